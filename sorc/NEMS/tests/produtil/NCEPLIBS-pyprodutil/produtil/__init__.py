@@ -37,6 +37,8 @@
 # * produtil.rstprod --- Handle NOAA restricted data requirements.
 # * produtil.dbn_alert --- Trigger DBNet alerts.
 # * produtil.datastore --- A database and product tracking.
+# * produtil.filewatch --- Waits for files to arrive, with inotify
+#   where it works and polling elsewhere.
 # * produtil.atparse --- A simple text preparser.
 #
 # @section prog_exec Program Execution
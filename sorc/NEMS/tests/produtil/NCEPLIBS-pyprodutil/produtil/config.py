@@ -802,8 +802,10 @@ class ProdConfig(object):
         with self:
             if self._datastore is None:
                 dsfile=self.getstr('config','datastore')
+                # [config] datastore_mode=wal on filesystems where sqlite3 locking works
+                dsmode=self.getstr('config','datastore_mode',None)
                 self._datastore=produtil.datastore.Datastore(dsfile,
-                    logger=self.log('datastore'))
+                    logger=self.log('datastore'),mode=dsmode)
             return self._datastore
 
     ##@var datastore
@@ -9,12 +9,14 @@ Datastore."""
 import sqlite3, threading, collections, re, contextlib, time, random,\
     traceback, datetime, logging, os, time
 import produtil.fileop, produtil.locking, produtil.sigsafety, produtil.log
+import produtil.filewatch
 
 ##@var __all__
 # Symbols exported by "from produtil.datastore import *"
 __all__=['DatumException','DatumLockHeld','InvalidID','InvalidOperation',
          'UnknownLocation','FAILED','UNSTARTED','RUNNING','PARTIAL',
-         'COMPLETED','Datastore','Transaction','Datum','CallbackExceptions',
+         'COMPLETED','LOCKFILE_MODE','WAL_MODE','ConnectionPool',
+         'Datastore','Transaction','Datum','CallbackExceptions',
          'Product','Task']
 
 class FakeException(Exception):
@@ -131,6 +133,141 @@ COMPLETED=30
 """Constant for use in Task.state: indicates the task ran to
 completion successfully."""
 
+##@var MAX_SQL_VARIABLES
+# Largest number of values bound in one "IN (...)" select; old sqlite3
+# libraries allow at most 999 variables per statement.
+MAX_SQL_VARIABLES=500
+
+def _chunks(items,size=MAX_SQL_VARIABLES):
+    """!Splits a list into lists of at most size items."""
+    for i in xrange(0,len(items),size):
+        yield items[i:i+size]
+
+##@var _VERSION_TRIGGERS
+# Triggers that give a Datum ID the next change sequence number in the
+# versions table whenever its products row or metadata change:
+# (name, event, table, condition, id)
+_VERSION_TRIGGERS=(
+    ('products_insert_version','INSERT','products','','NEW.id'),
+    ('products_update_version','UPDATE','products',
+     'WHEN OLD.available IS NOT NEW.available OR OLD.location IS NOT NEW.location',
+     'NEW.id'),
+    ('metadata_insert_version','INSERT','metadata','','NEW.id'),
+    ('metadata_update_version','UPDATE','metadata',
+     'WHEN OLD.value IS NOT NEW.value','NEW.id'),
+    ('metadata_delete_version','DELETE','metadata','','OLD.id') )
+
+##@var LOCKFILE_MODE
+# Datastore mode: every transaction holds a lock file next to the
+# database.  Safe on any filesystem, including those where sqlite3
+# locking or shared memory does not work.
+LOCKFILE_MODE='lockfile'
+
+##@var WAL_MODE
+# Datastore mode: sqlite3 write-ahead log journaling.  Writers take
+# the database with "BEGIN IMMEDIATE" and wait in sqlite3's busy
+# handler instead of polling a lock file, and readers work on a
+# snapshot that never blocks writers.  Needs a filesystem with working
+# POSIX locks and shared memory (not NFS or most parallel
+# filesystems).
+WAL_MODE='wal'
+
+##@var DEFAULT_BUSY_TIMEOUT
+# Seconds a WAL_MODE writer waits for another writer before failing.
+DEFAULT_BUSY_TIMEOUT=300.0
+
+##@var DEFAULT_POOL_SIZE
+# Maximum number of sqlite3 connections a Datastore opens.
+DEFAULT_POOL_SIZE=16
+
+class ConnectionPool(object):
+    """!A bounded pool of sqlite3 connections to one database file.
+
+    A thread takes a connection for its outermost transaction and
+    gives it back when that transaction ends, so threads outside a
+    transaction hold no connection.  Connections held by threads that
+    died without giving them back are rolled back and reused.  At most
+    "size" connections are opened; a thread asking for one while all
+    are in use waits until one is given back."""
+    def __init__(self,factory,size=DEFAULT_POOL_SIZE):
+        """!ConnectionPool constructor.
+        @param factory a function that opens a new connection
+        @param size the maximum number of connections"""
+        self._factory=factory
+        self.size=max(1,int(size))
+        self._cond=threading.Condition(threading.Lock())
+        self._idle=list()
+        self._owners=dict() # thread ident -> (thread, connection)
+        self._count=0
+    def _reap(self):
+        """!Takes back the connections of dead threads.  Must be
+        called with self._cond held."""
+        for tid,(thread,con) in list(self._owners.items()):
+            if thread.is_alive(): continue
+            del self._owners[tid]
+            try:
+                con.rollback()
+                self._idle.append(con)
+            except sqlite3.Error:
+                self._count-=1
+                try:
+                    con.close()
+                except sqlite3.Error: pass
+    def current(self):
+        """!The connection held by the current thread, or None."""
+        thread=threading.current_thread()
+        with self._cond:
+            owner=self._owners.get(thread.ident,None)
+            if owner is not None and owner[0] is thread:
+                return owner[1]
+            return None
+    def acquire(self,timeout=None):
+        """!Returns the connection of the current thread, taking one
+        from the pool if it has none.
+        @param timeout seconds to wait for a free connection, None
+          waits forever
+        @raise DatumException if no connection was free in time"""
+        thread=threading.current_thread()
+        start=time.time()
+        with self._cond:
+            while True:
+                owner=self._owners.get(thread.ident,None)
+                if owner is not None and owner[0] is thread:
+                    return owner[1]
+                self._reap() # also frees a dead thread's reused ident
+                if self._idle:
+                    con=self._idle.pop()
+                    break
+                if self._count<self.size:
+                    con=self._factory()
+                    self._count+=1
+                    break
+                if timeout is not None and time.time()-start>timeout:
+                    raise DatumException(
+                        'No free database connection after %.0f seconds '
+                        '(%d in use)'%(timeout,self._count))
+                self._cond.wait(1.0) # wake up now and then to reap dead threads
+            self._owners[thread.ident]=(thread,con)
+            return con
+    def release(self):
+        """!Gives the current thread's connection back to the pool."""
+        thread=threading.current_thread()
+        with self._cond:
+            owner=self._owners.get(thread.ident,None)
+            if owner is None or owner[0] is not thread: return
+            del self._owners[thread.ident]
+            self._idle.append(owner[1])
+            self._cond.notify()
+    def close(self):
+        """!Closes the connections no thread holds."""
+        with self._cond:
+            for con in self._idle:
+                try:
+                    con.close()
+                except sqlite3.Error: pass
+            self._count-=len(self._idle)
+            self._idle=list()
+
 class Datastore(object):
     """!Stores information about Datum objects in a database.  
 
@@ -142,8 +279,9 @@ class Datastore(object):
     parameter, and an arbitrary list of (key,value) metadata pairs.
     This object can safely be accessed by multiple threads in the
     local process, and handles concurrency between processes via file
-    locking."""
-    def __init__(self,filename,logger=None,locking=True):
+    locking, or via sqlite3's own locking in WAL_MODE."""
+    def __init__(self,filename,logger=None,locking=True,mode=None,
+                 busy_timeout=DEFAULT_BUSY_TIMEOUT,pool_size=DEFAULT_POOL_SIZE):
         """!Datastore constructor
 
         Creates a Datastore for the specified sqlite3 file.  Uses the
@@ -158,18 +296,33 @@ class Datastore(object):
         @param logger a logging.Logger to use for logging messages
         @param locking should file locking be used?  It is unwise to
           turn off file locking.
+        @param mode LOCKFILE_MODE or WAL_MODE.  The default is the
+          $PRODUTIL_DATASTORE_MODE environment variable, or
+          LOCKFILE_MODE if it is unset.  All processes sharing a
+          database must use the same mode.
+        @param busy_timeout seconds a WAL_MODE writer waits for another
+          one, and any thread waits for a free connection
+        @param pool_size maximum number of sqlite3 connections
         @warning Setting locking=False will disable file locking at
           both the Datastore level, and within sqlite3 itself.  This
           can lead to database corruption if two processes try to
           write at the same time.  This functionality is provided
           for the rare situation where you are unable to write to
           a database, such as when reading other users' sqlite3 
-          database files."""
+          database files.  It always uses LOCKFILE_MODE, without
+          the lock file."""
         self._logger=logger
         self.filename=filename
         self.db=None
         self._locking=locking
-        self._connections=dict()
+        if mode is None:
+            mode=os.environ.get('PRODUTIL_DATASTORE_MODE',LOCKFILE_MODE)
+        if mode not in (LOCKFILE_MODE,WAL_MODE):
+            raise DatumException('%s: unknown datastore mode %s'%(filename,repr(mode)))
+        self.mode=mode if locking else LOCKFILE_MODE
+        self._wal=(self.mode==WAL_MODE)
+        self._busy_timeout=float(busy_timeout)
+        self._pool=ConnectionPool(self._connect,pool_size)
         self._map_lock=threading.Lock()
         self._db_lock=threading.Lock()
         lockfile=filename+'.lock'
@@ -178,31 +331,61 @@ class Datastore(object):
         self._file_lock=produtil.locking.LockFile(
             lockfile,logger=logger,max_tries=300,sleep_time=0.1,first_warn=50)
         self._transtack=collections.defaultdict(list)
+        self._versioned=False
+        if self._wal:
+            # journaling can not change inside a transaction
+            try:
+                self._set_journal_mode(self._pool.acquire(self._busy_timeout),'wal')
+            finally:
+                self._pool.release()
         with self.transaction() as tx:
+            if locking and not self._wal:
+                # a database left in WAL journaling by a WAL_MODE run
+                self._set_journal_mode(self._connection(),'delete')
             self._createdb(self._connection())
+            self._versioned=self._createversions(self._connection())
     ##@var db 
     # The underlying sqlite3 database object
 
     ##@var filename
     # The path to the sqlite3 database file
 
+    def _connect(self):
+        """!Opens a new connection to the database, for the pool."""
+        if self._wal:
+            # transactions are begun and committed explicitly, see _begin
+            con=sqlite3.connect(self.filename,timeout=self._busy_timeout,
+                                isolation_level=None,check_same_thread=False)
+            con.execute('PRAGMA synchronous=NORMAL')
+        else:
+            con=sqlite3.connect(self.filename,check_same_thread=False)
+        return con
+    def _set_journal_mode(self,con,journal):
+        """!Switches the journaling of the database file, unless it is
+        already set.  WAL journaling is kept in the file, so it is
+        switched back when the file is opened in LOCKFILE_MODE.
+        @param con the connection to use
+        @param journal 'wal' or 'delete'"""
+        mode=con.execute('PRAGMA journal_mode').fetchone()[0]
+        if str(mode).lower()!=journal:
+            mode=con.execute('PRAGMA journal_mode=%s'%journal).fetchone()[0]
+            if self._logger is not None:
+                self._logger.info('%s: journal mode %s'%(self.filename,mode))
     def _connection(self):
-        """!Gets the current thread's database connection.  Each thread
-        has its own connection."""
-        tid=threading.current_thread().ident
-        with self._map_lock:
-            if tid in self._connections:
-                return self._connections[tid]
-            else:
-                c=sqlite3.connect(self.filename)
-                self._connections[tid]=c
-                return c
+        """!Gets the current thread's database connection.  A thread
+        holds a connection of the pool while it is in a transaction."""
+        con=self._pool.current()
+        if con is None:
+            con=self._pool.acquire(self._busy_timeout)
+        return con
     @contextlib.contextmanager
     def _mystack(self):
         """!Gets the transaction stack for the current thread."""
         tid=threading.current_thread().ident
         with self._map_lock:
-            yield self._transtack[tid]
+            stack=self._transtack[tid]
+            yield stack
+            if not stack: del self._transtack[tid]
     def _lock(self):
         """!Acquires the database lock for the current thread."""
         if not self._locking: return
@@ -222,9 +405,45 @@ class Datastore(object):
         #if self._logger is not None:
         #        self._logger.info('db lock release: '+\
         #          (''.join(traceback.format_list(traceback.extract_stack(limit=10)))))
-    def transaction(self):
-        """!Starts a transaction on the database in the current thread."""
-        return Transaction(self)
+    def _begin(self,readonly=False):
+        """!Starts the outermost transaction of the current thread: takes
+        a connection, then the lock file (LOCKFILE_MODE), or begins an
+        sqlite3 transaction (WAL_MODE).  A WAL_MODE write transaction
+        waits up to busy_timeout for other writers, a read-only one
+        reads a snapshot and waits for nobody.
+        @param readonly True if the transaction will not write"""
+        con=self._pool.acquire(self._busy_timeout)
+        try:
+            if self._wal:
+                con.execute('BEGIN' if readonly else 'BEGIN IMMEDIATE')
+            else:
+                self._lock()
+        except:
+            self._pool.release()
+            raise
+    def _end(self):
+        """!Ends the outermost transaction of the current thread:
+        commits, releases the lock and gives back the connection."""
+        try:
+            con=self._connection()
+            if self._wal:
+                con.execute('COMMIT')
+            else:
+                try:
+                    con.commit()
+                finally:
+                    self._unlock()
+        finally:
+            self._pool.release()
+    def close(self):
+        """!Closes the database connections no thread is using.
+        Connections are opened again as needed."""
+        self._pool.close()
+    def transaction(self,readonly=False):
+        """!Starts a transaction on the database in the current thread.
+        @param readonly True for a transaction that will only read,
+          which never blocks nor waits for writers in WAL_MODE"""
+        return Transaction(self,readonly)
     def _createdb(self,con):
         """!Creates the tables used by this Datastore.  
 
@@ -238,13 +457,38 @@ class Datastore(object):
         con.execute('''CREATE TABLE IF NOT EXISTS products ( id TEXT NOT NULL, available INTEGER DEFAULT 0, location TEXT DEFAULT "", type TEXT DEFAULT "Product", PRIMARY KEY(id))''')
         con.execute('''CREATE TABLE IF NOT EXISTS metadata ( id TEXT NOT NULL, key TEXT NOT NULL, value TEXT, CONSTRAINT id_metakey PRIMARY KEY(id,key))''')
         con.execute('''CREATE TABLE IF NOT EXISTS workers ( info TEXT NOT NULL, lastseen INTEGER NOT NULL)''')
+    def _createversions(self,con):
+        """!Creates the change sequence: the versions table, holding
+        the sequence number of the last change of each Datum ID, and
+        the triggers that fill it.  The triggers are in the database
+        file, so writes from any process, even ones that predate the
+        versions table, advance the sequence.
+
+        Must run inside a transaction.  Returns False, and Datum
+        caches fall back to rereading the database when they age out,
+        if the database is read-only and has no versions table.
+        @param con the connection to use"""
+        try:
+            con.execute('''CREATE TABLE IF NOT EXISTS versions ( id TEXT NOT NULL, version INTEGER NOT NULL, PRIMARY KEY(id))''')
+            con.execute('''CREATE INDEX IF NOT EXISTS versions_version ON versions (version)''')
+            for (name,event,table,when,did) in _VERSION_TRIGGERS:
+                # No conflict clause in the body: the "OR IGNORE" of
+                # an outer "UPDATE OR IGNORE" would override it.
+                con.execute('''CREATE TRIGGER IF NOT EXISTS %s AFTER %s ON %s %s BEGIN UPDATE versions SET version=(SELECT MAX(version)+1 FROM versions) WHERE id=%s; INSERT INTO versions SELECT %s, (SELECT IFNULL(MAX(version),0)+1 FROM versions) WHERE NOT EXISTS (SELECT 1 FROM versions WHERE id=%s); END'''
+                            %(name,event,table,when,did,did,did))
+        except sqlite3.OperationalError as e:
+            if self._logger is not None:
+                self._logger.info('%s: no change sequence: %s'%(
+                        self.filename,str(e)))
+            return False
+        return True
     def dump(self):
         """!Print database contents to the terminal.
 
         This function is only meant for debugging.  It dumps to the
         terminal an arguably human-readable display of the complete
         database state via the print command."""
-        with self.transaction() as t:
+        with self.transaction(readonly=True) as t:
             products=t.query('SELECT id,available,location,type FROM products')
             meta=t.query('SELECT id,key,value FROM metadata')
         print 'TABLE products:'
@@ -284,21 +528,35 @@ class Transaction(object):
     with datum_object.transaction() as t:
         ... do things to the datum object ...
     transaction is now complete, database is updated."""
-    def __init__(self,ds):
+    def __init__(self,ds,readonly=False):
         """!Transaction constructor.
 
         Creates the Transaction object but does NOT initiate the
-        transaction."""
+        transaction.
+        @param ds the Datastore
+        @param readonly True if the transaction will not write.  In
+          WAL_MODE it then reads a snapshot without waiting for
+          writers, and writing in it raises InvalidOperation."""
         self.ds=ds
+        self.readonly=bool(readonly)
 
     def __enter__(self):
         """!Locks the database for the current thread, if it isn't
         already locked."""
         with self.ds._mystack() as s:
             first=not s # True = first transaction from this thread
+            if not first and s[0].readonly and not self.readonly \
+                    and self.ds._wal:
+                raise InvalidOperation(
+                    'Cannot start a write transaction inside a read-only one.')
             s.append(self)
         if first:
-            self.ds._lock()
+            try:
+                self.ds._begin(self.readonly)
+            except:
+                with self.ds._mystack() as s:
+                    s.remove(self)
+                raise
         return self
     def __exit__(self,etype,evalue,traceback):
         """!Releases the database lock if this is the last Transaction
@@ -309,8 +567,7 @@ class Transaction(object):
             assert(s.pop() is self)
             unlock=not s
         if unlock:
-            self.ds._connection().commit()
-            self.ds._unlock()
+            self.ds._end()
     def query(self,stmt,subvals=()):
         """!Performs an SQL query returning the result of cursor.fetchall()
         @param stmt the SQL query
@@ -322,8 +579,18 @@ class Transaction(object):
         of cursor.lastrowid
         @param stmt the SQL query
         @param subvals the substitution values"""
+        self._check_writable(stmt)
         cursor=self.ds._connection().execute(stmt,subvals)
         return cursor.lastrowid
+    def _check_writable(self,stmt):
+        """!Raises InvalidOperation if the current thread is in a
+        WAL_MODE read-only transaction.
+        @param stmt the SQL statement, for the message"""
+        if self.ds._wal:
+            with self.ds._mystack() as s:
+                readonly=s[0].readonly if s else False
+            if readonly:
+                raise InvalidOperation('Cannot write in a read-only transaction: %s'%(stmt,))
     def init_datum(self,d,meta=True):
         """!Add a Datum to the database if it is not there already.
 
@@ -354,6 +621,38 @@ class Transaction(object):
                     self.mutate('INSERT OR IGNORE INTO metadata VALUES (?,?,?)',(d.did,k,v))
         if meta:
             self.refresh_meta(d,or_add=False)
+    def init_many(self,datums,meta=True):
+        """!Adds many Datum objects to the database, those not there
+        already, and fills their metadata caches from the database.
+
+        Same as calling init_datum on each, with one executemany per
+        table and a few selects (see refresh_many) instead of several
+        statements per Datum.  Use it with Datum objects created with
+        init=False.
+        @param datums a list of Datum objects
+        @param meta If True, also initialize metadata."""
+        datums=list(datums)
+        rows=list(); locs=list(); metas=list()
+        for d in datums:
+            av = d._meta['available'] if ('available' in d._meta) else 0
+            loc = d._meta['location'] if ('location' in d._meta) else ''
+            rows.append((d.did,av,loc,type(d).__name__))
+            if loc is not None and loc!='':
+                locs.append((loc,d.did))
+            if meta and d._meta:
+                metas.extend((d.did,k,v) for k,v in d._meta.iteritems()
+                             if k!='location' and k!='available')
+        con=self.ds._connection()
+        self._check_writable('INSERT INTO products')
+        con.executemany('INSERT OR IGNORE INTO products VALUES (?,?,?,?)',rows)
+        if locs:
+            # Set the location where the product table has none
+            con.executemany('UPDATE products SET location=? WHERE id=? '
+                            'AND (location IS NULL OR location="")',locs)
+        if metas:
+            con.executemany('INSERT OR IGNORE INTO metadata VALUES (?,?,?)',metas)
+        if meta:
+            self.refresh_many(datums,or_add=False)
     def update_datum(self,d):
         """!Update database availability and location records.
 
@@ -365,6 +664,46 @@ class Transaction(object):
         av=int(d._meta['available'])
         self.mutate('INSERT OR REPLACE INTO products VALUES (?,?,?,?)',
                     (d.did,av,loc,type(d).__name__))
+    def version(self):
+        """!Returns the change sequence number of the latest change to
+        the database, 0 if nothing changed since the versions table
+        was created, or None if the database has none.  One indexed
+        select."""
+        if not self.ds._versioned: return None
+        for (version,) in self.query('SELECT MAX(version) FROM versions'):
+            return version or 0
+        return 0
+    def changed_since(self,version):
+        """!Finds the Datum IDs that changed after a change sequence
+        number.
+        @param version a number returned by version()
+        @returns a tuple (latest,ids) of the latest sequence number
+          and the set of Datum IDs changed since version, or
+          (None,None) if the database has no change sequence"""
+        if not self.ds._versioned: return (None,None)
+        latest=version or 0
+        ids=set()
+        for (did,v) in self.query('SELECT id, version FROM versions WHERE version > ?',
+                                  (version or 0,)):
+            ids.add(did)
+            latest=max(latest,v)
+        return (latest,ids)
+    def validate_meta(self,d):
+        """!Checks a Datum's metadata cache against the change sequence:
+        whether its rows changed since the cache was read.  One
+        indexed select.
+        @param d the Datum
+        @returns True if the cache is still valid, False if it must be
+          reread (always, if there is no change sequence)"""
+        if not self.ds._versioned or d._version is None:
+            return False
+        for (latest,mine) in self.query(
+                'SELECT (SELECT MAX(version) FROM versions), '
+                '(SELECT version FROM versions WHERE id = ?)',(d.did,)):
+            if mine is None or mine<=d._version:
+                d._version=latest or 0
+                return True
+        return False
     def refresh_meta(self,d,or_add=True):
         """!Replace Datum metadata with database values, add new metadata to database.
 
@@ -373,7 +712,8 @@ class Transaction(object):
         exception if the product does not exist in the database.
         @param d The Datum.
         @param or_add If True, then any metadata that does not exist in the 
-          database is created from values in d."""
+          database is created from values in d.
+        @returns True if the Datum was in the database"""
         found=False
         meta=dict()
         for (did,av,loc) in \
@@ -392,6 +732,107 @@ class Transaction(object):
         for (did,k,v) in self.query('SELECT id, key, value FROM metadata WHERE id = ?',(d.did,)):
             meta[k]=v
         d._meta=meta
+        d._version=self.version()
+        return found
+    def refresh_many(self,datums,or_add=True):
+        """!Replaces the metadata caches of many Datum objects with the
+        database values, in one select per table (per MAX_SQL_VARIABLES
+        objects) instead of two per Datum.
+
+        Same as calling refresh_meta on each.  The caches are marked
+        fresh, so reading availability, location or metadata from the
+        objects does not go back to the database until they age out.
+        @param datums a list of Datum objects
+        @param or_add If True, objects not in the database are added
+          with init_many.
+        @returns the list of Datum objects that were not in the database"""
+        datums=list(datums)
+        meta=dict((d.did,dict()) for d in datums)
+        found=set()
+        ids=list(meta)
+        for chunk in _chunks(ids):
+            marks=','.join('?'*len(chunk))
+            for (did,av,loc) in self.query(
+                    'SELECT id, available, location FROM products WHERE id IN (%s)'
+                    %(marks,),chunk):
+                found.add(did)
+                meta[did]['available']=av
+                meta[did]['location']=loc
+            for (did,k,v) in self.query(
+                    'SELECT id, key, value FROM metadata WHERE id IN (%s)'
+                    %(marks,),chunk):
+                meta[did][k]=v
+        missing=[d for d in datums if d.did not in found]
+        if missing and or_add:
+            self.init_many(missing,meta=False)
+        now=time.time()
+        version=self.version()
+        for d in datums:
+            m=meta[d.did]
+            if d.did not in found:
+                m['available']=0
+                m['location']=''
+            with d:
+                d._meta=dict(m)
+                d._cachetime=now
+                d._version=version
+        return missing
+    def set_meta_many(self,items):
+        """!Sets many metadata values at once.
+
+        Same as calling set_meta for each (Datum, key, value), with one
+        executemany for each of location, availability and other keys.
+        The metadata caches of the Datum objects are updated too.
+        @param items an iterable of (Datum, key, value)"""
+        locs=list(); avails=list(); metas=list(); cached=list()
+        for (d,k,v) in items:
+            if k=='location':
+                locs.append((v,d.did))
+            elif k=='available':
+                v=int(v)
+                avails.append((v,d.did))
+            else:
+                metas.append((d.did,k,v))
+            cached.append((d,k,v))
+        con=self.ds._connection()
+        self._check_writable('UPDATE products')
+        if locs:
+            con.executemany('UPDATE OR IGNORE products SET location = ? WHERE id = ?',locs)
+        if avails:
+            con.executemany('UPDATE OR IGNORE products SET available = ? WHERE id = ?',avails)
+        if metas:
+            con.executemany('INSERT OR REPLACE INTO metadata VALUES (?,?,?)',metas)
+        for (d,k,v) in cached:
+            with d:
+                d._meta[k]=v
+    def query_by_category(self,category,prodtype=None):
+        """!Reads every Datum of a category, with its metadata, in one
+        select.
+
+        @param category the category, the part of the database IDs
+          before the "::"
+        @param prodtype Optional: only Datum objects of this type
+          (the Python class name, i.e. "FileProduct")
+        @returns a dict mapping each product name to a dict of its
+          metadata, including "available", "location" and "type" """
+        # IDs of the category sort between "category::" and "category:;"
+        where='p.id >= ? AND p.id < ?'
+        subvals=[category+'::',category+':;']
+        if prodtype is not None:
+            where+=' AND p.type = ?'
+            subvals.append(prodtype)
+        result=dict()
+        start=len(category)+2
+        for (did,av,loc,typ,k,v) in self.query(
+                'SELECT p.id, p.available, p.location, p.type, m.key, m.value '
+                'FROM products p LEFT JOIN metadata m ON m.id = p.id WHERE '
+                +where,subvals):
+            name=did[start:]
+            if name not in result:
+                result[name]={'available':av,'location':loc,'type':typ}
+            if k is not None:
+                result[name][k]=v
+        return result
     def set_meta(self,d,k,v):
         """!Sets metadata key k to value v for the given Datum.  
 
@@ -430,16 +871,23 @@ class Datum(object):
     datastore.  It has a category, a product name (prodname for
     short), a location, availability (an int) and arbitrary metadata
     (key,value) pairs.  It caches database metadata in self._meta,
-    which is directly accessed by the Datastore class.  Cache data
-    will be discarded once its age is older than self._cacheage."""
-    def __init__(self,dstore,prodname,category,meta=None,cache=30,location=None,**kwargs):
+    which is directly accessed by the Datastore class.  Every read
+    checks the cache against the database change sequence (see
+    Transaction.validate_meta) and only rereads it if this Datum
+    changed.  Databases without a change sequence trust the cache for
+    self._cacheage seconds instead."""
+    def __init__(self,dstore,prodname,category,meta=None,cache=30,location=None,init=True,**kwargs):
         """!Datum constructor.
 
         Creates a Datum in the given Datastore dstore, under the
         specified category and product name prodname.  The datastore
-        id used is "category::prodname".  The value for "cache" is the
-        number of seconds to retain cached metadata before going back
-        to disk to reread it.  That only applies to data "get"
+        id used is "category::prodname".  Cached metadata is checked
+        against the database change sequence on every read, one
+        indexed select, and only reread if it changed.  The value for
+        "cache" is the number of seconds to trust cached metadata
+        without checking, only used for databases without a change
+        sequence (read-only ones made by older versions).  A false
+        value for "cache" disables caching.  That only applies to data "get"
         operations: setting a data or metadata value will cause an
         immediate write to the database.  Also, __contains__ ("var" in
         self) will force a fetch from the database if the requested
@@ -458,13 +906,17 @@ class Datum(object):
         @param meta A dict of metadata values.
         @param cache Metadata cache lifetime in seconds.
         @param location The initial value for location, if it is not set already in the database.
+        @param init If False, the Datum is not read from nor added to
+          the database here: many are then added at once by
+          Transaction.init_many.
         @param kwargs Ignored."""
         #print 'INIT WITH location=%s prodname=%s category=%s'% \
         #    (repr(location),repr(prodname),repr(category))
         (self._dstore,self._prodname,self._category) = (dstore,str(prodname),str(category))
         self._id=self._category+'::'+self._prodname
         self._cachetime=time.time()
-        self._cacheage=30
+        self._cacheage=cache
+        self._version=None
         if not cache:
             self._cacheage=-1
         self.validate()
@@ -477,8 +929,9 @@ class Datum(object):
         if 'available' in self._meta:
             self._meta['available']=int(self._meta['available'])
         self._lock=threading.RLock()
-        with self._dstore.transaction() as t:
-            t.init_datum(self)
+        if init:
+            with self._dstore.transaction() as t:
+                t.init_datum(self)
 
     # Lock/unlock self:
     def __enter__(self):
@@ -593,23 +1046,33 @@ class Datum(object):
     def _getcache(self,k=None,force=False):
         """!Requests or forces a cache update.
         This is the implementation of metadata/location/available
-        caching.  It returns self._meta if the cache has not aged out
-        (and k, if provided, is in self._meta) or goes to the
+        caching.  It returns self._meta if the change sequence shows
+        this Datum did not change since it was read (or, without a
+        change sequence, if the cache has not aged out), and k, if
+        provided, is in self._meta.  Otherwise it goes to the
         Datastore to update the cache, and then returns the resulting
         self._meta.  This MUST be called from within a "with self".
         @param k The key of interest.
         @param force If True, forces a cache update even if the
-          cache is not expired."""
+          cache is still valid."""
         logger=self.dstore._logger
         did=self.did
-        if not force:
+        cached=not force and self._cacheage>=0 and (k is None or k in self._meta)
+        if cached and not self._dstore._versioned:
+            # no change sequence to check: trust the cache for its lifetime
             age=time.time()-self._cachetime
             if age<self._cacheage:
-                if k is None or k in self._meta:
-                    return self._meta
-        with self.transaction() as t:
-            t.refresh_meta(self)
-            self._cachetime=time.time()
+                return self._meta
+        # a read-only transaction first: it never waits for writers in WAL_MODE
+        with self._dstore.transaction(readonly=True) as t:
+            if cached and t.validate_meta(self):
+                self._cachetime=time.time()
+                return self._meta
+            found=t.refresh_meta(self,or_add=False)
+        if not found:
+            with self.transaction() as t:
+                t.refresh_meta(self)
+        self._cachetime=time.time()
         return self._meta
     def update(self):
         """!Discards all cached metadata and refreshes it from the
@@ -974,6 +1437,46 @@ class UpstreamFile(Product):
 
 ########################################################################
 
+def _overrides_check(product):
+    """!True if the product's class has its own check method, one
+    that does more than reread the database."""
+    check=type(product).check
+    return getattr(check,'im_func',check) is not \
+        getattr(Product.check,'im_func',Product.check)
+
+def refresh_products(plist,versions=None):
+    """!Refreshes the metadata caches of many Product (or other Datum)
+    objects with one read-only transaction and a few selects per
+    Datastore, instead of one transaction per object.
+
+    To poll, pass the same versions dict each time.  It keeps the
+    change sequence number each Datastore was last read at, and later
+    calls only reread the objects that changed since then: a poll in
+    which nothing changed is one indexed select per Datastore.
+    @param plist a list of Datum objects
+    @param versions Optional: a dict to keep the change sequence
+      numbers in, between calls"""
+    by_store=dict()
+    for p in plist:
+        by_store.setdefault(id(p.dstore),(p.dstore,list()))[1].append(p)
+    for (key,(dstore,datums)) in by_store.iteritems():
+        with dstore.transaction(readonly=True) as t:
+            if versions is not None and versions.get(key) is not None:
+                (latest,changed)=t.changed_since(versions[key])
+                now=time.time()
+                for d in datums:
+                    if d.did not in changed:
+                        with d:
+                            d._cachetime=now
+                            if d._version is not None: d._version=latest
+                datums=[d for d in datums if d.did in changed]
+            else:
+                latest=t.version()
+            if datums:
+                t.refresh_many(datums,or_add=False)
+        if versions is not None:
+            versions[key]=latest
+
 def wait_for_products(plist,logger,renamer=None,action=None,
                       renamer_args=None,action_args=None,sleeptime=20,
                       maxtime=1800):
@@ -981,8 +1484,11 @@ def wait_for_products(plist,logger,renamer=None,action=None,
 
     Waits for a specified list of products to be available, and
     performs some action on each product when it becomes available.
-    Sleeps sleeptime seconds between checks.  Returns the number of
-    products that were found before the maxtime was reached.
+    Between checks, it waits up to sleeptime seconds for a write to
+    the database files (or to the location of a product whose class
+    checks its file, like UpstreamFile).  See produtil.filewatch.
+    Returns the number of products that were found before the maxtime
+    was reached.
 
     @param plist A Product or a list of Product objects.
     @param logger A logging.Logger object in which to log messages.
@@ -996,9 +1502,9 @@ def wait_for_products(plist,logger,renamer=None,action=None,
     @param renamer_args Optional: arguments to renamer.
     @param action_args Optional: arguments to action.
     @param sleeptime - after checking availability of all products, if
-       at least one is unavailable, the code will sleep for this much
-       time before rechecking.  Will be overridden by 0.01 if it is
-       set to something lower than that.  Default: 20
+       at least one is unavailable, the code will wait at most this
+       much time before rechecking.  Will be overridden by 0.01 if it
+       is set to something lower than that.  Default: 20
     @param maxtime - maximum amount of time to spend in this routine
        before giving up.
     @returns the number of products that became available before the
@@ -1010,9 +1516,7 @@ def wait_for_products(plist,logger,renamer=None,action=None,
     if not ( isinstance(plist,tuple) or isinstance(plist,list) ):
         raise TypeError('In wait_for_products, plist must be a '
                         'list or tuple, not a '+type(plist).__name__)
-    now=int(time.time())
-    start=now
-    seen=set()
+    start=int(time.time())
     for p in plist:
         if not isinstance(p,Product):
             raise TypeError('In wait_for_products, plist must only '
@@ -1020,11 +1524,35 @@ def wait_for_products(plist,logger,renamer=None,action=None,
     if renamer_args is None: renamer_args=list()
     if action_args is None: action_args=list()
     logger.info('Waiting for %d products.'%(int(len(plist)),))
+    versions=dict()
+    watched=set()
+    for p in plist:
+        watched.add(p.dstore.filename)
+        watched.add(p.dstore.filename+'-wal')
+        if _overrides_check(p) and p.location:
+            watched.add(p.location)
+    with produtil.filewatch.watch_files(
+            sorted(watched),modify=True,max_interval=sleeptime,
+            logger=logger) as watcher:
+        return _wait_for_products(plist,logger,renamer,action,
+                                  renamer_args,action_args,sleeptime,
+                                  maxtime,start,versions,watcher)
+
+def _wait_for_products(plist,logger,renamer,action,renamer_args,
+                       action_args,sleeptime,maxtime,start,versions,
+                       watcher):
+    """!Implementation of wait_for_products, with a
+    produtil.filewatch watcher to wait on."""
+    now=start
+    seen=set()
     while len(seen)<len(plist) and now<start+maxtime:
         now=int(time.time())
+        refresh_products([p for p in plist if p not in seen],versions)
+        nseen=len(seen)
         for p in plist:
             if p in seen: continue
-            if not p.available: p.check()
+            # Product.check only rereads the database, which was just done
+            if not p.available and _overrides_check(p): p.check()
             if p.available:
                 logger.info('Product %s is available at location %s'
                             %(repr(p.did),repr(p.location)))
@@ -1036,13 +1564,15 @@ def wait_for_products(plist,logger,renamer=None,action=None,
                 logger.info(
                     'Product %s not available (available=%s location=%s).'
                     %(repr(p.did),repr(p.available),repr(p.location)))
+        if len(seen)>nseen: watcher.poke()
         now=int(time.time())
         if now<start+maxtime and len(seen)<len(plist):
             sleepnow=max(0.01,min(sleeptime,start+maxtime-now-1))
             logfun=logger.info if (sleepnow>=5) else logger.debug
-            logfun('Sleeping %g seconds...'%(float(sleepnow),))
-            time.sleep(sleepnow)
-            logfun('Done sleeping.')
+            logfun('Waiting up to %g seconds for changes (%s)...'
+                   %(float(sleepnow),watcher.backend))
+            watcher.wait(sleepnow)
+            logfun('Done waiting.')
     logger.info('Done waiting for products: found %d of %d products.'
                 %(int(len(seen)),int(len(plist))))
     return len(seen)
@@ -1200,3 +1730,67 @@ class Task(Datum):
         implementation simply calls self.run()"""
         self.run()
 
+
+########################################################################
+
+def _benchmark_worker(filename,mode,worker,nupdates,nreads,start,result):
+    """!One process of benchmark(): nupdates metadata updates and
+    nreads forced metadata reads of its own Product, after waiting for
+    the start event so all processes contend at once."""
+    ds=Datastore(filename,mode=mode)
+    prod=Product(ds,'product%d'%worker,'benchmark')
+    start.wait()
+    t0=time.time()
+    for i in xrange(nupdates):
+        prod['count']=str(i)
+        for j in xrange(nreads):
+            prod.update()
+    result.put((worker,time.time()-t0))
+    ds.close()
+
+def benchmark(filename,nprocs=8,nupdates=200,nreads=0,mode=WAL_MODE):
+    """!Contention benchmark: nprocs processes sharing one database
+    file each update the metadata of a Product nupdates times, with
+    nreads reads after each update.  Prints and returns the wall time
+    and the updates per second of all the processes together.
+    @param filename the database file, it is removed first
+    @param nprocs number of processes
+    @param nupdates updates per process
+    @param nreads forced metadata reads after each update
+    @param mode LOCKFILE_MODE or WAL_MODE"""
+    import multiprocessing
+    for ext in ('','-wal','-shm','.lock'):
+        if os.path.exists(filename+ext): os.remove(filename+ext)
+    Datastore(filename,mode=mode).close() # creates the tables
+    start=multiprocessing.Event()
+    result=multiprocessing.Queue()
+    procs=[multiprocessing.Process(target=_benchmark_worker,args=(
+                filename,mode,i,nupdates,nreads,start,result))
+           for i in xrange(nprocs)]
+    for proc in procs: proc.start()
+    time.sleep(0.5) # let every process open the database
+    t0=time.time()
+    start.set()
+    times=[result.get() for proc in procs]
+    wall=time.time()-t0
+    for proc in procs: proc.join()
+    slowest=max(t for (worker,t) in times)
+    rate=nprocs*nupdates/wall if wall>0 else 0.0
+    print('%-8s %d processes x %d updates (%d reads each): %.2f s wall, '
+          '%.0f updates/s, slowest process %.2f s'%(
+            mode,nprocs,nupdates,nreads,wall,rate,slowest))
+    return wall,rate
+
+if __name__=='__main__':
+    import argparse
+    parser=argparse.ArgumentParser(
+        description='produtil.datastore contention benchmark')
+    parser.add_argument('filename',help='database file, removed first')
+    parser.add_argument('-n','--nprocs',type=int,default=8)
+    parser.add_argument('-m','--nupdates',type=int,default=200)
+    parser.add_argument('-r','--nreads',type=int,default=0)
+    parser.add_argument('--mode',choices=[LOCKFILE_MODE,WAL_MODE],
+                        help='one mode, both are compared by default')
+    args=parser.parse_args()
+    for mode in ([args.mode] if args.mode else [LOCKFILE_MODE,WAL_MODE]):
+        benchmark(args.filename,args.nprocs,args.nupdates,args.nreads,mode)
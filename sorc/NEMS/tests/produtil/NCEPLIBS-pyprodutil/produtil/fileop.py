@@ -11,14 +11,17 @@ __all__=['FileOpError','FileOpErrors','CannotLinkMulti',
          'FindExeInvalidExeName','CannotFindExe','RelativePathError',
          'DeliveryFailed','VerificationFailed','realcwd','chdir',
          'makedirs','remove_file','rmall','lstat_stat','isnonempty',
-         'check_file','deliver_file','make_symlinks_in','find_exe',
+         'check_file','deliver_file','deliver_many','RateBudget',
+         'make_symlinks_in','find_exe',
          'make_symlink','replace_symlink','unblock','fortcopy',
          'norm_expand_path','norm_abs_path','check_last_lines',
          'wait_for_files','FileWaiter','call_fcntrl','gribver',
          'netcdfver','touch']
 
 import os,tempfile,filecmp,stat,shutil,errno,random,time,fcntl,math,logging
-import produtil.cluster, produtil.pipeline
+import zlib,threading,ctypes,ctypes.util
+import produtil.cluster, produtil.pipeline, produtil.filewatch
+import produtil.workpool
 
 module_logger=logging.getLogger('produtil.fileop')
 
@@ -341,11 +344,192 @@ def isnonempty(filename):
     return ret
 
 ########################################################################    
+##@var ZERO_COPY
+# If True, deliver_file copies with the copy_file_range or sendfile
+# system calls, so the data does not pass through Python.  They are
+# only used when available.
+ZERO_COPY=True
+
+##@var ZERO_COPY_BLOCKS
+# Number of deliver_file blocksize blocks copied by one
+# copy_file_range or sendfile call.
+ZERO_COPY_BLOCKS=64
+
+##@var VERIFY_BLOCKSIZE
+# Read size when a verified kernel copy is compared to its input.
+# Small reads stay in the CPU caches: with the deliver_file blocksize
+# (1 MB) the comparison takes twice as long.
+VERIFY_BLOCKSIZE=131072
+
+_copy_libc=None
+
+def _zero_copy_calls():
+    """!Returns a list of (name,function) of the zero-copy system calls
+    the C library has, as ctypes functions."""
+    global _copy_libc
+    if _copy_libc is None:
+        _copy_libc=list()
+        try:
+            libc=ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                             use_errno=True)
+        except OSError:
+            return _copy_libc
+        try:
+            fun=libc.copy_file_range
+            fun.argtypes=[ctypes.c_int,ctypes.c_void_p,ctypes.c_int,
+                          ctypes.c_void_p,ctypes.c_size_t,ctypes.c_uint]
+            fun.restype=ctypes.c_ssize_t
+            # copy_file_range(in,None,out,None,count,0)
+            _copy_libc.append(('copy_file_range',
+                               lambda i,o,n: fun(i,None,o,None,n,0)))
+        except AttributeError: pass
+        try:
+            send=libc.sendfile
+            send.argtypes=[ctypes.c_int,ctypes.c_int,ctypes.c_void_p,
+                           ctypes.c_size_t]
+            send.restype=ctypes.c_ssize_t
+            _copy_libc.append(('sendfile',lambda i,o,n: send(o,i,None,n)))
+        except AttributeError: pass
+    return _copy_libc
+
+def _kernel_copy(infd,outfd,count,budget=None,verify=False,
+                 blocksize=VERIFY_BLOCKSIZE):
+    """!Copies from one file descriptor to another, from their current
+    offsets to the end of the input, inside the kernel.  Tries
+    copy_file_range and then sendfile.  With verify, each piece the
+    kernel copied is read back from both files right away, while it
+    is still in the page cache, and compared.
+    @param infd,outfd the input and output file descriptors; the
+      output must be open for reading too if verify
+    @param count bytes to copy per system call, no more than a
+      budget's chunk() when there is a budget
+    @param budget a RateBudget, or None
+    @param verify If True, compare the copy to the input
+    @param blocksize read size of the comparison
+    @returns a tuple (name,differs) of the name of the system call
+      used, or None if none of them can copy these files (then nothing
+      was copied), and the input offset of the first block that
+      differs, or None"""
+    if budget is not None: count=budget.chunk(count)
+    for (name,call) in _zero_copy_calls():
+        copied=0
+        while True:
+            n=call(infd,outfd,count)
+            if n<0:
+                e=ctypes.get_errno()
+                if e==errno.EINTR: continue
+                if copied==0 and e in (errno.ENOSYS,errno.EXDEV,
+                                       errno.EINVAL,errno.EOPNOTSUPP,
+                                       errno.EBADF,errno.ESPIPE):
+                    break # cannot copy these files this way; try another
+                raise OSError(e,'%s: %s'%(name,os.strerror(e)))
+            if n==0: return (name,None)
+            if budget is not None: budget.take(n)
+            if verify:
+                # both calls moved the two offsets past the piece
+                os.lseek(infd,-n,os.SEEK_CUR)
+                os.lseek(outfd,-n,os.SEEK_CUR)
+                left=n
+                while left>0:
+                    size=min(left,blocksize)
+                    if os.read(infd,size)!=os.read(outfd,size):
+                        return (name,copied+n-left)
+                    left-=size
+            copied+=n
+    return (None,None)
+
+def _copy_data(indata,outdata,blocksize,verify=False,budget=None,
+               logger=None,target=None):
+    """!Copies a file for deliver_file: by the kernel if possible (see
+    ZERO_COPY), or through Python.  When verify is requested, a kernel
+    copy is compared to the input piece by piece as it is made, and a
+    copy through Python gets the CRC-32 of the data.
+    @param indata,outdata the open input and output files
+    @param blocksize block size for copies through Python
+    @param verify If True, verify the copy
+    @param budget a RateBudget, or None
+    @param logger a logging.Logger for messages
+    @param target the final name of the output, for messages
+    @returns the CRC-32 of the data if verify and it was copied
+      through Python, for the caller to compare to the output, or
+      None"""
+    if ZERO_COPY:
+        outdata.flush()
+        (name,differs)=_kernel_copy(indata.fileno(),outdata.fileno(),
+                                    blocksize*ZERO_COPY_BLOCKS,budget,
+                                    verify)
+        if differs is not None:
+            raise VerificationFailed(
+                'copy by %s differs in the block at byte %d'%(name,differs),
+                indata.name,target,outdata.name)
+        if name is not None:
+            if logger is not None:
+                logger.debug('%s: copied by %s'%(indata.name,name))
+            return None
+    crc=0
+    while True:
+        buf=indata.read(blocksize)
+        if not buf: break
+        if budget is not None: budget.take(len(buf))
+        if verify: crc=zlib.crc32(buf,crc)
+        outdata.write(buf)
+    return crc&0xffffffff if verify else None
+
+def _file_checksum(filename,blocksize=1048576):
+    """!Returns the CRC-32 of a file's contents.
+    @param filename the file
+    @param blocksize read size"""
+    crc=0
+    with open(filename,'rb') as f:
+        while True:
+            buf=f.read(blocksize)
+            if not buf: break
+            crc=zlib.crc32(buf,crc)
+    return crc&0xffffffff
+
+class RateBudget(object):
+    """!A byte rate shared by several threads.  Each one calls take()
+    after copying some bytes, and it sleeps as needed so all of them
+    together stay within the rate.  Copies are charged in pieces of
+    at most chunk() bytes, so no thread runs far ahead of the rate
+    before it waits.  Used by deliver_many."""
+    def __init__(self,bytes_per_second,seconds=0.1,min_chunk=65536):
+        """!RateBudget constructor
+        @param bytes_per_second the rate, in bytes per second
+        @param seconds the time a copy may run ahead of the rate
+        @param min_chunk smallest piece, in bytes, so a low rate does
+          not mean tiny system calls"""
+        self.bytes_per_second=float(bytes_per_second)
+        self.max_chunk=max(int(min_chunk),int(self.bytes_per_second*seconds))
+        self._lock=threading.Lock()
+        self._next=time.time()
+    ##@var bytes_per_second
+    # The byte rate shared by all users of this RateBudget
+
+    ##@var max_chunk
+    # Largest number of bytes copied between two calls to take()
+
+    def chunk(self,count):
+        """!Returns count, or the largest piece to copy before calling
+        take() if it is smaller.
+        @param count the bytes a copy would do at once"""
+        return min(int(count),self.max_chunk)
+
+    def take(self,nbytes):
+        """!Accounts for nbytes copied, and waits until the copy is
+        back within the rate.
+        @param nbytes the number of bytes just copied"""
+        with self._lock:
+            now=time.time()
+            start=max(self._next,now)
+            self._next=start+nbytes/self.bytes_per_second
+        if start>now: time.sleep(start-now)
+
 def deliver_file(infile,outfile,keep=True,verify=False,blocksize=1048576,
                  tempprefix=None,permmask=os.umask(0o02),removefailed=True,
                  logger=None,preserve_perms=True,preserve_times=True,
                  preserve_group=None,copy_acl=None,moveok=True, 
-                 force=True, copier=None):
+                 force=True, copier=None, budget=None):
     """!This moves or copies the file "infile" to "outfile" in a unit
     operation; outfile will never be seen in an incomplete state.
 
@@ -353,9 +537,14 @@ def deliver_file(infile,outfile,keep=True,verify=False,blocksize=1048576,
     moveok=True, and the source and destination are on the same
     filesystem then the delivery is done with a simple move.
     Otherwise a copy is done to a temporary file on the same
-    filesystem as the target.  If verification is requested
-    (verify=True) then the temporary file is verified by filecmp.cmp,
-    before moving the temporary file to the final location.
+    filesystem as the target.  The copy is done by the kernel when
+    possible (see ZERO_COPY).  If verification is requested
+    (verify=True) then each piece the kernel copied is read back from
+    both files right away, from the page cache, and compared; a copy
+    through Python gets a CRC-32 of the data while it is copied, and
+    that of the temporary file is compared to it.  Either is done
+    before moving the temporary file to the final location.  With a
+    copier, the temporary file is verified by filecmp.cmp instead.
 
     When requested, and when possible, the permissions and ownership
     are preserved.  Both copy_acl and preserve_group have defaults set
@@ -401,7 +590,9 @@ def deliver_file(infile,outfile,keep=True,verify=False,blocksize=1048576,
            copier(infile,temp_file_name,temp_file_object)
       Where the temp_file_name is the name of the destination file and
       the temp_file_object is an object that can be used to write to 
-      the file.  The copier should NOT close the temp_file_object. """
+      the file.  The copier should NOT close the temp_file_object. 
+    @param budget Optional: a RateBudget to limit the copy rate.  Not
+      used by copiers."""
     if preserve_group is None:
         preserve_group = not produtil.cluster.group_quotas()
     if copy_acl is None:
@@ -508,9 +699,11 @@ def deliver_file(infile,outfile,keep=True,verify=False,blocksize=1048576,
         tempname=temp.name
         if logger is not None:
             logger.info('%s: copy to temporary %s'%(infile,tempname))
+        digest=None
         if copier is None:
             with open(infile,'rb') as indata:
-                shutil.copyfileobj(indata,temp,length=blocksize)
+                digest=_copy_data(indata,temp,blocksize,verify,budget,
+                                  logger,actual_outfile)
         else:
             copier(infile,tempname,temp)
         temp.close()
@@ -519,9 +712,14 @@ def deliver_file(infile,outfile,keep=True,verify=False,blocksize=1048576,
         if verify:
             if logger is not None:
                 logger.info('%s: verify copy %s'%(infile,tempname))
-            if not filecmp.cmp(infile,tempname):
-                raise VerificationFailed('filecmp.cmp returned False',
-                                         infile,actual_outfile,tempname)
+            if copier is not None:
+                if not filecmp.cmp(infile,tempname):
+                    raise VerificationFailed('filecmp.cmp returned False',
+                                             infile,actual_outfile,tempname)
+            elif digest is not None:
+                if _file_checksum(tempname,blocksize)!=digest:
+                    raise VerificationFailed('CRC-32 of copy differs',
+                                             infile,actual_outfile,tempname)
         if logger is not None:
             logger.info('%s: copy group ID and permissions to %s'
                         %(infile,tempname,))
@@ -558,6 +756,50 @@ def deliver_file(infile,outfile,keep=True,verify=False,blocksize=1048576,
         except EnvironmentError as e:
             pass
 
+def deliver_many(deliveries,threads=4,bytes_per_second=None,
+                 logger=None,**kwargs):
+    """!Delivers many files at once, in several threads, with
+    deliver_file.  The zero-copy system calls run without the Python
+    global interpreter lock, so the copies proceed in parallel.
+
+    All deliveries are attempted even if some fail.  If only one fails,
+    its exception is raised, otherwise FileOpErrors is raised.
+    @param deliveries an iterable of (infile,outfile) pairs
+    @param threads number of deliveries to run at once
+    @param bytes_per_second Optional: the total copy rate of all
+      threads, to keep from saturating a shared filesystem
+    @param logger a logging.Logger for messages
+    @param kwargs more keyword arguments for deliver_file
+    @returns the number of files delivered"""
+    deliveries=list(deliveries)
+    if bytes_per_second:
+        kwargs['budget']=RateBudget(bytes_per_second)
+    ex=list()
+    lock=threading.Lock()
+    def deliver(infile,outfile):
+        try:
+            deliver_file(infile,outfile,logger=logger,**kwargs)
+        except Exception as e:
+            with lock: ex.append( (infile,outfile,e) )
+    if logger is not None:
+        logger.info('Delivering %d files in %d threads...'
+                    %(len(deliveries),threads))
+    with produtil.workpool.WorkPool(max(1,min(threads,len(deliveries))),
+                                    logger=logger) as pool:
+        for (infile,outfile) in deliveries:
+            pool.add_work(deliver,[infile,outfile])
+        pool.barrier()
+    if len(ex)==1:
+        raise ex[0][2]
+    elif len(ex)>1:
+        msg='Multiple exceptions caught while delivering files in deliver_many.'
+        if logger is not None: logger.warning(msg)
+        raise FileOpErrors(msg,','.join(a for a,b,c in ex),
+                           [ (a,b,str(c)) for a,b,c in ex ] )
+    if logger is not None:
+        logger.info('Done delivering %d files.'%(len(deliveries),))
+    return len(deliveries)
+
 ########################################################################
 def find_exe(name,dirlist=None,raise_missing=True):
     """!Searches the $PATH or a specified iterable of directory names
@@ -1063,19 +1305,54 @@ class FileWaiter:
         """!Returns the number of files that were NOT found."""
         return len(self._fset)-len(self._found)
 
+    def ready_in(self,filename):
+        """!Returns the number of seconds until an existing file that
+        fails only the age requirements will meet them, or None if the
+        file does not exist.  Used to know when to check it again.
+        @param filename the path to the file"""
+        try:
+            s=os.stat(filename)
+        except EnvironmentError:
+            return None
+        now=time.time()
+        wait=0
+        # check_file compares whole seconds: int(now)-time>age
+        for (when,age) in ( (s.st_mtime,self.min_mtime_age),
+                            (s.st_atime,self.min_atime_age),
+                            (s.st_ctime,self.min_ctime_age) ):
+            if age is not None:
+                wait=max(wait,math.floor(when+age)+1-now)
+        return wait
+
     def checkfiles(self,maxwait=1800,sleeptime=20,logger=None,
                    log_each_file=True):
         """!Looks for the requested files.  Will loop, checking over
-        and over up to maxwait seconds, sleeping sleeptime seconds
-        between checks.
+        and over up to maxwait seconds.  Between checks, it waits for
+        the files to be written or renamed into place (see
+        produtil.filewatch), a file to become old enough, or sleeptime
+        seconds to pass, whichever comes first.  Where inotify does
+        not work, it polls instead, with sleeps that grow up to
+        sleeptime seconds.
         @param maxwait maximum seconds to wait
-        @param sleeptime sleep time in seconds between checks
+        @param sleeptime longest time in seconds between checks
         @param logger a logging.Logger for messages
         @param log_each_file log messages about each file checked"""
-        maxwait=int(maxwait)
-        start=int(time.time())
+        watcher=produtil.filewatch.watch_files(
+            self._flist,max_interval=sleeptime,logger=logger)
+        with watcher:
+            return self._checkfiles(watcher,maxwait,sleeptime,logger,
+                                    log_each_file)
+
+    def _checkfiles(self,watcher,maxwait,sleeptime,logger,log_each_file):
+        """!Implementation of checkfiles, with a
+        produtil.filewatch watcher to wait on."""
+        maxwait=float(maxwait)
+        start=time.time()
+        deadline=start+maxwait
         now=start
         first=True
+        changed=None
+        young=None
         if log_each_file:
             flogger=logger
         else:
@@ -1087,7 +1364,7 @@ class FileWaiter:
                 return True
 
             left=len(self._fset)-len(self._found)
-            now=int(time.time())
+            now=time.time()
             nfiles=len(self._fset)
             nfound=len(self._found)
             frac=float(nfound)/nfiles
@@ -1096,13 +1373,17 @@ class FileWaiter:
             if frac>=self.min_fraction-1e-5: 
                 logger.info('Have required fraction of files.')
                 return True
-            if now-start>=maxwait: 
+            if now>=deadline: 
                 logger.info('Waited too long.  Giving up.')
                 return False
             
             if not first:
-                sleepnow=max(0,min(sleeptime,start+maxwait-now-1))
+                sleepnow=max(0,min(sleeptime,deadline-now))
+                if young is not None:
+                    sleepnow=min(sleepnow,young+0.01)
                 if sleepnow<1e-3:
+                    # Out of time, even if a young file would be
+                    # ready soon: never spin on zero-length waits.
                     logger.info('Waited too long.  Giving up.')
                     return False
                 if logger is not None:
@@ -1112,21 +1393,35 @@ class FileWaiter:
                                   self.min_fraction*100.0,needfiles,
                                   's' if (needfiles>1) else ''))
                     logfun=logger.info if (sleepnow>=5) else logger.debug
-                    logfun('Sleeping %g seconds...'%(float(sleepnow),))
-                time.sleep(sleepnow)
+                    logfun('Waiting up to %g seconds for files (%s)...'
+                           %(float(sleepnow),watcher.backend))
+                changed=watcher.wait(sleepnow)
                 if logger is not None:
-                    logfun('Done sleeping.')
+                    logfun('Done waiting.')
 
+            # Recheck only the files that changed, unless the wait
+            # timed out or the watcher cannot tell (polling).
+            recheck_all=first or not changed or young is not None
             first=False
+            young=None
+            nfound=len(self._found)
 
             for filename in self._flist:
                 if filename in self._found: continue
+                abspath=os.path.abspath(filename)
+                if not recheck_all and abspath not in changed: continue
                 if self.check(filename,logger=flogger):
                     self._found.add(filename)
                     if flogger is not None:
                         flogger.info('%s: found this one (%d of %d found).'
                                     %(filename,len(self._found),
                                       len(self._fset)))
+                else:
+                    wait=self.ready_in(filename)
+                    if wait is not None and wait>0:
+                        young=wait if young is None else min(young,wait)
+            if len(self._found)>nfound:
+                watcher.poke()
                 
         return len(self._found)>=len(self._fset)
 
@@ -1155,3 +1450,55 @@ def wait_for_files(flist,logger=None,maxwait=1800,sleeptime=20,
     waiter=FileWaiter(flist,min_size,min_mtime_age,min_atime_age,
                       min_ctime_age,min_fraction)
     return waiter.checkfiles(maxwait,sleeptime,logger,log_each_file)
+
+########################################################################
+def benchmark(directory,sizes=(1,),logger=None):
+    """!Compares the old deliver_file copy (a Python read/write loop,
+    and filecmp for verification) to the zero-copy and
+    checksum-while-copying paths, on files of the given sizes in GB, in directory.  Note
+    that the source file is in the page cache after the first copy;
+    use files larger than memory to measure the disks.
+    @param directory a scratch directory, which needs room for two
+      files of the largest size
+    @param sizes file sizes in GB
+    @param logger a logging.Logger for messages"""
+    def old_copier(infile,tempname,temp):
+        with open(infile,'rb') as indata:
+            shutil.copyfileobj(indata,temp,length=1048576)
+    paths=( ('old copy',dict(copier=old_copier)),
+            ('zero-copy',dict()),
+            ('old copy+verify',dict(copier=old_copier,verify=True)),
+            ('zero-copy+verify',dict(verify=True)) )
+    src=os.path.join(directory,'deliver_benchmark.src')
+    dst=os.path.join(directory,'deliver_benchmark.dst')
+    block=os.urandom(1048576)
+    libc=ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6')
+    try:
+        for size in sizes:
+            with open(src,'wb') as f:
+                for i in range(int(size*1024)): f.write(block)
+            libc.sync()
+            nbytes=os.path.getsize(src)
+            for (name,kwargs) in paths:
+                start=time.time()
+                deliver_file(src,dst,logger=logger,**kwargs)
+                elapsed=time.time()-start
+                print('%5.1f GB %-16s %8.2f s %8.1f MB/s'%(
+                    nbytes/1073741824.0,name,elapsed,
+                    nbytes/1048576.0/max(elapsed,1e-6)))
+                remove_file(dst)
+                # write back the dirty pages before the next timing
+                libc.sync()
+    finally:
+        remove_file(src)
+        remove_file(dst)
+
+if __name__=='__main__':
+    import argparse
+    parser=argparse.ArgumentParser(
+        description='produtil.fileop.deliver_file benchmark')
+    parser.add_argument('directory',help='scratch directory')
+    parser.add_argument('sizes',nargs='*',type=float,default=[1],
+                        help='file sizes in GB (default: 1)')
+    args=parser.parse_args()
+    benchmark(args.directory,args.sizes)
@@ -0,0 +1,418 @@
+"""!Waits for files to appear or change, using Linux inotify when it
+works and polling when it does not.
+
+A watcher is given the paths of files that may not exist yet, and
+its wait() function returns as soon as one of them is written,
+renamed into place or created, instead of sleeping a fixed time.  It
+watches the parent directories (or their nearest existing ancestor)
+with inotify, through ctypes, so it needs no extra modules.  Inotify
+does not see writes made from other hosts on network and parallel
+filesystems (NFS, Lustre, GPFS...), so on those, or when inotify is
+missing, it polls instead, at an interval that starts short and grows
+while nothing changes.
+
+@code
+import produtil.filewatch
+with produtil.filewatch.watch_files(['/path/to/a','/path/to/b']) as w:
+    while not ready():
+        changed=w.wait(20)   # the set of paths that changed, or None
+@endcode
+
+Run this module to measure the delay between a file delivery and the
+return of wait(), with both backends:
+@code
+python -m produtil.filewatch [directory]
+@endcode"""
+
+import os, sys, time, errno, select, struct, ctypes, ctypes.util
+
+try:
+    basestring
+except NameError: # Python 3
+    basestring=str
+
+##@var __all__
+# Symbols exported by "from produtil.filewatch import *"
+__all__=['watch_files','InotifyWatcher','PollWatcher','inotify_works',
+         'NO_INOTIFY_FILESYSTEMS']
+
+##@var IN_MODIFY
+# inotify event: file was written
+IN_MODIFY=0x00000002
+
+##@var IN_ATTRIB
+# inotify event: metadata changed (i.e. touch)
+IN_ATTRIB=0x00000004
+
+##@var IN_CLOSE_WRITE
+# inotify event: a file opened for writing was closed
+IN_CLOSE_WRITE=0x00000008
+
+##@var IN_MOVED_TO
+# inotify event: a file was renamed into the directory
+IN_MOVED_TO=0x00000080
+
+##@var IN_CREATE
+# inotify event: a file or directory was created in the directory
+IN_CREATE=0x00000100
+
+##@var IN_DELETE_SELF
+# inotify event: the watched directory was deleted
+IN_DELETE_SELF=0x00000400
+
+##@var IN_MOVE_SELF
+# inotify event: the watched directory was moved
+IN_MOVE_SELF=0x00000800
+
+##@var IN_Q_OVERFLOW
+# inotify event: events were lost
+IN_Q_OVERFLOW=0x00004000
+
+##@var IN_IGNORED
+# inotify event: the watch was removed
+IN_IGNORED=0x00008000
+
+##@var IN_ISDIR
+# inotify event flag: the event is about a directory
+IN_ISDIR=0x40000000
+
+##@var IN_ONLYDIR
+# inotify_add_watch flag: only watch a directory
+IN_ONLYDIR=0x01000000
+
+##@var IN_NONBLOCK
+# inotify_init1 flag: non-blocking reads
+IN_NONBLOCK=os.O_NONBLOCK
+
+##@var IN_CLOEXEC
+# inotify_init1 flag: close on exec
+IN_CLOEXEC=0x80000
+
+##@var NO_INOTIFY_FILESYSTEMS
+# Filesystem types (as in /proc/mounts) on which inotify misses
+# changes made from other hosts, so watch_files polls instead.
+NO_INOTIFY_FILESYSTEMS=frozenset([
+        'nfs','nfs4','lustre','gpfs','cifs','smbfs','smb3','panfs',
+        'afs','fuse.sshfs','ceph','fuse.glusterfs','beegfs'])
+
+_EVENT=struct.Struct('iIII')
+_libc=None
+
+def _fsencode(path):
+    """!Returns path as the bytes ctypes passes to C."""
+    if isinstance(path,bytes): return path
+    return path.encode(sys.getfilesystemencoding() or 'utf-8',
+                       'surrogateescape')
+
+def _fsdecode(name):
+    """!Returns an inotify event name as a str path."""
+    if isinstance(name,str): return name
+    return name.decode(sys.getfilesystemencoding() or 'utf-8',
+                       'surrogateescape')
+
+def _inotify_libc():
+    """!Returns the C library, with the inotify functions declared,
+    or None if it has none."""
+    global _libc
+    if _libc is None:
+        try:
+            libc=ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                             use_errno=True)
+            libc.inotify_init1.argtypes=[ctypes.c_int]
+            libc.inotify_init1.restype=ctypes.c_int
+            libc.inotify_add_watch.argtypes=[ctypes.c_int,ctypes.c_char_p,
+                                             ctypes.c_uint32]
+            libc.inotify_add_watch.restype=ctypes.c_int
+            _libc=libc
+        except (OSError,AttributeError):
+            _libc=False
+    return _libc or None
+
+def _fstype(path):
+    """!Returns the type of the filesystem that contains path, from
+    /proc/mounts, or None if it is unknown."""
+    path=os.path.realpath(path)
+    best=None
+    try:
+        with open('/proc/mounts','rt') as f:
+            for line in f:
+                fields=line.split()
+                if len(fields)<3: continue
+                mount=fields[1].replace('\\040',' ')
+                if path==mount or path.startswith(mount.rstrip('/')+'/'):
+                    if best is None or len(mount)>len(best[0]):
+                        best=(mount,fields[2])
+    except EnvironmentError:
+        return None
+    return best[1] if best else None
+
+def _existing_dir(path):
+    """!Returns the directory of path, or its nearest ancestor that
+    exists."""
+    d=os.path.dirname(os.path.abspath(path))
+    while not os.path.isdir(d) and d!=os.path.dirname(d):
+        d=os.path.dirname(d)
+    return d
+
+def inotify_works(path):
+    """!Returns True if inotify can watch the directory of path: the C
+    library has inotify, and the filesystem is not one of
+    NO_INOTIFY_FILESYSTEMS.
+    @param path a file that may not exist yet"""
+    if _inotify_libc() is None: return False
+    return _fstype(_existing_dir(path)) not in NO_INOTIFY_FILESYSTEMS
+
+########################################################################
+
+class PollWatcher(object):
+    """!Polling backend of watch_files.  The wait() function sleeps
+    and returns None: "anything may have changed."  The sleep starts
+    at min_interval and grows by half each time up to max_interval,
+    and poke() brings it back to min_interval."""
+    def __init__(self,paths,min_interval=0.1,max_interval=20.0,
+                 logger=None):
+        """!PollWatcher constructor
+        @param paths the files to watch (not used)
+        @param min_interval first sleep time in seconds
+        @param max_interval longest sleep time in seconds
+        @param logger a logging.Logger for messages"""
+        self.min_interval=float(min_interval)
+        self.max_interval=max(float(max_interval),self.min_interval)
+        self._interval=self.min_interval
+        self._logger=logger
+    ##@var min_interval
+    # The first, and shortest, sleep time
+
+    ##@var max_interval
+    # The longest sleep time
+
+    backend='poll'
+    def add(self,paths):
+        """!Adds files to watch: nothing to do when polling.
+        @param paths a list of files"""
+    def poke(self):
+        """!Something was found: go back to short sleeps."""
+        self._interval=self.min_interval
+    def wait(self,timeout):
+        """!Sleeps the current interval, but no more than timeout
+        seconds, then grows the interval.
+        @param timeout maximum seconds to sleep
+        @returns None"""
+        sleepnow=max(0,min(self._interval,timeout))
+        if sleepnow>0: time.sleep(sleepnow)
+        self._interval=min(self.max_interval,self._interval*1.5)
+        return None
+    def close(self):
+        """!Does nothing: there is nothing to close."""
+    def __enter__(self):
+        """!Does nothing; returns self."""
+        return self
+    def __exit__(self,etype,evalue,traceback):
+        """!Calls close().
+        @param etype,evalue,traceback exception information"""
+        self.close()
+
+class InotifyWatcher(PollWatcher):
+    """!Inotify backend of watch_files.  Watches the directories of the
+    files, and wait() returns the set of files that were written,
+    moved into place, created or touched.  A directory that does not
+    exist yet is handled by watching its nearest existing ancestor,
+    and moving the watch down as directories are created."""
+    def __init__(self,paths,modify=False,logger=None):
+        """!InotifyWatcher constructor.  Raises EnvironmentError if
+        inotify is not available.
+        @param paths the files to watch
+        @param modify If True, also report every write (IN_MODIFY),
+          not just the close of the file.  That is for files that
+          stay open, like databases.
+        @param logger a logging.Logger for messages"""
+        super(InotifyWatcher,self).__init__(paths,logger=logger)
+        libc=_inotify_libc()
+        if libc is None:
+            raise EnvironmentError(errno.ENOSYS,'inotify is not available')
+        self._libc=libc
+        self._mask=IN_CLOSE_WRITE|IN_MOVED_TO|IN_CREATE|IN_ATTRIB| \
+            IN_DELETE_SELF|IN_MOVE_SELF|IN_ONLYDIR
+        if modify: self._mask|=IN_MODIFY
+        self._fd=libc.inotify_init1(IN_NONBLOCK|IN_CLOEXEC)
+        if self._fd<0:
+            e=ctypes.get_errno()
+            raise EnvironmentError(e,'inotify_init1: '+os.strerror(e))
+        self._paths=dict()   # directory => set of files in it to watch
+        self._wd=dict()      # watch descriptor => directory watched
+        self._dirwd=dict()   # directory watched => watch descriptor
+        try:
+            self.add(paths)
+        except:
+            self.close()
+            raise
+    backend='inotify'
+    def add(self,paths):
+        """!Adds files to watch.
+        @param paths a file or a list of files"""
+        if isinstance(paths,basestring): paths=[paths]
+        for path in paths:
+            path=os.path.abspath(path)
+            self._paths.setdefault(os.path.dirname(path),set()).add(path)
+        self._rewatch()
+    def _rewatch(self):
+        """!Watches the directory of each file, or its nearest existing
+        ancestor."""
+        for d in self._paths:
+            w=d if os.path.isdir(d) else _existing_dir(d+'/x')
+            if w in self._dirwd: continue
+            wd=self._libc.inotify_add_watch(self._fd,_fsencode(w),self._mask)
+            if wd<0:
+                e=ctypes.get_errno()
+                if e in (errno.ENOENT,errno.ENOTDIR):
+                    continue # deleted meanwhile; try again later
+                raise EnvironmentError(e,'%s: inotify_add_watch: %s'
+                                       %(w,os.strerror(e)))
+            self._wd[wd]=w
+            self._dirwd[w]=wd
+    def _read(self):
+        """!Reads the pending events.
+        @returns a tuple (changed,rewatch): the files that changed, and
+          True if the watched directories must be updated"""
+        changed=set()
+        rewatch=False
+        while True:
+            try:
+                buf=os.read(self._fd,65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN,errno.EINTR): break
+                raise
+            if not buf: break
+            i=0
+            while i+_EVENT.size<=len(buf):
+                (wd,mask,cookie,namelen)=_EVENT.unpack_from(buf,i)
+                name=_fsdecode(buf[i+_EVENT.size:i+_EVENT.size+namelen]
+                               .rstrip(b'\0'))
+                i+=_EVENT.size+namelen
+                if mask&IN_Q_OVERFLOW:
+                    # events were lost: report every file
+                    for files in self._paths.values(): changed|=files
+                    continue
+                d=self._wd.get(wd,None)
+                if d is None: continue
+                if mask&(IN_DELETE_SELF|IN_MOVE_SELF|IN_IGNORED):
+                    del self._wd[wd]
+                    self._dirwd.pop(d,None)
+                    rewatch=True
+                    continue
+                path=os.path.join(d,name)
+                if path in self._paths.get(d,()):
+                    changed.add(path)
+                if mask&IN_ISDIR:
+                    # may be a directory that was not there to watch
+                    rewatch=True
+        return (changed,rewatch)
+    def wait(self,timeout):
+        """!Waits until a file changes, or timeout seconds pass.
+        @param timeout maximum seconds to wait
+        @returns the set of files that changed, empty on timeout"""
+        end=time.time()+max(0,timeout)
+        while True:
+            try:
+                (r,w,x)=select.select([self._fd],[],[],
+                                      max(0,end-time.time()))
+            except select.error as e:
+                if e.args[0]!=errno.EINTR: raise
+                continue
+            if not r: return set()
+            (changed,rewatch)=self._read()
+            if rewatch:
+                self._rewatch()
+                # files may have been made in a directory before it was watched
+                for d,files in self._paths.items():
+                    if d in self._dirwd:
+                        changed|=set(f for f in files if os.path.exists(f))
+            if changed or time.time()>=end:
+                return changed
+    def close(self):
+        """!Stops watching: closes the inotify file descriptor."""
+        if self._fd>=0:
+            os.close(self._fd)
+            self._fd=-1
+    def __del__(self):
+        """!Calls close()."""
+        try:
+            self.close()
+        except Exception: pass
+
+def watch_files(paths,modify=False,max_interval=20.0,logger=None):
+    """!Returns an InotifyWatcher for the files if inotify works for
+    all of them, or a PollWatcher otherwise.  See the module
+    documentation.
+    @param paths the files to watch
+    @param modify If True, report every write, not just closes.
+    @param max_interval longest sleep time when polling
+    @param logger a logging.Logger for messages"""
+    if isinstance(paths,basestring): paths=[paths]
+    paths=list(paths)
+    if all(inotify_works(p) for p in paths):
+        try:
+            return InotifyWatcher(paths,modify=modify,logger=logger)
+        except EnvironmentError as e:
+            if logger is not None:
+                logger.info('Cannot use inotify, will poll instead: %s'
+                            %(str(e),))
+    return PollWatcher(paths,max_interval=max_interval,logger=logger)
+
+########################################################################
+
+def _latency(watcher,directory,count):
+    """!Writes files into directory one at a time, from a child
+    process, and returns the delays between the rename of each file
+    into place and the return of watcher.wait() in this process."""
+    delays=list()
+    for i in range(count):
+        path=os.path.join(directory,'file%03d'%i)
+        watcher.add(path)
+        pid=os.fork()
+        if pid==0:
+            time.sleep(0.2)
+            with open(path+'.part','wb') as f: f.write(b'x'*1024)
+            os.rename(path+'.part',path)
+            os._exit(0)
+        while not os.path.exists(path):
+            watcher.wait(30)
+        found=time.time()
+        os.waitpid(pid,0)
+        delays.append(found-os.stat(path).st_ctime)
+        watcher.poke()
+    return delays
+
+def benchmark(directory,count=10):
+    """!Measures the file arrival latency of both backends, after the
+    adaptive poll interval has grown to 2 seconds (about the sleep of
+    a job that waited a while).
+    @param directory a scratch directory
+    @param count number of files per backend
+    @returns a dict of the sorted delays of each backend that works
+      on directory"""
+    import tempfile, shutil
+    result=dict()
+    for backend in ('inotify','poll'):
+        d=tempfile.mkdtemp(prefix='filewatch.',dir=directory)
+        try:
+            if backend=='inotify':
+                if not inotify_works(d+'/x'):
+                    print('%-8s not available on %s'%(backend,directory))
+                    continue
+                watcher=InotifyWatcher([])
+            else:
+                watcher=PollWatcher([],max_interval=2.0)
+                watcher._interval=watcher.max_interval
+                watcher.poke=lambda: None
+            with watcher:
+                delays=sorted(_latency(watcher,d,count))
+            print('%-8s %d files: median %.4f s, max %.4f s'%(
+                backend,count,delays[len(delays)//2],delays[-1]))
+            result[backend]=delays
+        finally:
+            shutil.rmtree(d)
+    return result
+
+if __name__=='__main__':
+    benchmark(sys.argv[1] if len(sys.argv)>1 else '.')
@@ -0,0 +1,72 @@
+"""!Tests of produtil.filewatch: the delay between a file delivery
+and the return of wait() with both backends, and files in directories
+that do not exist yet when the watch starts.
+
+@code
+python -m pytest -s tests/test_filewatch.py
+python tests/test_filewatch.py
+@endcode"""
+
+import os, sys, time, shutil, tempfile, threading
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import produtil.filewatch
+
+##@var POLL_INTERVAL
+# Poll interval of the latency test: the benchmark lets it grow to
+# 2 seconds, so a file is seen within one interval of its delivery
+POLL_INTERVAL=2.0
+
+def _scratch():
+    """!A scratch directory on a filesystem inotify works on, if any."""
+    for d in (None,'/dev/shm'):
+        s=tempfile.mkdtemp(prefix='test_filewatch.',dir=d)
+        if produtil.filewatch.inotify_works(os.path.join(s,'x')):
+            return s
+        shutil.rmtree(s)
+    return tempfile.mkdtemp(prefix='test_filewatch.')
+
+def test_latency():
+    """!inotify sees a file as soon as it is renamed into place,
+    polling within one poll interval."""
+    d=_scratch()
+    try:
+        delays=produtil.filewatch.benchmark(d,count=3)
+    finally:
+        shutil.rmtree(d)
+    assert 'poll' in delays
+    assert delays['poll'][-1]<POLL_INTERVAL+0.5, delays['poll']
+    if 'inotify' in delays:
+        assert delays['inotify'][-1]<0.5, delays['inotify']
+        assert delays['inotify'][len(delays['inotify'])//2] < \
+            delays['poll'][len(delays['poll'])//2], delays
+
+def test_new_directory():
+    """!A file whose directory is made after the watch started: the
+    watch moves down from the nearest existing ancestor."""
+    d=_scratch()
+    try:
+        if not produtil.filewatch.inotify_works(os.path.join(d,'x')):
+            return
+        path=os.path.join(d,'sub','deeper','file')
+        def deliver():
+            time.sleep(0.2)
+            os.makedirs(os.path.dirname(path))
+            with open(path,'wb') as f: f.write(b'x')
+        with produtil.filewatch.watch_files([path]) as w:
+            assert w.backend=='inotify'
+            t=threading.Thread(target=deliver)
+            t.start()
+            changed=set()
+            end=time.time()+10
+            while path not in changed and time.time()<end:
+                changed|=w.wait(end-time.time())
+            t.join()
+        assert path in changed
+    finally:
+        shutil.rmtree(d)
+
+if __name__=='__main__':
+    test_latency()
+    test_new_directory()
+    print('OK')
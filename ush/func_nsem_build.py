@@ -11,12 +11,15 @@ Contacts    : Coastal Act Team
 
 
 # standard libs
-import os, sys, re
-import subprocess, shutil
+import os, re, sys, time, signal
+import subprocess, shutil, shlex, threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from pathlib import Path
 
 # local libs
 import nsem_utils as nus
+import nsem_nemsconfig as nnc
+import nsem_buildcache as nbc
 import func_nsem_workflow as fnw
 
 
@@ -315,32 +318,15 @@ runSeq::
         print("\nReading NEMS config file %s" %nems_cf)
 
         try:
-          with open(nems_cf,'r') as fptr:
-            cnt = 0; sentinel = '::'
-            # saves the line # of the "::" in file nems.configure
-            indx = []
-            lines = fptr.readlines()
-            for line in lines:
-              cnt += 1
-              if line.startswith(sentinel):
-                indx.append(cnt)
-
-            # cut each section of the file based on indx
-            earth_list = []; model_list = []; seq_list = []
-
-            earth_list = lines[:indx[0]]
-            model_list = lines[indx[0]:indx[len(indx)-2]]
-            seq_list = lines[indx[len(indx)-2]:]
-
-            # persists newely writen config files into __dic__ 
-            self.process_earth_section(earth_list)
-            self.process_model_section(model_list)
-            self.process_runseq_section(seq_list)
-
-        except Exception as e:
+            # parsed once per file modification, see nsem_nemsconfig.py
+            cfg = nnc.read(nems_cf)
+        except (OSError, nnc.NEMSConfigError) as e:
             print(nus.colory("red", "{}\n".format(str(e))))
             sys.exit(-1)
 
+        # persists newely read config into __dic__ 
+        self.process_config(cfg)
+
 
 
     def get_num_tasks(self):
@@ -369,138 +355,34 @@ runSeq::
 
 
 
-    def process_earth_section(self, earth_lines):
+    def process_config(self, cfg):
+        """ keeps the parsed nems.configure (a nsem_nemsconfig.NEMSConfigure) and
+            the per model values in __dict__, as NEMSModel objects """
 
-        sentinel = '::'; i=0
-
-        # lines are not cleaned yet
-        lines = [line.strip() for line in earth_lines if len(line) > 1]
-        line = lines[i]
-
-        while line:
-          #print("Line {}: {}".format(i, line.strip()))
-
-          if re.search('EARTH_component_list', line, re.IGNORECASE) :
-            k,v = line.split(":")     # Use v if decided to persists earth models as string instead of list
-
-            models = list(v.split(" "))
-            self.__dict__['EARTH_component_list'] = [model.strip() for model in models if len(model) > 1]
-            i += 1
-            line = lines[i]
-
-          elif re.search('EARTH_attributes', line, re.IGNORECASE) :    # do not use :: becasue it might have space between!
-            self.__dict__['EARTH_attributes'] = {}
-            i += 1
-            line = lines[i]
-
-            while line.find(sentinel) == -1:
-              dic = self.__dict__['EARTH_attributes']
-              k,v = line.split("=")
-              dic[k.strip()] = v.strip()
-              self.__dict__['EARTH_attributes'] = dic
-              i += 1
-              line = lines[i]
-            break
-
-          else:
-            i += 1
-            line = lines[i]
+        self.nems_configure = cfg
 
+        self.__dict__['EARTH_component_list'] = list(cfg.earth)
+        self.__dict__['EARTH_attributes'] = dict(cfg.earth_attributes)
         print("Pocessed EARTH_component_list")
         print(self.__dict__['EARTH_component_list'], "\n")
 
+        tmp = []       # array for holding many NEMSModel objects
+        for comp in cfg.components:
+            model = comp.name
+            petlist = list(comp.petlist) if isinstance(comp.petlist, tuple) else comp.petlist
+            kwargs = { model+"_petlist_bounds": petlist,
+                       model+"_attributes": dict(comp.attributes),
+                       model+"_model": comp.model}
+            self.__dict__.update(kwargs)
+            tmp.append(NEMSModel(model,**kwargs))
+        self.__dict__['NEMS_component_list'] = tmp
 
-    def process_model_section(self, model_lines):
-
-      sentinel = '::'; cnt = 0
-      lines = [line.strip() for line in model_lines if len(line) > 2]
-      line = lines[cnt]
+        print("Processed models_component_list")
+        self.print_model()
 
-
-      self.__dict__['NEMS_component_list'] = []
-      tmp = []       # array for holding many NEMSModel objects
-      i = 0          # counter of number of models in EARTH_component_list
-
-      while( i < len(self.__dict__['EARTH_component_list']) ):
-          model = self.__dict__['EARTH_component_list'][i]
-          #print("Processing line %d, %s-%s, %d\n" %(cnt, line, model, i))
-
-          if re.search(model+"_model", line, re.IGNORECASE) :   # do not use : becasue it might have space between!
-              k,v = line.split(":")
-              self.__dict__[model+"_model"] = v.strip()
-              # print("1 - ", k, v.strip())
-              cnt += 1
-              line = lines[cnt]
-
-          elif re.search(model+"_petlist_bounds", line, re.IGNORECASE) :
-              k,v = line.split(":")
-              v_int = [int(i) for i in list(v.strip().split(" "))]
-              self.__dict__[model+"_petlist_bounds"] = v_int
-              # print("2 - ", k, v_int)
-              cnt += 1
-              line = lines[cnt]
-
-          elif re.search(model+"_attributes", line, re.IGNORECASE):
-              self.__dict__[model+"_attributes"] = {}
-              cnt += 1
-              line = lines[cnt]
-              while line.find(sentinel) == -1:
-                  dic = self.__dict__[model+"_attributes"]
-                  k,v = line.split("=")
-                  dic[k.strip()] = v.strip()
-                  self.__dict__[model+"_attributes"] = dic
-                  cnt += 1
-                  line = lines[cnt]
-              # print("3 - ", k, dic)
-
-              # update before breaking
-              kwargs = { model+"_petlist_bounds":self.__dict__[model+"_petlist_bounds"],
-                         model+"_attributes":self.__dict__[model+"_attributes"],
-                         model+"_model":self.__dict__[model+"_model"]}
-              tmp.append(NEMSModel(model,**kwargs))
-              i += 1     # go to the next model in the list
-
-          else:
-              cnt += 1   # lines with comment or extera
-              line = lines[cnt]
-
-
-
-      # update before breaking
-      self.__dict__['NEMS_component_list'] = tmp
-
-      print("Processed models_component_list")
-      self.print_model()
-
-
-
-    def process_runseq_section(self, runseq_lines):
-
-      sentinel = '::'; i = 0
-      lines = [line.strip() for line in runseq_lines]
-      line = lines[i]
-
-      while True :
-        # for now put this as common property -TODO
-        if re.search('runSeq', line, re.IGNORECASE) :
-          self.__dict__["runSeq"] = []
-          vals = self.__dict__['runSeq']
-          i += 1
-          line = lines[i]
-
-          while line.find(sentinel) == -1:
-            vals.append(line.strip())
-            i += 1
-            line = lines[i]
-
-          self.__dict__["runSeq"] = vals
-          break
-        else:
-          i += 1
-          line = lines[i]
-
-      print("Processed runSeq")
-      print(nus.colory("green", ",    \n".join(self.__dict__['runSeq'])))
+        self.__dict__["runSeq"] = nnc.run_seq_lines(cfg.run_seq)
+        print("Processed runSeq")
+        print(nus.colory("green", ",    \n".join(self.__dict__['runSeq'])))
 
 
 
@@ -528,23 +410,40 @@ class NEMSBuild():
     """
 
 
-    def __init__(self, nems_cfg):
+    def __init__(self, nems_cfg, cache_dir=None, jobs=0):
 
         self.nems_cfg = nems_cfg
         self.source_dir = self.nems_cfg.source_dir
 
+        # NEMS.x and component installs by content hash, see nsem_buildcache.py
+        self.cache = nbc.BuildCache(cache_dir) if cache_dir else None
+
+        # make job tokens shared by components compiled side by side, 0 runs build.sh
+        self.jobs = jobs
+
         # we need the build.sh script to be available
         self.write_build()
 
 
-    def write_build(self):
+    def components(self):
+        """ NEMS COMPONENTS names (i.e. ADCIRC, NWM) """
+        return [model.get_alias().upper() for model in self.nems_cfg.nems_models()]
+
+
+    def modulefile(self):
+        """ user modulefile relative to the source directory """
+        junk, modulefile = self.nems_cfg.user_module.split(self.source_dir)
+        return modulefile[1:]    # remove the '/' from string
+
+
+    def write_build(self, distclean=None):
+        """ distclean: components to clean before the build, all if None """
 
-        user_module = self.nems_cfg.user_module
         nems_models = self.nems_cfg.nems_models
 
         p = os.path.join(self.source_dir,'build.sh')
 
-        junk, modulefile = user_module.split(self.source_dir)
+        modulefile = self.modulefile()
 
         lines = """#!/bin/bash\n
 # Description : Script to compile NSEModel NEMS application 
@@ -558,7 +457,7 @@ class NEMSBuild():
 # load modules
 source {}
 
-cd NEMS\n""".format(nus.now(2), modulefile[1:])    # remove the '/' from string
+cd NEMS\n""".format(nus.now(2), modulefile)
 
         lines += '\n#clean up\n'
 
@@ -566,6 +465,8 @@ cd NEMS\n""".format(nus.now(2), modulefile[1:])    # remove the '/' from string
             alias = model.get_alias().upper()
             if not nus.exist(os.path.join(self.source_dir, alias)):
                 sys.exit(0)
+            if distclean is not None and alias not in distclean:
+                continue
 
             lines += 'make -f GNUmakefile distclean_' + \
                       alias + ' COMPONENTS=' + \
@@ -667,13 +568,273 @@ export WRF_HYDRO_NUDGING={}
 
     def build_nems_app(self):
 
+        if self.cache:
+            return self.build_cached()
+        return self.run_build()
+
+
+    def build_cached(self):
+        """ restores what the cache holds for the current sources, modulefile and compilers,
+            then cleans and compiles only the components it does not hold """
+
+        comps = self.components()
+        keys = self.cache.keys(self.source_dir, comps, self.nems_cfg.user_module)
+        state = nbc.read_state(self.source_dir)
+        exe = os.path.join(self.source_dir, nbc.NEMS_EXE)
+
+        def in_place(c):
+            path = exe if c == nbc.NEMS else nbc.install_dir(self.source_dir, c)
+            return state.get(c) == keys[c] and os.path.exists(path)
+
+        if in_place(nbc.NEMS) and all(in_place(c) for c in comps):
+            print(nus.colory("green", "NEMS.x is up to date with the sources, nothing to compile"))
+            return True
+
+        todo = []
+        for c in comps:
+            if in_place(c):
+                continue
+            if self.cache.has(keys[c]):
+                self.cache.restore(keys[c], {c: nbc.install_dir(self.source_dir, c)})
+                state[c] = keys[c]
+            else:
+                todo.append(c)
+
+        if not todo and self.cache.has(keys[nbc.NEMS]):
+            self.cache.restore(keys[nbc.NEMS], {'NEMS.x': exe})
+            nbc.write_state(self.source_dir, keys)
+            return True
+
+        print("Components to compile: %s" %(", ".join(todo) or "none, NEMS only"))
+        self.write_build(distclean=todo)
+        if not self.run_build(todo):
+            nbc.write_state(self.source_dir, dict((c, k) for c, k in state.items() if c not in todo and c != nbc.NEMS))
+            return False
+
+        for c in todo:
+            path = nbc.install_dir(self.source_dir, c)
+            if os.path.isdir(path):
+                self.cache.store(keys[c], {c: path})
+            else:
+                print(nus.colory("red", "No install directory %s, %s is not cached" %(path, c)))
+                keys.pop(c)
+        self.cache.store(keys[nbc.NEMS], {'NEMS.x': exe})
+        nbc.write_state(self.source_dir, keys)
+        return True
+
+
+    def run_build(self, todo=None):
+        """ compiles todo components (all if None) and links NEMS.x - concurrently
+            when jobs is set, otherwise with the serial build.sh """
+
+        if self.jobs:
+            comps = self.components()
+            driver = ParallelBuild(self.source_dir, self.modulefile(), comps,
+                                   comps if todo is None else todo, self.jobs)
+            return driver.run()
+
         try:
             print("\nStart compiling ............\n")
             subprocess.check_call(['./build.sh'], cwd=self.source_dir, stderr=subprocess.STDOUT)
         except subprocess.CalledProcessError as err:
-            print(nus.colory("red", 'Error in executing build.sh:\n'.format(err)))
+            print(nus.colory("red", 'Error in executing build.sh: {}\n'.format(err)))
+            return False
+        return True
+
+
+
+
+class JobServer():
+
+    """ GNU make job server shared by makes running side by side: a pipe holding the job tokens.
+        Every make gets one implicit job, the pipe holds the rest of the budget, so a component
+        that runs out of work leaves its tokens to the others """
+
+    def __init__(self, jobs, makes):
+
+        self.fds = os.pipe()
+        os.write(self.fds[1], b'+' * max(0, jobs - makes))
+
+
+    def makeflags(self, version):
+        r, w = self.fds
+        if version >= (4, 2):
+            return " -j --jobserver-auth=%d,%d" %(r, w)
+        return " -j --jobserver-fds=%d,%d" %(r, w)
+
+
+    def close(self):
+        for fd in self.fds:
+            os.close(fd)
+
 
 
+def make_version(make='make'):
+    """ (major, minor) of GNU make, None if make is not GNU make """
+    try:
+        out = subprocess.run([make, '--version'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.decode()
+    except OSError:
+        return None
+    words = out.split()
+    if len(words) < 3 or words[:2] != ['GNU', 'Make']:
+        return None
+    return tuple(int(v) for v in words[2].split('.')[:2])
+
+
+
+class ParallelBuild():
+
+    """
+    compiles the component libraries concurrently, then links NEMS:
+    "make configure" runs once first, then each component runs "make distclean_<C> build_<C>"
+    of the NEMS GNUmakefile in its own process and log (<source_dir>/build_logs/<C>.log).
+    every make relists its components through a scratch file (new_components_file of
+    NEMS/src/incmake/globals.mk), each component make is given its own so they do not
+    read or delete each other's. The job budget is shared through a
+    GNU make job server, or split evenly when make can not share it. The first failure stops
+    the other builds and shows the tail of its log. A timeline of the builds is printed at the end.
+    """
+
+    TAIL = 40          # lines of a failed log to show
+
+    def __init__(self, source_dir, modulefile, components, todo, jobs):
+
+        self.source_dir = source_dir
+        self.modulefile = modulefile          # relative to source_dir, sourced before make
+        self.components = components          # COMPONENTS of the NEMS link
+        self.todo = todo                      # components to clean and compile
+        self.jobs = max(1, jobs)
+        self.log_dir = os.path.join(source_dir, "build_logs")
+        self.timeline = []                    # (name, start, end, status)
+        self.procs = {}
+        self.lock = threading.Lock()
+        self.failed = threading.Event()
+
+
+    def log(self, name):
+        return os.path.join(self.log_dir, name + ".log")
+
+
+    def components_file(self, name):
+        return os.path.join(self.log_dir, "components.%s.mk" %name)
+
+
+    def command(self, targets, components, jobs=None, components_file=None):
+        """ one make per target, in order - a parallel make must not clean while it builds.
+            components_file: the make's own relist scratch file, instead of the shared NEMS/src/conf/components.mk """
+
+        makes = []
+        for target in targets:
+            make = "make -f GNUmakefile %s COMPONENTS=\"%s\"" %(target, " ".join(components))
+            if components_file:
+                make += " new_components_file=%s" %components_file
+            makes.append(make + " -j%d" %jobs if jobs else make)
+        return "source %s && cd NEMS && %s" %(self.modulefile, " && ".join(makes))
+
+
+    def step(self, name, cmd, env, pass_fds=()):
+        """ runs one make in its own session, returns True on success """
+
+        start = time.time()
+        with open(self.log(name), 'w') as fptr:
+            fptr.write("# %s\n" %cmd); fptr.flush()
+            proc = subprocess.Popen(['bash', '-c', cmd], cwd=self.source_dir, env=env, stdout=fptr,
+                                    stderr=subprocess.STDOUT, pass_fds=pass_fds, start_new_session=True)
+            with self.lock:
+                self.procs[name] = proc
+            rc = proc.wait()
+        # a build ending after another one failed was stopped by us
+        status = 'ok' if rc == 0 else ('stopped' if self.failed.is_set() else 'FAILED')
+        self.timeline.append((name, start, time.time(), status))
+        return rc == 0
+
+
+    def stop(self):
+        """ stops every make still running, with its children """
+        self.failed.set()
+        with self.lock:
+            for proc in self.procs.values():
+                if proc.poll() is None:
+                    try:
+                        os.killpg(proc.pid, signal.SIGTERM)
+                    except OSError:
+                        pass
+
+
+    def tail(self, name):
+        with open(self.log(name), 'r', errors='replace') as fptr:
+            return "".join(fptr.readlines()[-self.TAIL:])
+
+
+    def run(self):
+
+        os.makedirs(self.log_dir, exist_ok=True)
+        self.t0 = time.time()
+        env = dict(os.environ)
+
+        # the configuration files of NEMS/src/conf are shared, written once before the builds
+        if self.todo and not self.step('configure', self.command(['configure'], self.components), env):
+            print(nus.colory("red", "Error configuring NEMS, last lines of %s:\n%s"
+                             %(self.log('configure'), self.tail('configure'))))
+            self.failed.set()
+            self.print_timeline()
+            return False
+
+        version = make_version()
+        server = None
+        if self.todo and version:
+            server = JobServer(self.jobs, len(self.todo))
+            env['MAKEFLAGS'] = server.makeflags(version)
+            share, fds = None, server.fds
+        else:
+            share, fds = max(1, self.jobs // max(1, len(self.todo))), ()
+
+        print("\nCompiling %s with %d job(s) %s, logs in %s"
+              %(", ".join(self.todo) or "no components", self.jobs,
+                "shared through a make job server" if server else "split evenly", self.log_dir))
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, len(self.todo))) as pool:
+                futures = dict((pool.submit(self.step, c, self.command(['distclean_' + c, 'build_' + c], [c], share,
+                                                                       self.components_file(c)), env, fds), c)
+                               for c in self.todo)
+                pending = set(futures)
+                while pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        c = futures[future]
+                        if not future.result() and not self.failed.is_set():
+                            self.stop()
+                            print(nus.colory("red", "Error compiling %s, last lines of %s:\n%s"
+                                             %(c, self.log(c), self.tail(c))))
+        finally:
+            if server:
+                server.close()
+
+        if not self.failed.is_set():
+            # components are up to date, build only links NEMS.x now
+            cmd = self.command(['distclean_NEMS', 'build'], self.components, self.jobs)
+            env.pop('MAKEFLAGS', None)
+            if not self.step('NEMS', cmd, env):
+                print(nus.colory("red", "Error linking NEMS, last lines of %s:\n%s" %(self.log('NEMS'), self.tail('NEMS'))))
+                self.failed.set()
+
+        self.print_timeline()
+        return not self.failed.is_set()
+
+
+    def print_timeline(self, width=50):
+
+        if not self.timeline:
+            return
+        total = max(end for name, start, end, status in self.timeline) - self.t0
+        scale = width / total if total > 0 else 0.0
+        print("\nBuild timeline, %.1f seconds" %total)
+        for name, start, end, status in sorted(self.timeline, key=lambda t: t[1]):
+            a = min(width - 1, int((start - self.t0) * scale)); b = max(a + 1, int((end - self.t0) * scale))
+            bar = " " * a + "#" * (b - a) + " " * (width - b)
+            line = "  %-8s |%s| %8.1f s  %s" %(name, bar, end - start, status)
+            print(nus.colory("green" if status == 'ok' else "red", line))
+
 
 
 class SlurmJob():
@@ -700,27 +861,31 @@ class SlurmJob():
         print(self.__dict__)
 
 
-    def write_sbatch(self):
-
-        slurm_file = os.path.join(self.__dict__['slurm_dir'], self.jobname[1:])   # no j in this name, using this in standalone runs not in WCOSS
-        self.slurm_job_file = slurm_file
-
-        sbatch_part = """#!/bin/sh -l\n
-#SBATCH -A {}
-#SBATCH -q {}
-#SBATCH -e {}
-#SBATCH --output={}
-#SBATCH --ignore-pbs
-#SBATCH -J {}
-#SBATCH --mail-user={}
-#SBATCH --ntasks-per-node={}
-#SBATCH -N {}
-#SBATCH --parsable
-#SBATCH -t {}""".format(self.__dict__['account'], self.__dict__['queue'], self.error, self.output,self.jobname,
-                        self.__dict__['mailuser'], self.__dict__['ntasks'], self.__dict__['nnodes'], self.__dict__['time'])
-
-        # for use by other classes
-        self.sbatch_part = sbatch_part
+    def sbatch_lines(self, extra=None, nodes=None, tasks=None, name=None, error=None, output=None):
+        """ the #SBATCH lines of the job, extra lines after them. nodes, tasks (per node), name and log
+            files default to the job's own, with the total task count if the job has one (npets, see
+            nsem_petlayout.slurm_resources) """
+
+        lines = ["#SBATCH -A {}".format(self.__dict__['account']),
+                 "#SBATCH -q {}".format(self.__dict__['queue']),
+                 "#SBATCH -e {}".format(error or self.error),
+                 "#SBATCH --output={}".format(output or self.output),
+                 "#SBATCH --ignore-pbs",
+                 "#SBATCH -J {}".format(name or self.jobname),
+                 "#SBATCH --mail-user={}".format(self.__dict__['mailuser']),
+                 "#SBATCH --ntasks-per-node={}".format(tasks or self.__dict__['ntasks']),
+                 "#SBATCH -N {}".format(nodes or self.__dict__['nnodes']),
+                 "#SBATCH --parsable",
+                 "#SBATCH -t {}".format(self.__dict__['time'])]
+        if nodes is None and getattr(self, 'npets', None):
+            lines.append("#SBATCH -n {}".format(self.npets))
+        if getattr(self, 'dependency', None):
+            lines.append("#SBATCH --dependency={}".format(self.dependency))
+        return lines + list(extra or [])
+
+
+    def main_lines(self, job_file, run=None, srun="srun ./NEMS.x"):
+        """ the commands of the job, run: commands before NEMS.x starts (i.e. cd to the run directory) """
 
         lines = """\n\n############################### main - to run: $sbatch {} ##########################
 set -x
@@ -730,20 +895,165 @@ echo $SLURM_JOB_NAME
 echo $SLURM_NNODES
 echo $SLURM_TASKS_PER_NODE\n
 echo $SLURM_NODELIST		# give you the list of assigned nodes.\n
-echo 'STARTING THE JOB AT'
+{}echo 'STARTING THE JOB AT'
 date\n
 # change to absolute path of where you pulled the
 # NEMS and NEMS Applications. use modules.nems becasue user's
 # modulefiles are copied into this with constant name.
 cp -fv {}/NEMS/exe/NEMS.x NEMS.x
 source {}/NEMS/src/conf/modules.nems
-srun ./NEMS.x
+{}
 date
-""".format(self.jobname, self.prj_dir, self.prj_dir )
+""".format(job_file, "".join(line + "\n" for line in run or []), self.prj_dir, self.prj_dir, srun)
+        return lines
+
 
+    def _write(self, slurm_file, header, job=None):
         with open(slurm_file, 'w') as f:
-            f.write(sbatch_part+lines)
+            f.write(header + self.main_lines(job or self.jobname, self._run, self._srun))
         print("\nProcessed slurm job file %s" %slurm_file)
+        return slurm_file
+
+
+    def write_sbatch(self):
+
+        slurm_file = os.path.join(self.__dict__['slurm_dir'], self.jobname[1:])   # no j in this name, using this in standalone runs not in WCOSS
+        self.slurm_job_file = slurm_file
+
+        sbatch_part = "#!/bin/sh -l\n\n" + "\n".join(self.sbatch_lines())
+
+        # for use by other classes
+        self.sbatch_part = sbatch_part
+
+        self._run, self._srun = None, "srun ./NEMS.x"
+        return self._write(slurm_file, sbatch_part)
+
+
+    # ---------------------------------------------------------- many runs in one submission
+
+    def write_array(self, run_dirs, max_running=None, name=None):
+        """
+        one array job for many runs of the same resources (i.e. ensemble members), task i runs NEMS.x in
+        run_dirs[i], listed in <job>.dirs next to the job file. max_running limits the tasks running at once.
+        returns the job file name
+        """
+
+        job = name or self.jobname[1:].replace(".job", ".array.job")
+        slurm_file = os.path.join(self.__dict__['slurm_dir'], job)
+        dirs_file = slurm_file.replace(".job", "") + ".dirs"
+        nus.write_atomic(dirs_file, "".join(os.path.abspath(d) + "\n" for d in run_dirs))
+
+        array = "0-%d" %(len(run_dirs) - 1) + ("%%%d" %max_running if max_running else "")
+        # %A array job id, %a task index - one log per task
+        header = "#!/bin/sh -l\n\n" + "\n".join(self.sbatch_lines(
+                 ["#SBATCH --array={}".format(array)], name=job,
+                 error=self.error.replace(".err.log", ".%A_%a.err.log"),
+                 output=self.output.replace(".out.log", ".%A_%a.out.log")))
+
+        self._run = ['RUNDIR=$(sed -n "$((SLURM_ARRAY_TASK_ID + 1))p" {})'.format(dirs_file),
+                     'cd $RUNDIR || exit 1']
+        self._srun = "srun ./NEMS.x"
+        return self._write(slurm_file, header, job)
+
+
+    def write_hetjob(self, petlists, cores_per_node, name=None):
+        """
+        heterogeneous job of one component per group of NEMS PETs (see het_groups), each sized by its
+        own PET count so no node is held for a component that does not use it. one srun spans all the
+        components, MPI ranks follow the components in order, as in the petlist bounds.
+        petlists:       {component: (lo, hi)}, i.e. nsem_petlayout.current_layout(nems configure)
+        cores_per_node: number, or {component: number} for components on other node types
+        returns the job file name
+        """
+
+        groups = het_groups(petlists)
+        job = name or self.jobname[1:].replace(".job", ".het.job")
+        slurm_file = os.path.join(self.__dict__['slurm_dir'], job)
+
+        header = ["#!/bin/sh -l\n"]
+        for i, (names, lo, hi) in enumerate(groups):
+            cores = cores_per_node.get(names[0]) if isinstance(cores_per_node, dict) else cores_per_node
+            npets = hi - lo + 1
+            nodes = (npets + cores - 1) // cores
+            header.append("# %s: PETs %d-%d" %(" ".join(names), lo, hi))
+            if not i:
+                # the exact task count keeps the MPI ranks of the next components on their petlist bounds
+                header += self.sbatch_lines(["#SBATCH -n {}".format(npets)], name=job, nodes=nodes, tasks=min(cores, npets))
+                continue
+            # job wide options come from the first component, the resources are per component
+            header += ["#SBATCH hetjob",
+                       "#SBATCH -A {}".format(self.__dict__['account']),
+                       "#SBATCH -q {}".format(self.__dict__['queue']),
+                       "#SBATCH --ntasks-per-node={}".format(min(cores, npets)),
+                       "#SBATCH -N {}".format(nodes),
+                       "#SBATCH -n {}".format(npets),
+                       "#SBATCH -t {}".format(self.__dict__['time'])]
+        self._run = None
+        self._srun = "srun --het-group=0-%d ./NEMS.x" %(len(groups) - 1)
+        return self._write(slurm_file, "\n".join(header), job)
+
+
+
+def het_groups(petlists):
+    """
+    components of the petlists grouped into heterogeneous job components: overlapping petlists share
+    PETs and so a group, unused PETs go to the group before them (MPI ranks stay the petlist bounds).
+    returns [(component names, lo, hi)] in rank order, starting at 0
+    """
+
+    groups = []
+    for name, (lo, hi) in sorted(petlists.items(), key=lambda kv: (kv[1][0], kv[1][1])):
+        if groups and lo <= groups[-1][2]:
+            groups[-1] = (groups[-1][0] + [name], groups[-1][1], max(hi, groups[-1][2]))
+        else:
+            if groups:
+                groups[-1] = (groups[-1][0], groups[-1][1], lo - 1)     # a gap joins the group before
+            groups.append(([name], lo if groups else 0, hi))
+    return [(tuple(names), lo, hi) for names, lo, hi in groups]
+
+
+
+def shell_name(name):
+    """ a shell variable name for a job name: characters other than ascii letters, digits
+        and _ become _, a leading digit gets a job_ prefix """
+
+    var = re.sub(r'[^A-Za-z0-9_]', '_', name)
+    if not var or var[0].isdigit():
+        var = "job_" + var
+    return var
+
+
+
+def write_chain(filename, jobs):
+    """
+    a submission script for a campaign of jobs depending on each other, i.e. spin-up -> forecast.
+    jobs: [(name, job file, [(dependency type, name of an earlier job)])], the types are Slurm's:
+          afterok, afterany, afternotok and aftercorr (array task i after task i of an array job)
+    every job is submitted at once, Slurm holds each until its dependencies are met. job ids are kept in
+    shell variables named after the jobs (see shell_name). returns filename
+    """
+
+    lines = ["#!/bin/sh -l", "# submits %d job(s), each held by Slurm until the jobs it depends on end" %len(jobs), "set -e"]
+    known = {}                  # job name: shell variable
+    for name, job_file, after in jobs:
+        var = shell_name(name)
+        if var in known.values():
+            raise ValueError("jobs %s and %s both need the shell variable %s"
+                             %([n for n, v in known.items() if v == var][0], name, var))
+        deps = []
+        for kind, other in after or []:
+            if other not in known:
+                raise ValueError("job %s depends on %s, which is not submitted before it" %(name, other))
+            deps.append("%s:$%s" %(kind, known[other]))
+        dep = " --dependency=%s" %",".join(deps) if deps else ""
+        lines.append("%s=$(sbatch --parsable%s %s)" %(var, dep, shlex.quote(job_file)))
+        lines.append('echo %s"$%s"' %(shlex.quote(name + ": "), var))
+        known[name] = var
+
+    nus.write_atomic(filename, "\n".join(lines) + "\n")
+    os.chmod(filename, 0o755)
+    print("\nProcessed campaign submission script %s" %filename)
+    return filename
 
 
 
@@ -771,7 +1081,7 @@ def git_nsem(repo, nco_sorc_dir):
     
 
 
-def nsem_build(args=None):
+def nsem_build(args=None, ini=None):
     """ clones the nsem models from repository into nco sorc directory,
         set up environment and libraries required for build process
         including esmf-impi-env.sh for all models, setEnvar.sh for nwm,
@@ -779,7 +1089,7 @@ def nsem_build(args=None):
         build the model in place 
         install the build into com directory
     """
-    nco, ini = fnw.nsem_workflow(args)
+    nco, ini = fnw.nsem_workflow(args, ini)
     sorc_dir = nco.source_dir()           
     parm_dir = nco.parm_dir()
 
@@ -810,7 +1120,7 @@ def nsem_build(args=None):
 
 
     # create the build file 
-    nems_build = NEMSBuild(nems_cf)                # TODO pickle
+    nems_build = NEMSBuild(nems_cf, getattr(ini, 'build_cache', None), getattr(ini, 'build_jobs', 0))   # TODO pickle
     # compile the codes 
     if ini.compile_flag:
         # set libraries before compiling - also make sure any changes to be applied with the flag
@@ -828,7 +1138,7 @@ def nsem_build(args=None):
     # print("\n",ntasks, walltime, start_date, start_date_str, local_repo,"\n")
     # note: slurm_source_dir = dest_repo = nems_cf.source_dir, nems_build.source_dir 
 
-    slurm_args = ini.slurm_args
+    slurm_args = dict(ini.slurm_args)             # config values are read-only
     # update the "TBD" values in nsem_ini.py file
     # slurm_args['ntasks'] = ntasks               # remove after discussion
     slurm_args['slurm_dir'] = local_repo
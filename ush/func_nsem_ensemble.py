@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+
+"""
+File Name   : func_nsem_ensemble.py
+Description : NSEM ensemble orchestrator - expands a storms x run types x members matrix into independent
+              NCO trees, runs the work they share once (one NEMS build per component set, one NWM input
+              check per domain and time window) and prepares the members concurrently with a bounded
+              worker pool. Every stage is recorded in a state file so an interrupted ensemble resumes
+              where it stopped.
+Usage       : Import this into an external python program such as main.py (i.e. import func_nsem_ensemble as fen)
+              then run the main program: python main.py ensemble --spec=nsem_ensemble_ini.py
+Date        : 7/6/2020
+Contacts    : Coastal Act Team
+              ali.abdolali@noaa.gov, saeed.moghimi@noaa.gov, beheen.m.trimble@gmail.com, andre.vanderwesthuysen@noaa.gov
+"""
+
+# standard libs
+import os, sys, json, time
+import threading
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+# local libs
+import func_nsem_build    as fbn
+import func_nsem_prep     as fnp
+import func_nsem_workflow as fnw
+import nsem_config        as nsc
+import nsem_install       as nin
+import nsem_nemsconfig    as nnc
+import nsem_utils         as nus
+
+
+MAX_WORKERS = 8
+
+DONE = 'done'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+
+# one run of the matrix - overrides: {ini variable: value}, dictionaries are merged into the ini ones
+Member = namedtuple('Member', 'storm run_type name overrides')
+
+
+def member_key(member):
+    """ matthew.atm2wav2ocn2hyd.m01 """
+    return ".".join(p for p in (member.storm, member.run_type, member.name) if p)
+
+
+
+def expand(spec):
+    """ the members of a spec module (see nsem_ensemble_ini.py), in storm, run type, member order """
+
+    members = getattr(spec, 'MEMBERS', None) or {"": {}}
+    return [Member(storm, run_type, name, overrides)
+            for storm in spec.STORMS
+            for run_type in spec.RUN_TYPES
+            for name, overrides in members.items()]
+
+
+
+def member_ini(base_ini, member):
+    """
+    the config of the base initialization file for one member (see nsem_config.py): STORM, RUN_TYPE
+    and the overrides are applied before the values derived from them (COMIN, RUNdir, jlogfile,
+    nems_cfg, ...), dictionary overrides are merged. A named member gets its own RUN_NAME and RUNdir.
+    """
+
+    overrides = dict(member.overrides)
+    overrides['STORM'] = member.storm
+    overrides['RUN_TYPE'] = member.run_type
+    ini = nsc.load(base_ini, overrides)
+
+    if member.name:
+        ini = ini.replace(RUN_NAME=member.run_type + "." + member.name, RUNdir=ini.RUNdir + "." + member.name)
+    return ini
+
+
+
+def components(ini):
+    """ (name, model) of every EARTH component in the nems.configure of the run type, from nco parm dir """
+
+    cfg = nnc.read(os.path.join(ini.PARMnsem, ini.nems_configure['nems_cfg']))
+    return tuple((comp.name, comp.model) for comp in cfg.components)
+
+
+
+def build_tag(comps):
+    """ one NEMS build per component set: adcirc_atmesh_nwm_ww3data """
+    return "_".join(sorted(model for name, model in comps))
+
+
+
+class EnsembleState():
+
+    """ stage name: {'status': done|failed|skipped, 'elapsed': seconds, 'error': text}, kept as json.
+        Stages are updated from many threads, every update is saved atomically """
+
+    def __init__(self, path, force=False):
+
+        self.path = path
+        self.stages = OrderedDict()
+        self.lock = threading.Lock()
+        if not force:
+            try:
+                with open(path, 'r') as fptr:
+                    self.stages.update(json.load(fptr, object_pairs_hook=OrderedDict))
+            except (OSError, ValueError):
+                pass              # new ensemble
+
+
+    def done(self, stage):
+        return self.stages.get(stage, {}).get('status') == DONE
+
+
+    def mark(self, stage, status, elapsed=0.0, error=None):
+        with self.lock:
+            self.stages[stage] = {'status': status, 'elapsed': round(elapsed, 3), 'error': error,
+                                  'time': nus.now(frmt=3)}
+            nus.write_atomic(self.path, json.dumps(self.stages, indent=1))
+
+
+    def run(self, stage, func, *args):
+        """ runs func once - a stage done in a previous run is not run again.
+            returns True when the stage is done """
+
+        if self.done(stage):
+            print(nus.colory("green", "Stage %s done in a previous run, skipped" %stage))
+            return True
+
+        t0 = time.time()
+        try:
+            func(*args)
+        except (Exception, SystemExit) as err:     # the prep functions sys.exit on bad input
+            self.mark(stage, FAILED, time.time() - t0, "%s: %s" %(type(err).__name__, err))
+            print(nus.colory("red", "Stage %s failed - %s" %(stage, err)))
+            return False
+        self.mark(stage, DONE, time.time() - t0)
+        return True
+
+
+
+# ------------------------------------------------------------------ stages
+
+def build_stage(ini, tag):
+    """ builds (or only configures if compile_flag is 0) NEMS for a component set, then keeps its
+        NEMS.x in EXECnsem/<tag> - the build tree in sorc is shared by all the sets """
+
+    fbn.nsem_build(ini=ini)
+    local_repo = os.path.join(ini.SORCnsem, Path(ini.repository).name)
+    nin.install_files([os.path.join(local_repo, 'NEMS', 'exe', 'NEMS.x')], os.path.join(ini.EXECnsem, tag))
+
+
+
+def nwm_check_stage(ini):
+    """ NWM input files of one domain and time window, checked once for all the members using them """
+
+    start_date_str, tot_hrs = fnp.run_window(ini)
+    report = fnp.NWM(ini, start_date_str, tot_hrs).check_files(ini, min_size=1)
+    if not report.ok:
+        raise OSError("NWM input files not ready: %s" %report.summary())
+
+
+
+def prep_stage(ini, comps, tag):
+    """ one member: its NCO tree, run directory, model inputs, NEMS configs, NEMS.x and slurm job """
+
+    nco, ini = fnw.nsem_workflow(ini=ini)
+    rundir = ini.RUNdir
+    os.makedirs(rundir, exist_ok=True)
+
+    if 'nwm' in [model for name, model in comps]:
+        start_date_str, tot_hrs = fnp.run_window(ini)
+        fnp.prep_nwm(ini, start_date_str, tot_hrs, check=False)
+
+    # configs written per member into its own run directory, not in the shared sorc tree
+    nems_cf = fbn.NEMSConfig(rundir, ini.node, ini.nems['user_module'])
+    nems_cf.setup_model_config(ini.model_configure)
+    nems_cf.setup_nems_config(ini.nems_configure, nco.parm_dir())
+
+    copied, skipped, failed = nin.install_files([os.path.join(ini.EXECnsem, tag, 'NEMS.x')], rundir)
+    if failed:
+        raise OSError("NEMS.x of build %s is missing" %tag)
+
+    slurm_args = dict(ini.slurm_args)
+    slurm_args['jobname'] = getattr(ini, 'RUN_NAME', ini.RUN_TYPE)
+    slurm_args['slurm_dir'] = rundir
+    slurm_args['prj_dir'] = os.path.join(ini.SORCnsem, Path(ini.repository).name)
+    fbn.SlurmJob(**slurm_args).write_sbatch()
+
+
+
+def write_submission(inis, keys, jobs_dir, stages=None, max_running=None):
+    """
+    the prepared members as a few submissions: one array job per stage and slurm resources, tasks
+    running in the member run directories, and a script submitting them all with each stage held
+    until the arrays of the stage before it end (i.e. spin-up -> forecast). A member's stage is its
+    STAGE override, stages: their order (spec STAGES). returns the submission script name
+    """
+
+    os.makedirs(jobs_dir, exist_ok=True)
+    stages = list(stages or [None])
+    arrays = OrderedDict()
+    for key in keys:
+        ini = inis[key]
+        stage = getattr(ini, 'STAGE', None)
+        if stage not in stages:
+            stages.append(stage)
+        resources = json.dumps(dict((k, v) for k, v in ini.slurm_args.items() if k not in ('slurm_dir', 'jobname')),
+                               sort_keys=True)
+        arrays.setdefault((stage, resources), (ini, []))[1].append(ini.RUNdir)
+
+    jobs = []; before = []
+    for stage in stages:
+        names = []
+        for n, ((s, resources), (ini, run_dirs)) in enumerate(arrays.items()):
+            if s != stage:
+                continue
+            name = "%s_%d" %(stage or "run", n)
+            slurm_args = dict(ini.slurm_args)
+            slurm_args.update(jobname=name, error=name, output=name, slurm_dir=jobs_dir,
+                              prj_dir=os.path.join(ini.SORCnsem, Path(ini.repository).name))
+            job_file = fbn.SlurmJob(**slurm_args).write_array(run_dirs, max_running)
+            jobs.append((name, job_file, [('afterok', b) for b in before]))
+            names.append(name)
+        before = names or before
+
+    return fbn.write_chain(os.path.join(jobs_dir, "submit.sh"), jobs)
+
+
+
+def nsem_ensemble(args=None):
+    """ expands the ensemble spec and prepares every member:
+        1. one NEMS build per component set, one at a time (the sorc tree is shared)
+        2. NWM input checks, one per data path, domain, storm and time window
+        3. member preps, concurrently - each waits only for its own shared stages
+    """
+
+    try:
+        print("Importing ensemble file %s ....." %args.spec)
+        spec = nus.import_file(args.spec)
+        base_ini = os.path.join(os.path.dirname(os.path.abspath(args.spec)), spec.INI)
+        members = expand(spec)
+    except Exception as err:
+        print(nus.colory("red", "\nError importing ensemble file {} - {}\n".format(args.spec, err)))
+        sys.exit(0)
+
+    workers = args.workers or getattr(spec, 'MAX_WORKERS', MAX_WORKERS)
+    state_file = args.state or getattr(spec, 'STATE_FILE', None) or os.path.splitext(args.spec)[0] + ".state.json"
+    state = EnsembleState(state_file, args.force)
+    print("%d member(s), %d worker(s), state file %s" %(len(members), workers, state_file))
+
+    t0 = time.time()
+    inis = OrderedDict(); comps = {}; builds = OrderedDict(); checks = OrderedDict(); needs = {}
+    for member in members:
+        key = member_key(member)
+        try:
+            ini = member_ini(base_ini, member)
+            comps[key] = components(ini)
+        except Exception as err:
+            state.mark("prep:" + key, FAILED, error="%s: %s" %(type(err).__name__, err))
+            print(nus.colory("red", "Member %s can not be set up - %s" %(key, err)))
+            continue
+        inis[key] = ini
+
+        tag = build_tag(comps[key])
+        builds.setdefault(tag, ini)
+        needs[key] = ["build:" + tag]
+        if 'nwm' in [model for name, model in comps[key]]:
+            check = "nwm:%s:%s:%s:%s:%s" %((ini.NWM['nwm_data_path'], ini.NWM['domain'], ini.STORM) + fnp.run_window(ini))
+            checks.setdefault(check, ini)
+            needs[key].append(check)
+
+    # 1. builds
+    ok = {}
+    for tag, ini in builds.items():
+        ok["build:" + tag] = state.run("build:" + tag, build_stage, ini, tag)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+
+        # 2. shared checks are queued first, so a member waiting on one never holds the only worker
+        futures = dict((check, pool.submit(state.run, check, nwm_check_stage, ini)) for check, ini in checks.items())
+
+        def prep(key):
+            for need in needs[key]:
+                if not (ok[need] if need in ok else futures[need].result()):
+                    state.mark("prep:" + key, SKIPPED, error="%s failed" %need)
+                    return False
+            return state.run("prep:" + key, prep_stage, inis[key], comps[key], build_tag(comps[key]))
+
+        # 3. members
+        for future in [pool.submit(prep, key) for key in inis]:
+            future.result()
+
+    wall = time.time() - t0
+    member_time = sum(state.stages.get("prep:" + key, {}).get('elapsed', 0.0) for key in inis)
+    bad = [k for k in (member_key(m) for m in members) if not state.done("prep:" + k)]
+
+    print("\nEnsemble of %d member(s): %d build(s), %d NWM check(s), wall time %.1f seconds "
+          "(members alone %.1f seconds)" %(len(members), len(builds), len(checks), wall, member_time))
+    if bad:
+        print(nus.colory("red", "Not prepared (see %s): %s" %(state_file, ", ".join(bad))))
+        sys.exit(1)
+    print(nus.colory("green", "All members prepared"))
+
+    jobs_dir = getattr(spec, 'JOBS_DIR', None) or os.path.splitext(args.spec)[0] + ".jobs"
+    script = write_submission(inis, list(inis), jobs_dir, getattr(spec, 'STAGES', None), getattr(spec, 'MAX_RUNNING', None))
+    print("Submit the whole ensemble with: sh %s" %script)
@@ -11,11 +11,12 @@ Contacts    : Coastal Act Team
 """
 
 # standard libs
-import glob, os, sys
+import glob, os, sys, json, hashlib
 import datetime, subprocess
 
 # local libs
 import nsem_utils as nus
+import nsem_config as nsc
 
 
 # ecflow nco variables:
@@ -113,12 +114,14 @@ class NCOSystem():
 
     """
 
-    def __init__(self, event, envir, run_name, dataroot, gesroot, model="nsem"):
+    def __init__(self, event, envir, run_name, dataroot, gesroot, com_dir, prj_dir, model="nsem"):
 
-        self.COMROOT = COM_DIR               # COMROOT root directory for input/output data on current system
+        # com_dir and prj_dir come from the config of the run, ensemble members pass their own
+        # so many trees can be set up side by side
+        self.COMROOT = com_dir               # COMROOT root directory for input/output data on current system
         self.GESROOT = gesroot               # GESROOT nwges root directory for input/output guess fields on current system
         self.DATAROOT = dataroot             # DATAROOT Directory containing the working directory, often /tmpnwprd1 in production
-        self.NWROOT = PRJ_DIR                # NWROOT Root directory for application, typically /nw$envir
+        self.NWROOT = prj_dir                # NWROOT Root directory for application, typically /nw$envir
         self.NET = event.lower()
         self.envir = envir.lower()
         self.RUN = run_name.lower()
@@ -310,54 +313,13 @@ export jlogfile={}
             which = self.jjob_dir()
 
         p = os.path.join(which, self.NET)
-        if not nus.exist(p):
-            print("\nCreating directory: {}".format(p))
-            try:
-                subprocess.run(['mkdir', '-pv', p ], check=True)
-            except subprocess.CalledProcessError as err:
-                print('Error in creating directory: ', err)
+        try:
+            os.makedirs(p, exist_ok=True)
+        except OSError as err:
+            print('Error in creating directory: ', err)
         return p
 
 
-    def setup_prjdir(self):
-        # update the prj_dir for new storm event - TOO
-        # <prj_dir>/parm/<event> - to exists 
-        # <prj_dir>/fix/meshes/<event>   hsofs  hsofs_elevated20m ??
-        # <prj_dir>/sorc/runupforecast.fd ??
-        p = self.NWROOT
-        print("Checking health of project directory: {}".format(p))
-        if not nus.exist(p):
-            try:
-                subprocess.run(['mkdir', '-pv', p ], check=True)
-                subprocess.check_call(['mkdir', '-v', self.SOURCE, self.SCRIPT, self.ECF, self.FIX,
-                                       self.USH, self.EXEC, self.PARM, self.JOBS], cwd=p)
-            except subprocess.CalledProcessError as err:
-                print('Error in creating model home directory: ', err)
-        else:
-            for dir in self.prj_dir():
-                if not nus.exist(dir):
-                    try:
-                      subprocess.run(['mkdir', '-vp', dir ], check=True)
-                    except subprocess.CalledProcessError as err:
-                      print('Error in creating %s directory: ' %(dir, err))
-                #else:
-                #    print("\n%s is healthy" %dir)
-
-        # now check on subdirs:
-        for dir in self.prj_subdir():
-            if not nus.exist(dir):
-                try:
-                  subprocess.run(['mkdir', '-vp', dir ], check=True)
-                except subprocess.CalledProcessError as err:
-                  print('Error in creating %s directory: ' %(dir, err))
-            #else:
-            #    print("\n%s is healthy" %dir)
-
-    # rundir is not clear yet! - TODO
-    def setup_rundir(self):
-        pass
-
-
     # Com dir and subdir
     def com_subdir(self):
         subdir_iterable = ['nwm', 'adcirc', 'ww3', 'atmesh', 'atm']
@@ -365,62 +327,101 @@ export jlogfile={}
             yield subdir
 
 
-    def setup_comdir(self):
-        p = self.COMIN
-        print("Checking health of com directory: {}".format(p))
-        if not nus.exist(p):
-            try:
-                subprocess.run(['mkdir', '-pv', p ], check=True)
-            except subprocess.CalledProcessError as err:
-                print('Error in creating model input directory: ', err)
-
-        for dir in self.com_subdir():
-            subdir = os.path.join(p, dir)
-            if not nus.exist(subdir):
-                try:
-                  subprocess.run(['mkdir', '-vp', subdir ], check=True)
-                except subprocess.CalledProcessError as err:
-                  print('Error in creating %s directory: ' %(subdir, err))
-
-
-        """created on script side with id
-        p = self.COMOUT
-        if not nus.exist(p):
-            print("\nCreating model output directory: {}".format(p))
+    def tree(self):
+        """ every directory of the NCO tree for this storm and run, parents first:
+            NWROOT and its subdirs, per storm parm/fix subdirs, COMIN and its model subdirs,
+            GESIN and the logs directory of jlogfile.
+            COMOUT and GESOUT are created on script side with the job id """
+
+        dirs = [self.NWROOT] + list(self.prj_dir()) + list(self.prj_subdir())
+        dirs += [self.COMIN] + [os.path.join(self.COMIN, d) for d in self.com_subdir()]
+        dirs += [self.GESIN, os.path.dirname(self.jlogfile)]
+        return dirs
+
+
+    def state_file(self):
+        return os.path.join(self.COMIN, ".nsem_workflow.%s.json" %self.RUN)
+
+
+    def tree_key(self, ini_file=None):
+        """ sha256 of the initialization file and the directory list """
+
+        h = hashlib.sha256("\n".join(self.tree()).encode())
+        if ini_file:
             try:
-                subprocess.run(['mkdir', '-pv', p ], check=True)
-            except subprocess.CalledProcessError as err:
-                print('Error in creating model input directory: ', err)
+                with open(ini_file, 'rb') as fptr:
+                    h.update(fptr.read())
+            except OSError:
+                h.update(ini_file.encode())
+        return h.hexdigest()
+
+
+    def setup_tree(self, ini_file=None, force=False):
+        """
+        creates the whole tree in process, in one pass, and records it in a state file keyed by
+        the initialization file and the directory list - later runs with the same key skip the
+        health check (one file read instead of a stat per directory). force checks again.
+        returns the directories created
         """
 
-        p = self.GESIN
-        print("Checking restart directory: {}".format(p))
-        if not nus.exist(p):
+        key = self.tree_key(ini_file)
+        state_file = self.state_file()
+        if not force:
+            try:
+                with open(state_file, 'r') as fptr:
+                    if json.load(fptr).get('key') == key:
+                        print("NCO system directory structure unchanged since %s" %state_file)
+                        return []
+            except (OSError, ValueError):
+                pass
+
+        print("Checking health of project and com directories: {} {}".format(self.NWROOT, self.COMIN))
+        created = []; failed = []
+        for d in self.tree():
+            if os.path.isdir(d):
+                continue
             try:
-                subprocess.run(['mkdir', '-pv', p ], check=True)
-            except subprocess.CalledProcessError as err:
-                print('Error in creating gesin directory: ', err)
+                os.makedirs(d, exist_ok=True)
+                created.append(d)
+            except OSError as err:
+                print(nus.colory("red", "Error in creating directory %s: %s" %(d, err)))
+                failed.append(d)
+        for d in created:
+            print("Created directory: {}".format(d))
 
+        if not failed:
+            nus.write_atomic(state_file, json.dumps({'key': key, 'dirs': self.tree(), 'time': nus.now(frmt=3)}, indent=1))
+        return created
 
-        """created on script side with id
-        p = self.GESOUT
-        if not nus.exist(p):
-            print("\nCreating gesout directory: {}".format(p))
+
+    def setup_prjdir(self):
+        # update the prj_dir for new storm event - TOO
+        # <prj_dir>/parm/<event> - to exists 
+        # <prj_dir>/fix/meshes/<event>   hsofs  hsofs_elevated20m ??
+        # <prj_dir>/sorc/runupforecast.fd ??
+        print("Checking health of project directory: {}".format(self.NWROOT))
+        for d in [self.NWROOT] + list(self.prj_dir()) + list(self.prj_subdir()):
             try:
-                subprocess.run(['mkdir', '-pv', p ], check=True)
-            except subprocess.CalledProcessError as err:
-                print('Error in creating gesout directory: ', err)
-        """
+                os.makedirs(d, exist_ok=True)
+            except OSError as err:
+                print('Error in creating %s directory: %s' %(d, err))
+
+    # rundir is not clear yet! - TODO
+    def setup_rundir(self):
+        pass
 
-        # this is a dev logfile, so creating it here.
+
+    def setup_comdir(self):
+        # COMOUT and GESOUT are created on script side with id.
+        # this is a dev logfile, so creating its directory here.
         # there is one also in ecf script to create, upon running!! One is extra!!
-        p = self.jlogfile
-        print("Checking logs directory: {}".format(p))
-        if not nus.exist(p):
+        print("Checking health of com directory: {}".format(self.COMIN))
+        for d in [self.COMIN] + [os.path.join(self.COMIN, d) for d in self.com_subdir()] + \
+                 [self.GESIN, os.path.dirname(self.jlogfile)]:
             try:
-                subprocess.run(['mkdir', '-pv', p ], check=True)
-            except subprocess.CalledProcessError as err:
-                print('Error in creating logs directory: ', err)
+                os.makedirs(d, exist_ok=True)
+            except OSError as err:
+                print('Error in creating %s directory: %s' %(d, err))
 
 
     def write_ecf2(self, slurm):
@@ -880,64 +881,47 @@ exit 0
 
 
 
-def import_initfile(filename):
-
-    directory, module_name = os.path.split(filename)
-    module_name = os.path.splitext(module_name)[0]
-
-    path = list(sys.path)
-    sys.path.insert(0, directory)
-         
-    try:
-        module = __import__(module_name) 
-        return module
-    finally:
-        sys.path[:] = path # restore
-
-
-
 def import_ini(args=None):
 
-    # get the input from the nsem_ini.py file
+    # get the input from the nsem_ini.py file, see nsem_config.py
     try:
-      print("Importing initialization file, nsem_ini.py .....")
-      ini = nus.import_file(args.ini)       # TO DO - check for correct format of init file
-    except Exception as err:
-      print("\nError importing initialization file {} - {0}\n".format(args.ini,err))
+      print("Loading initialization file %s ....." %args.ini)
+      ini = nsc.load(args.ini)
+    except (OSError, SyntaxError, nsc.NSEMConfigError) as err:
+      print(nus.colory("red", "\nError loading initialization file {} - {}\n".format(args.ini, err)))
       sys.exit(0)
 
     return ini
  
 
 
-def nsem_workflow(args=None):
+def nsem_workflow(args=None, ini=None):
 
-    ini = import_ini(args)
+    # ini: an already loaded config (i.e. an ensemble member), args.ini is loaded otherwise
+    if ini is None:
+        ini = import_ini(args)
 
     try:
       node = ini.node
       envir = ini.envir
       event = ini.STORM
-      run_name = ini.RUN_TYPE
-      global PRJ_DIR
-      PRJ_DIR = ini.PRJ_DIR   # location where nco system directory is to be constructed, if not exists
-      global COM_DIR
-      COM_DIR = ini.COM_DIR   # "/scratch2/COASTAL/coastal/scrub/com/nsem"  # Note: nsem part of com dir!!
+      run_name = getattr(ini, 'RUN_NAME', ini.RUN_TYPE)     # ensemble members run as <run_type>.<member>
+      prj_dir = ini.PRJ_DIR   # location where nco system directory is to be constructed, if not exists
+      com_dir = ini.COM_DIR   # "/scratch2/COASTAL/coastal/scrub/com/nsem"  # Note: nsem part of com dir!!
     except OSError as err:
       print("\nError reading initialization file {} - {0}\n".format("nsem_ini.py",err))
       sys.exit(0)
 
     # these 3 to be verified for their final place 
     DATAROOT = os.path.join("/tmp",event.lower())
-    GESROOT = COM_DIR
+    GESROOT = com_dir
     model = ini.model
 
     # construct model input/output paths, if none exists
     # or creates the none existing ones
     print("\nChecking NCO system directory structure .....")
-    nco = NCOSystem(event, envir, run_name, DATAROOT, GESROOT, model)
-    nco.setup_prjdir()
-    nco.setup_comdir()
+    nco = NCOSystem(event, envir, run_name, DATAROOT, GESROOT, com_dir, prj_dir, model)
+    nco.setup_tree(ini.path, force=getattr(args, 'check', False))
     # nco.setup_rundir()     # TODO - not clear at this time
     return nco, ini
 
@@ -15,6 +15,7 @@ import argparse
 
 # local libs
 import func_nsem_build    as fbn
+import func_nsem_ensemble as fen
 import func_nsem_prep     as fnp
 import func_nsem_workflow as fnw
 import nsem_utils         as nus
@@ -32,16 +33,19 @@ if __name__ == '__main__':
    
     nco = subp.add_parser("workflow", help="reads an initialization file and construct the NSEM workflow")
     nco.add_argument("--ini", help="an init python file with prepopulated values", default="nsem_ini.py")
+    nco.add_argument("--check", action='store_true', help="checks the NCO directory structure even if unchanged since the last run")
     nco.set_defaults(func=fnw.nsem_workflow)
     
 
     build_install = subp.add_parser("build", help="buils and installs NSEM models with NEMS")
     build_install.add_argument("--ini", help="an init python file with prepopulated values", default="nsem_ini.py")
+    build_install.add_argument("--check", action='store_true', help="checks the NCO directory structure even if unchanged since the last run")
     build_install.set_defaults(func=fbn.nsem_build)
   
 
     prep_data = subp.add_parser("prep", help="prepares NSEM models input files")
     prep_data.add_argument("--ini", help="an init python file with prepopulated values", default="nsem_ini.py")
+    prep_data.add_argument("--check", action='store_true', help="checks the NCO directory structure even if unchanged since the last run")
     prep_data.add_argument("--nwm", action='store_true', help="prepares data for the NWM")
     prep_data.add_argument("--adc", action='store_true', help="prepares data for the ADCIRC")
     prep_data.add_argument("--ww3", action='store_true', help="prepares data for the WW3")
@@ -51,6 +55,14 @@ if __name__ == '__main__':
     prep_data.set_defaults(func=fnp.nsem_prep)
   
 
+    ensemble = subp.add_parser("ensemble", help="expands a storms x run types x members matrix and prepares all the runs")
+    ensemble.add_argument("--spec", help="an ensemble python file with the matrix", default="nsem_ensemble_ini.py")
+    ensemble.add_argument("--workers", type=int, help="members prepared at the same time, MAX_WORKERS of the spec if not given")
+    ensemble.add_argument("--state", help="state file to resume from, <spec>.state.json if not given")
+    ensemble.add_argument("--force", action='store_true', help="runs again the stages done in a previous run")
+    ensemble.set_defaults(func=fen.nsem_ensemble)
+  
+
     args = parser.parse_args()
     print(args)
     args.func(args)
@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+
+"""
+File Name   : nsem_buildcache.py
+Description : NEMS build cache - NEMS.x and the per component install directories (ADCIRC_INSTALL,
+              NWM_INSTALL, ...) stored by a content hash of the component source trees, the user
+              modulefile, the COMPONENTS set and the compiler environment. A configuration built
+              before is restored instead of compiled, and only components whose hash changed are
+              cleaned and compiled again
+Usage       : import this into an external python source file (i.e. import nsem_buildcache as nbc)
+              cache = nbc.BuildCache(root); keys = cache.keys(source_dir, ['ADCIRC', 'NWM'], modulefile)
+Date        : 7/6/2020
+Contacts    : Coastal Act Team
+              ali.abdolali@noaa.gov, saeed.moghimi@noaa.gov, beheen.m.trimble@gmail.com, andre.vanderwesthuysen@noaa.gov
+"""
+
+# standard libs
+import os, json, hashlib
+import shutil, subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+# local libs
+import nsem_utils as nus
+import nsem_install as nin
+
+
+NEMS = 'NEMS'
+NEMS_EXE = os.path.join('NEMS', 'exe', 'NEMS.x')
+INSTALL_DIR = "%s_INSTALL"                  # per component install directory, next to NEMS
+STATE = ".nsem_build.json"                  # keys of what is built in place, in the source directory
+META = "meta.json"                          # written last, an entry without it is incomplete
+
+# what is hashed in a source tree - build products and scratch directories are not
+SOURCE_SUFFIXES = ('.f', '.F', '.f90', '.F90', '.for', '.ftn', '.c', '.h', '.cc', '.cpp', '.hpp',
+                   '.inc', '.mk', '.cmake', '.sh', '.csh', '.pl', '.py', '.cfg', '.in')
+SOURCE_NAMES = ('Makefile', 'makefile', 'GNUmakefile', 'CMakeLists.txt', 'configure', 'switch')
+SKIP_DIRS = ('.git', '.svn', 'exe', 'bin', 'lib', 'mod', 'obj', 'tmp', 'Run')
+SKIP_PREFIXES = ('obj_', 'mod_', 'odir')
+
+# compiler environment - these variables and any starting with the prefixes
+ENV_VARS = ('FC', 'F77', 'F90', 'CC', 'CXX', 'MPIFC', 'MPICC', 'MPICXX', 'FFLAGS', 'FCFLAGS', 'CFLAGS',
+            'CXXFLAGS', 'LDFLAGS', 'LOADEDMODULES', 'COMPILER', 'NEMS_COMPILER')
+ENV_PREFIXES = ('ESMF', 'NETCDF', 'HDF5', 'PNETCDF', 'PARMETIS', 'METIS', 'I_MPI', 'INTEL')
+
+MAX_WORKERS = 8
+
+
+def _is_source(name):
+    return name.endswith(SOURCE_SUFFIXES) or name in SOURCE_NAMES
+
+
+
+def _skip_dir(name):
+    return name in SKIP_DIRS or name.startswith(SKIP_PREFIXES) or name.endswith(INSTALL_DIR %"")
+
+
+
+def git_tree_hash(root):
+    """
+    sha256 of the git tree object of root at HEAD plus the uncommitted changes of tracked files -
+    files generated by a build are untracked so they never change the key.
+    returns None if root is not in a git work tree (i.e. sources copied in, not cloned)
+    """
+
+    try:
+        tree = subprocess.run(['git', 'rev-parse', 'HEAD:./'], cwd=root, check=True,
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
+        diff = subprocess.run(['git', 'diff', 'HEAD', '--binary', '--', '.'], cwd=root, check=True,
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return hashlib.sha256(tree + b"\n" + diff).hexdigest()
+
+
+
+def tree_hash(root, index):
+    """
+    sha256 over the relative path and content of every source file under root, for trees outside git.
+    index: {relative path: [size, mtime_ns, sha256]} of the previous run, updated in place -
+    only files whose size or modification time changed are read again
+    """
+
+    seen = set(); h = hashlib.sha256()
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if not _skip_dir(d))
+        for name in sorted(filenames):
+            if not _is_source(name):
+                continue
+            path = os.path.join(dirpath, name)
+            rel = os.path.relpath(path, root)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue          # dangling link
+            cached = index.get(rel)
+            if cached and cached[0] == st.st_size and cached[1] == st.st_mtime_ns:
+                digest = cached[2]
+            else:
+                digest = nin.file_hash(path)
+                index[rel] = [st.st_size, st.st_mtime_ns, digest]
+            seen.add(rel)
+            h.update(("%s %s\n" %(rel, digest)).encode())
+
+    for rel in set(index) - seen:
+        del index[rel]
+    return h.hexdigest()
+
+
+
+def env_hash(environ=None):
+    """ sha256 of the compiler related environment variables """
+
+    environ = os.environ if environ is None else environ
+    names = sorted(k for k in environ if k in ENV_VARS or k.startswith(ENV_PREFIXES))
+    return hashlib.sha256("\n".join("%s=%s" %(k, environ[k]) for k in names).encode()).hexdigest()
+
+
+
+def _digest(*parts):
+    return hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+
+
+class BuildCache():
+
+    """
+    <root>/<key>/        one entry per component key (its install directory) or NEMS key (NEMS.x)
+    <root>/index/        source file hashes per tree, so unchanged trees are not read again
+    """
+
+    def __init__(self, root, max_entries=64):
+
+        self.root = root
+        self.max_entries = max_entries
+        os.makedirs(os.path.join(root, "index"), exist_ok=True)
+
+
+    # ---------------------------------------------------------- keys
+
+    def _tree(self, path):
+        """ git tree hash, or a tree hash with its file index kept in the cache """
+
+        digest = git_tree_hash(path)
+        if digest:
+            return digest
+
+        index_file = os.path.join(self.root, "index", hashlib.sha256(os.path.abspath(path).encode()).hexdigest() + ".json")
+        try:
+            with open(index_file, 'r') as fptr:
+                index = json.load(fptr)
+        except (OSError, ValueError):
+            index = {}
+        digest = tree_hash(path, index)
+        nus.write_atomic(index_file, json.dumps(index))
+        return digest
+
+
+    def keys(self, source_dir, components, modulefile, environ=None, workers=MAX_WORKERS):
+        """
+        {component: key, ..., 'NEMS': key} for a build of components (NEMS aliases, i.e. ADCIRC) in source_dir.
+        A component key covers its source tree, the modulefile and the compiler environment,
+        the NEMS key covers NEMS sources, the COMPONENTS set and every component key
+        """
+
+        try:
+            with open(modulefile, 'rb') as fptr:
+                module_digest = hashlib.sha256(fptr.read()).hexdigest()
+        except OSError:
+            module_digest = modulefile          # not there yet, the path is all we know
+        environ_digest = env_hash(environ)
+
+        trees = list(components) + [NEMS]
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(trees)))) as pool:
+            digests = dict(zip(trees, pool.map(lambda c: self._tree(os.path.join(source_dir, c)), trees)))
+
+        keys = {}
+        for c in components:
+            keys[c] = _digest(c, digests[c], module_digest, environ_digest)
+        keys[NEMS] = _digest(NEMS, digests[NEMS], " ".join(sorted(components)), *[keys[c] for c in sorted(components)])
+        return keys
+
+
+    # ---------------------------------------------------------- entries
+
+    def entry(self, key):
+        return os.path.join(self.root, key)
+
+
+    def has(self, key):
+        return os.path.exists(os.path.join(self.entry(key), META))
+
+
+    def store(self, key, files):
+        """ files: {name in entry: path of a file or directory}, copied then published with one rename """
+
+        if self.has(key):
+            return
+        tmp = os.path.join(self.root, ".%s.%d" %(key, os.getpid()))
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        try:
+            for name, path in files.items():
+                if os.path.isdir(path):
+                    shutil.copytree(path, os.path.join(tmp, name), symlinks=True)
+                else:
+                    shutil.copy2(path, os.path.join(tmp, name))
+            nus.write_atomic(os.path.join(tmp, META), json.dumps({'files': sorted(files), 'stored': nus.now(frmt=3)}))
+            os.rename(tmp, self.entry(key))
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+            if not self.has(key):           # another build may have published the same key
+                raise
+        print("Stored build %s in cache: %s" %(key[:12], ", ".join(sorted(files))))
+        self.prune()
+
+
+    def restore(self, key, dests):
+        """ dests: {name in entry: destination path}, an existing destination is replaced whole """
+
+        src = self.entry(key)
+        for name, dest in dests.items():
+            path = os.path.join(src, name)
+            if os.path.isdir(path):
+                tmp = dest + ".restore"
+                shutil.rmtree(tmp, ignore_errors=True)
+                shutil.copytree(path, tmp, symlinks=True)
+                shutil.rmtree(dest, ignore_errors=True)
+                os.rename(tmp, dest)
+            else:
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                nin.copy_file(path, dest)
+        os.utime(src)                      # recently used, see prune
+        print("Restored build %s from cache: %s" %(key[:12], ", ".join(sorted(dests))))
+
+
+    def link(self, key, dests):
+        """ dests: {name in entry: destination path} of files, linked (see nsem_install.link_file) instead
+            of copied - for products read by the runs and never written, i.e. WW3 mod_def files """
+
+        src = self.entry(key)
+        for name, dest in dests.items():
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            nin.link_file(os.path.join(src, name), dest)
+        os.utime(src)                      # recently used, see prune
+
+
+    def prune(self):
+        """ drops the least recently used entries above max_entries """
+
+        entries = [os.path.join(self.root, d) for d in os.listdir(self.root) if self.has(d)]
+        entries.sort(key=os.path.getmtime)
+        for path in entries[:max(0, len(entries) - self.max_entries)]:
+            print("Removing build %s from cache" %os.path.basename(path)[:12])
+            shutil.rmtree(path, ignore_errors=True)
+
+
+
+# ------------------------------------------------------------------ build state in the source directory
+
+def read_state(source_dir):
+    """ {component or 'NEMS': key} of what was last built in place """
+    try:
+        with open(os.path.join(source_dir, STATE), 'r') as fptr:
+            return json.load(fptr)
+    except (OSError, ValueError):
+        return {}
+
+
+
+def write_state(source_dir, keys):
+    nus.write_atomic(os.path.join(source_dir, STATE), json.dumps(keys, indent=1, sort_keys=True))
+
+
+
+def install_dir(source_dir, component):
+    return os.path.join(source_dir, INSTALL_DIR %component)
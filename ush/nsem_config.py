@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+
+"""
+File Name   : nsem_config.py
+Description : NSEM configuration loader - an initialization file (nsem_ini.py, or the same values in
+              json, toml or yaml) evaluated in its own namespace into an immutable, validated config
+              with the derived values computed once: run window, com paths and NWM file templates.
+              Configs are cached by file content, so many storms can be driven from one process
+              without importing anything and two files named nsem_ini.py never collide
+Usage       : import this into an external python source file (i.e. import nsem_config as nsc)
+              ini = nsc.load("nsem_ini.py"); ini.STORM, ini.NWM['domain'], ini.window.start, ini.com.COMINnwm
+Date        : 7/6/2020
+Contacts    : Coastal Act Team
+              ali.abdolali@noaa.gov, saeed.moghimi@noaa.gov, beheen.m.trimble@gmail.com, andre.vanderwesthuysen@noaa.gov
+"""
+
+# standard libs
+import os, ast, json, types, hashlib, datetime, functools
+from dataclasses import dataclass, fields
+from typing import Mapping, Optional, Tuple
+
+
+class NSEMConfigError(ValueError):
+    """ every problem found in one initialization file """
+
+    def __init__(self, path, errors):
+        self.path = path
+        self.errors = errors
+        ValueError.__init__(self, "%s:\n  %s" %(path, "\n  ".join(errors)))
+
+
+
+@dataclass(frozen=True)
+class RunWindow:
+
+    start: datetime.datetime
+    hours: int
+
+    @property
+    def start_str(self):
+        """ yyyy-mm-dd hh:mm:ss """
+        return self.start.strftime('%Y-%m-%d %H:%M:%S')
+
+    @property
+    def end(self):
+        return self.start + datetime.timedelta(hours=self.hours)
+
+
+
+@dataclass(frozen=True)
+class ComPaths:
+
+    COMIN: str
+    COMINatm: str
+    COMINwave: str
+    COMINwavedata: str
+    COMINmeshdata: str
+    COMINadc: str
+    COMINnwm: str
+    RUNdir: str
+    jlogfile: str
+
+
+
+@dataclass(frozen=True)
+class NWMTemplates:
+
+    data_path: str
+    domain: str
+    domain_files: Mapping[str, str]
+    restart_files: Mapping[str, str]           # yyyy-mm-dd, yyyymmddhh placeholders
+    forcing: str                               # yyyymmddhh.LDASIN_DOMAIN1
+    nudging: str                               # yyyy-mm-dd_hh:mm:00.15min.usgsTimeSlice.ncdf
+    config_files: Mapping[str, str]
+    table_files: Tuple[str, ...]
+
+
+
+@dataclass(frozen=True)
+class NSEMConfig:
+
+    """ read-only values of an initialization file. Any of its variables reads as an attribute,
+        like the imported module did (ini.STORM, ini.NWM['domain']), dictionaries are read-only
+        (FrozenDict) and lists are tuples """
+
+    path: str
+    digest: str                                # sha256 of the file content
+    values: Mapping[str, object]
+    window: RunWindow
+    com: ComPaths
+    nwm: Optional[NWMTemplates]
+    overrides: str = '{}'                      # json of the overrides the file was loaded with
+
+    def __getattr__(self, name):
+        if name == 'values':                   # not set yet (i.e. while unpickling)
+            raise AttributeError(name)
+        try:
+            return self.values[name]
+        except KeyError:
+            raise AttributeError("%s has no variable %s" %(self.path, name))
+
+
+    def replace(self, **values):
+        """ a new config with some variables replaced: the file is loaded again with them added to its
+            overrides (see load), so every value it derives from them follows """
+        return load(self.path, _merge(json.loads(self.overrides), values))
+
+
+
+class FrozenDict(dict):
+    """ dictionary of a config - reads like a dict (json, copy and pickle too), can not be changed """
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("configuration values are read-only, use NSEMConfig.replace or a copy (dict(value))")
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _readonly
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
+
+
+
+# ------------------------------------------------------------------ helpers
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return FrozenDict((k, _freeze(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+
+def _thaw(value):
+    if isinstance(value, dict):
+        return dict((k, _thaw(v)) for k, v in value.items())
+    if isinstance(value, tuple):
+        return [_thaw(v) for v in value]
+    return value
+
+
+
+def _merge(values, overrides):
+    """ scalars replace, dictionaries are merged one level deep """
+    for k, v in overrides.items():
+        if isinstance(v, dict) and isinstance(values.get(k), dict):
+            values[k] = dict(values[k], **v)
+        else:
+            values[k] = v
+    return values
+
+
+
+def _exec_python(path, text, overrides):
+    """
+    runs the initialization file in a fresh namespace - nothing is imported or added to sys.modules.
+    scalar overrides replace the top level assignments before it runs, so the values derived
+    from them inside the file (COMIN, RUNdir, nems_cfg, ...) follow
+    """
+
+    scalars = dict((k, v) for k, v in overrides.items() if not isinstance(v, dict))
+    tree = ast.parse(text, path)
+    for node in tree.body:
+        if (isinstance(node, ast.Assign) and len(node.targets) == 1 and
+                isinstance(node.targets[0], ast.Name) and node.targets[0].id in scalars):
+            value = ast.parse(repr(scalars[node.targets[0].id]), mode='eval').body
+            node.value = ast.copy_location(value, node.value)
+    ast.fix_missing_locations(tree)
+
+    namespace = {'__file__': path, '__name__': os.path.splitext(os.path.basename(path))[0]}
+    exec(compile(tree, path, 'exec'), namespace)
+
+    values = dict((k, v) for k, v in namespace.items()
+                  if not k.startswith('_') and not isinstance(v, (types.ModuleType, types.FunctionType, type)))
+    # dictionaries, and scalars the file does not assign
+    return _merge(values, dict((k, v) for k, v in overrides.items() if isinstance(v, dict) or k not in values))
+
+
+
+def _read_data(path, text):
+    """ json, toml or yaml initialization file to a dictionary """
+
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.json':
+        return json.loads(text)
+    if ext == '.toml':
+        try:
+            import tomllib as toml
+        except ImportError:
+            try:
+                import toml
+            except ImportError:
+                raise NSEMConfigError(path, ["toml initialization files need python 3.11 or the toml package"])
+        return toml.loads(text)
+    if ext in ('.yaml', '.yml'):
+        try:
+            import yaml
+        except ImportError:
+            raise NSEMConfigError(path, ["yaml initialization files need the pyyaml package"])
+        return yaml.safe_load(text)
+    raise NSEMConfigError(path, ["unknown initialization file type %s" %ext])
+
+
+
+def _derive(values):
+    """ the values nsem_ini.py computes from the others, for data files that only give the base ones """
+
+    v = values
+    storm, run_type = v['STORM'], v['RUN_TYPE']
+    v.setdefault('nems_configure', {'nems_cfg': 'nems.configure.' + run_type})
+    v.setdefault('NWROOT', v['PRJ_DIR'])
+    for var, sub in (('FIXnsem', 'fix'), ('EXECnsem', 'exec'), ('SORCnsem', 'sorc'), ('PARMnsem', 'parm'),
+                     ('USHnsem', 'ush'), ('GESIN', 'nwgs')):
+        v.setdefault(var, os.path.join(v['NWROOT'], sub))
+    v.setdefault('hotstart_cache', os.path.join(v['GESIN'], 'hotstart'))
+    v.setdefault('COMIN', os.path.join(v['COM_DIR'], v['envir'], storm))
+    for var, sub in (('COMINatm', 'atm'), ('COMINwave', 'ww3'), ('COMINwavedata', 'ww3data'),
+                     ('COMINmeshdata', 'atmesh'), ('COMINadc', 'adcirc'), ('COMINnwm', 'nwm')):
+        v.setdefault(var, os.path.join(v['COMIN'], sub))
+    v.setdefault('RUNdir', os.path.join(v['RUN_DIR'], storm + "." + run_type + "." + datetime.datetime.now().strftime("%Y%m%d")))
+    v.setdefault('jlogfile', os.path.join(v['RUN_DIR'], v['envir'], "logs", "jlogfile." + run_type))
+    return v
+
+
+
+REQUIRED = ('STORM', 'RUN_TYPE', 'PRJ_DIR', 'COM_DIR', 'RUN_DIR', 'envir', 'node', 'model',
+            'repository', 'nems', 'model_configure', 'slurm_args')
+MODEL_CONFIGURE = ('start_year', 'start_month', 'start_day', 'start_hour', 'start_minute', 'start_second', 'nhours_fcst')
+NWM_KEYS = ('nwm_data_path', 'domain', 'domain_files', 'restart_files', 'forcing_files',
+            'nudgingTimeSliceObs_files', 'config_files', 'table_files')
+
+
+def _validate(values):
+    """ list of problems, empty if none """
+
+    errors = ["%s is missing" %k for k in REQUIRED if k not in values]
+    if errors:
+        return errors
+
+    if 'valid_runs' in values and values['RUN_TYPE'] not in values['valid_runs']:
+        errors.append("RUN_TYPE %s is not one of valid_runs" %values['RUN_TYPE'])
+
+    mc = values['model_configure']
+    missing = [k for k in MODEL_CONFIGURE if k not in mc]
+    if missing:
+        errors.append("model_configure is missing %s" %", ".join(missing))
+    else:
+        try:
+            datetime.datetime(*[int(mc[k]) for k in MODEL_CONFIGURE[:-1]])
+            if int(mc['nhours_fcst']) <= 0:
+                errors.append("model_configure nhours_fcst must be positive")
+        except (TypeError, ValueError) as err:
+            errors.append("model_configure start date: %s" %err)
+
+    if 'NWM' in values:
+        nwm = values['NWM']
+        missing = [k for k in NWM_KEYS if k not in nwm]
+        if missing:
+            errors.append("NWM is missing %s" %", ".join(missing))
+        else:
+            if not nwm['forcing_files'] or 'yyyymmddhh' not in nwm['forcing_files'][0]:
+                errors.append("NWM forcing_files template must hold yyyymmddhh")
+            if not nwm['nudgingTimeSliceObs_files'] or 'yyyy-mm-dd_hh:mm' not in nwm['nudgingTimeSliceObs_files'][0]:
+                errors.append("NWM nudgingTimeSliceObs_files template must hold yyyy-mm-dd_hh:mm")
+            missing = [k for k in ('hydro', 'restart', 'nudginglastobs') if k not in nwm['restart_files']]
+            if missing:
+                errors.append("NWM restart_files is missing %s" %", ".join(missing))
+    return errors
+
+
+
+def _build(path, digest, values, overrides='{}'):
+
+    errors = _validate(values)
+    if errors:
+        raise NSEMConfigError(path, errors)
+    values = _derive(values)
+
+    mc = values['model_configure']
+    window = RunWindow(datetime.datetime(*[int(mc[k]) for k in MODEL_CONFIGURE[:-1]]), int(mc['nhours_fcst']))
+    com = ComPaths(*[values[f.name] for f in fields(ComPaths)])
+
+    nwm = None
+    if 'NWM' in values:
+        n = values['NWM']
+        nwm = NWMTemplates(n['nwm_data_path'], n['domain'], _freeze(n['domain_files']), _freeze(n['restart_files']),
+                           n['forcing_files'][0], n['nudgingTimeSliceObs_files'][0],
+                           _freeze(n['config_files']), tuple(n['table_files']))
+
+    return NSEMConfig(path, digest, _freeze(values), window, com, nwm, overrides)
+
+
+
+@functools.lru_cache(maxsize=64)
+def _load(path, digest, overrides):
+
+    with open(path, 'r') as fptr:
+        text = fptr.read()
+    if path.endswith('.py'):
+        values = _exec_python(path, text, json.loads(overrides))
+    else:
+        values = _merge(_read_data(path, text) or {}, json.loads(overrides))
+    return _build(path, digest, values, overrides)
+
+
+
+def load(filename, overrides=None):
+    """
+    the config of an initialization file, optionally with some variables replaced
+    (i.e. {'STORM': 'florence', 'model_configure': {'start_hour': '06'}}, dictionaries are merged).
+    the same content and overrides give the same cached object. Raises NSEMConfigError
+    """
+
+    path = os.path.abspath(filename)
+    with open(path, 'rb') as fptr:
+        digest = hashlib.sha256(fptr.read()).hexdigest()
+    return _load(path, digest, json.dumps(overrides or {}, sort_keys=True))
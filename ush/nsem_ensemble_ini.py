@@ -0,0 +1,35 @@
+
+"""
+File Name   : nsem_ensemble_ini.py
+Description : NSEM ensemble file - the storms x run types x members matrix expanded by main.py ensemble.
+              Every member is the initialization file INI evaluated with its STORM, RUN_TYPE and overrides
+Usage       : python main.py ensemble --spec=nsem_ensemble_ini.py [--workers 16] [--state file] [--force]
+Date        : 7/6/2020
+Contacts    : Coastal Act Team 
+              ali.abdolali@noaa.gov, saeed.moghimi@noaa.gov, beheen.m.trimble@gmail.com, andre.vanderwesthuysen@noaa.gov
+"""
+
+INI = "nsem_ini.py"                                                     # base initialization file, next to this file
+
+STORMS = ["matthew", "florence"]                                        # nsem - a.k.a event
+
+RUN_TYPES = ["atm2wav2ocn2hyd", "atm2ocn"]                              # see valid_runs in nsem_ini.py
+
+# member name: overrides of INI variables, dictionaries are merged (i.e. only start_hour changes)
+# members with an empty name run as the plain run type
+MEMBERS = {
+        "m00": {},
+        "m01": {'model_configure': {'start_hour': '06'}},
+        "m02": {'model_configure': {'start_hour': '12'}},
+}
+
+MAX_WORKERS = 8                                                         # members prepared at the same time
+
+STATE_FILE = None                                                       # default: nsem_ensemble_ini.state.json
+
+# the prepared members are submitted as one array job per stage and slurm resources, by one script
+JOBS_DIR = None                                                         # default: nsem_ensemble_ini.jobs
+STAGES = None                                                           # stage order, i.e. ["spinup", "forecast"], of
+                                                                        # the members' STAGE overrides - each stage
+                                                                        # held until the one before it ends
+MAX_RUNNING = None                                                      # array tasks running at once, None for all
@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+
+"""
+File Name   : nsem_forcing.py
+Description : NSEM forcing files preparation for the ATMesh and WW3Data caps - each scenario file is
+              streamed chunk by chunk along time from one or more source files (i.e. forecast cycles),
+              subset to the mesh bounding box, its time axis fixed (sorted, duplicates dropped, one
+              "<units> since <start>" axis) and written as a NEMS ready NetCDF file. Memory is bounded
+              by the chunk size whatever the file size, and scenario files are processed in parallel
+Usage       : import this into an external python source file (i.e. import nsem_forcing as nfc)
+              nfc.merge(['hwrf.2008090600.nc', 'hwrf.2008090606.nc'], '01_IKE_HWRF_OC.nc', bbox=nfc.mesh_bbox('fort.14'))
+              or through main.py: python main.py prep --atmesh --ww3data
+Date        : 7/6/2020
+Contacts    : Coastal Act Team
+              ali.abdolali@noaa.gov, saeed.moghimi@noaa.gov, beheen.m.trimble@gmail.com, andre.vanderwesthuysen@noaa.gov
+"""
+
+# standard libs
+import os, glob, time, datetime
+from concurrent.futures import ProcessPoolExecutor
+
+# third party libs
+import numpy as np
+
+# local libs
+import nsem_utils as nus
+import nsem_ncheader as nch
+
+
+CHUNK_BYTES = 256 * 1024 ** 2          # of one variable read at a time
+FORMAT = 'NETCDF3_64BIT_OFFSET'        # read by every netcdf build of the caps
+MAX_WORKERS = 4
+
+LON_NAMES = ('longitude', 'lon', 'x')
+LAT_NAMES = ('latitude', 'lat', 'y')
+CONNECTIVITY = ('element', 'ele', 'nv', 'tri')
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+class ForcingError(RuntimeError):
+    pass
+
+
+
+def _netcdf4():
+    try:
+        import netCDF4
+    except ImportError:
+        raise ForcingError("preparing forcing files needs the netCDF4 package")
+    return netCDF4
+
+
+
+def mesh_bbox(fort14, margin=0.5):
+    """ (lon_min, lon_max, lat_min, lat_max) of the nodes of a fort.14, widened by margin degrees """
+
+    with open(fort14, 'r') as fptr:
+        fptr.readline()
+        nodes = int(fptr.readline().split()[1])
+        xy = np.loadtxt(fptr, usecols=(1, 2), max_rows=nodes)
+    return (xy[:, 0].min() - margin, xy[:, 0].max() + margin, xy[:, 1].min() - margin, xy[:, 1].max() + margin)
+
+
+
+def _find(ds, names):
+    for n in names:
+        if n in ds.variables:
+            return ds.variables[n]
+    return None
+
+
+
+def _selection(ds, bbox):
+    """
+    {dimension: sorted index array} of the points in bbox - a node dimension (unstructured mesh)
+    is masked, lon/lat dimensions (regular grid) and y/x of 2-d coordinates are cut to a rectangle
+    """
+
+    if bbox is None:
+        return {}
+    lon_var, lat_var = _find(ds, LON_NAMES), _find(ds, LAT_NAMES)
+    if lon_var is None or lat_var is None:
+        raise ForcingError("%s has no longitude/latitude to subset" %ds.filepath())
+
+    lon = np.asarray(lon_var[:], dtype=float); lat = np.asarray(lat_var[:], dtype=float)
+    lon = np.where(lon > 180.0, lon - 360.0, lon) if bbox[0] < 0 else lon
+    in_lon = (lon >= bbox[0]) & (lon <= bbox[1]); in_lat = (lat >= bbox[2]) & (lat <= bbox[3])
+
+    if lon_var.dimensions == lat_var.dimensions and lon_var.ndim == 1:
+        sel = {lon_var.dimensions[0]: np.nonzero(in_lon & in_lat)[0]}
+    elif lon_var.ndim == 1:
+        sel = {lon_var.dimensions[0]: np.nonzero(in_lon)[0], lat_var.dimensions[0]: np.nonzero(in_lat)[0]}
+    else:
+        rows, cols = np.nonzero(in_lon & in_lat)
+        sel = dict((d, np.arange(idx.min(), idx.max() + 1) if idx.size else idx)
+                   for d, idx in zip(lon_var.dimensions, (rows, cols)))
+    for d, idx in sel.items():
+        if not idx.size:
+            raise ForcingError("%s has no point in %s" %(ds.filepath(), bbox))
+    return sel
+
+
+
+def _connectivity(ds, sel):
+    """
+    element connectivity of an unstructured mesh subset by a node selection: (variable name, lookup)
+    with the elements having all their nodes kept added to sel, lookup maps old to new node numbers.
+    None if the file has no connectivity or its nodes are not subset
+    """
+
+    var = _find(ds, CONNECTIVITY)
+    node_dims = [d for d in sel if d not in var.dimensions] if var is not None else []
+    if var is None or var.ndim != 2 or len(node_dims) != 1:
+        return None
+
+    start = int(var.getncattr('start_index')) if 'start_index' in var.ncattrs() else 1
+    nodes = sel[node_dims[0]]
+    conn = np.asarray(var[:]) - start
+    lookup = np.full(len(ds.dimensions[node_dims[0]]), -1)
+    lookup[nodes] = np.arange(nodes.size)
+    sel[var.dimensions[0]] = np.nonzero((lookup[conn] >= 0).all(axis=1))[0]
+    return var.name, lookup, start
+
+
+
+def _read(var, sel, records=None, time_dim=None):
+    """ var subset by sel (and records along time_dim) - one contiguous read per variable, then numpy picks """
+
+    slices = []; picks = []
+    for d in var.dimensions:
+        idx = records if d == time_dim else sel.get(d)
+        if idx is None:
+            slices.append(slice(None)); picks.append(None)
+        else:
+            lo, hi = int(idx.min()), int(idx.max())
+            slices.append(slice(lo, hi + 1)); picks.append(idx - lo)
+    data = var[tuple(slices)]
+    for axis, pick in enumerate(picks):
+        if pick is not None and not np.array_equal(pick, np.arange(data.shape[axis])):
+            data = np.take(data, pick, axis=axis)
+    return data
+
+
+
+def _records(datasets, time_name, start=None, end=None):
+    """
+    (source index, record index, seconds since 1970) of every output record - sorted, one per time
+    (the latest source wins, i.e. the newest forecast cycle) and within [start, end] if given
+    """
+
+    src = []; rec = []; sec = []
+    for k, ds in enumerate(datasets):
+        var = ds.variables[time_name]
+        factor, base = nch.time_units(var.units)
+        values = np.asarray(var[:], dtype=float) * factor + (base - EPOCH).total_seconds()
+        src.append(np.full(values.size, k)); rec.append(np.arange(values.size)); sec.append(values)
+    src, rec, sec = np.concatenate(src), np.concatenate(rec), np.concatenate(sec)
+
+    order = np.lexsort((-src, np.round(sec, 3)))
+    src, rec, sec = src[order], rec[order], sec[order]
+    keep = np.ones(sec.size, dtype=bool)
+    keep[1:] = np.round(sec[1:], 3) != np.round(sec[:-1], 3)
+    if start is not None:
+        keep &= sec >= (start - EPOCH).total_seconds()
+    if end is not None:
+        keep &= sec <= (end - EPOCH).total_seconds()
+    return src[keep], rec[keep], sec[keep]
+
+
+
+def merge(sources, dest, bbox=None, base=None, units='hours', start=None, end=None,
+          chunk_bytes=CHUNK_BYTES, fmt=FORMAT, time_name='time'):
+    """
+    one NEMS ready forcing file dest from sources (same variables and grid, i.e. forecast cycles):
+    subset to bbox, records sorted by time with duplicates dropped, within [start, end], time in
+    "<units> since <base>" (the first record if no base). dest is written under a temporary name
+    and renamed when complete. returns {'records', 'points', 'bytes', 'seconds'}
+    """
+
+    netCDF4 = _netcdf4()
+    t0 = time.time()
+    datasets = [netCDF4.Dataset(s) for s in sources]
+    tmp = "%s.%d.tmp" %(dest, os.getpid())
+    try:
+        first = datasets[0]
+        if time_name not in first.variables:
+            raise ForcingError("%s has no %s variable" %(sources[0], time_name))
+        time_dim = first.variables[time_name].dimensions[0]
+        src, rec, sec = _records(datasets, time_name, start, end)
+        if not sec.size:
+            raise ForcingError("no record of %s between %s and %s" %(dest, start, end))
+
+        base = base or EPOCH + datetime.timedelta(seconds=float(sec[0]))
+        factor = nch.UNIT_SECONDS[units.rstrip('s')]
+        sel = _selection(first, bbox)
+        points = int(np.prod([len(i) for i in sel.values()])) if sel else None
+        conn = _connectivity(first, sel)
+
+        with netCDF4.Dataset(tmp, 'w', format=fmt) as out:
+            out.setncatts(dict((a, first.getncattr(a)) for a in first.ncattrs()))
+            for name, dim in first.dimensions.items():
+                out.createDimension(name, None if name == time_dim else
+                                    len(sel[name]) if name in sel else len(dim))
+
+            for name, var in first.variables.items():
+                attrs = dict((a, var.getncattr(a)) for a in var.ncattrs() if a != '_FillValue')
+                fill = var.getncattr('_FillValue') if '_FillValue' in var.ncattrs() else None
+                ovar = out.createVariable(name, var.dtype, var.dimensions, fill_value=fill)
+                if name == time_name:
+                    attrs['units'] = "%s since %s" %(units, base.strftime('%Y-%m-%d %H:%M:%S'))
+                ovar.setncatts(attrs)
+
+            # time axis
+            out.variables[time_name][:] = (sec - (base - EPOCH).total_seconds()) / factor
+
+            for name, var in first.variables.items():
+                if name == time_name:
+                    continue
+                ovar = out.variables[name]
+                var.set_auto_mask(False)
+
+                if time_dim not in var.dimensions:
+                    data = _read(var, sel)
+                    if conn and name == conn[0]:
+                        lookup, start = conn[1], conn[2]
+                        data = lookup[data - start] + start
+                    ovar[:] = data
+                    continue
+
+                # streamed along time, chunk records at a time
+                record_bytes = var.dtype.itemsize * int(np.prod([len(sel[d]) if d in sel else len(first.dimensions[d])
+                                                                 for d in var.dimensions if d != time_dim]))
+                chunk = max(1, int(chunk_bytes // max(1, record_bytes)))
+                for o0 in range(0, sec.size, chunk):
+                    o1 = min(sec.size, o0 + chunk)
+                    axis = var.dimensions.index(time_dim)
+                    parts = []
+                    for k in np.unique(src[o0:o1]):
+                        mask = src[o0:o1] == k
+                        svar = datasets[k].variables[name]
+                        svar.set_auto_mask(False)
+                        parts.append((np.nonzero(mask)[0], _read(svar, sel, rec[o0:o1][mask], time_dim)))
+                    if len(parts) == 1:
+                        data = parts[0][1]
+                    else:
+                        shape = list(parts[0][1].shape); shape[axis] = o1 - o0
+                        data = np.empty(shape, dtype=var.dtype)
+                        for where, part in parts:
+                            index = [slice(None)] * data.ndim; index[axis] = where
+                            data[tuple(index)] = part
+                    index = [slice(None)] * ovar.ndim; index[axis] = slice(o0, o1)
+                    ovar[tuple(index)] = data
+
+        os.replace(tmp, dest)
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    finally:
+        for ds in datasets:
+            ds.close()
+
+    return {'records': int(sec.size), 'points': points, 'bytes': os.path.getsize(dest), 'seconds': time.time() - t0}
+
+
+
+def _merge_job(job):
+    """ merge of one scenario in a worker process, exceptions returned not raised """
+
+    sources, dest, kwargs = job
+    try:
+        return dest, merge(sources, dest, **kwargs), None
+    except Exception as err:
+        return dest, None, "%s: %s" %(type(err).__name__, err)
+
+
+
+def merge_many(jobs, workers=MAX_WORKERS, **kwargs):
+    """
+    jobs: {dest: [sources]} merged in parallel processes (HDF5 is not thread safe), kwargs as merge.
+    returns (done {dest: merge result}, failed {dest: error})
+    """
+
+    done = {}; failed = {}
+    todo = [(sources, dest, kwargs) for dest, sources in jobs.items()]
+    with ProcessPoolExecutor(max_workers=max(1, min(workers, len(todo)))) as pool:
+        for dest, result, error in pool.map(_merge_job, todo):
+            if error:
+                failed[dest] = error
+                print(nus.colory("red", "Error preparing %s - %s" %(dest, error)))
+            else:
+                done[dest] = result
+                print("Prepared %s: %d record(s), %.1f MB in %.1f seconds"
+                      %(dest, result['records'], result['bytes'] / 1048576., result['seconds']))
+    return done, failed
+
+
+
+def scenario_jobs(files, source_dir, dest_dir):
+    """
+    {dest: [sources]} of a scenario mapping {output name: source name, glob or list of them}
+    (see ATMESH and WW3DATA in nsem_ini.py), sources relative to source_dir
+    """
+
+    jobs = {}
+    for name, patterns in files.items():
+        patterns = [patterns] if isinstance(patterns, str) else patterns
+        sources = []
+        for pattern in patterns:
+            found = sorted(glob.glob(os.path.join(source_dir, pattern)))
+            if not found:
+                raise ForcingError("no source file %s in %s for %s" %(pattern, source_dir, name))
+            sources += found
+        jobs[os.path.join(dest_dir, name)] = sources
+    return jobs
+
@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+
+"""
+File Name   : nsem_hotstart.py
+Description : NSEM hotstart cache - ADCIRC hotstart files (fort.67.nc/fort.68.nc) kept under GESIN and indexed
+              by mesh, tidal constituent set, cold start date and model time reached, all read from the
+              NetCDF header. A run starting at a date a spin-up already reached gets the hotstart reflinked
+              or hardlinked into its directory instead of copied, so a spun-up mesh is never spun up again.
+              Entries are evicted by age and a size quota, least recently used first
+Usage       : import this into an external python source file (i.e. import nsem_hotstart as nhs)
+              cache = nhs.HotstartCache(ini.hotstart_cache); entry = cache.find(mesh, constituents, start_date)
+              or standalone: python nsem_hotstart.py <cache dir> list|store|evict ...
+Date        : 7/6/2020
+Contacts    : Coastal Act Team
+              ali.abdolali@noaa.gov, saeed.moghimi@noaa.gov, beheen.m.trimble@gmail.com, andre.vanderwesthuysen@noaa.gov
+"""
+
+# standard libs
+import os, re, sys, json, time, fcntl, hashlib, datetime
+import shutil, argparse
+from contextlib import contextmanager
+
+# local libs
+import nsem_utils as nus
+import nsem_install as nin
+import nsem_ncheader as nch
+
+
+INDEX = "index.json"
+LOCK = ".lock"
+HOTSTART_FILES = ('fort.67.nc', 'fort.68.nc')
+IHOT = {'fort.67.nc': 567, 'fort.68.nc': 568}         # fort.15 IHOT reading each file
+TOLERANCE = 60.0                                      # seconds between a hotstart time and a wanted date
+
+def mesh_key(fort14):
+    """ grid title and node count of a fort.14, what ADCIRC writes to the agrid attribute and node dimension """
+
+    with open(fort14, 'r') as fptr:
+        title = fptr.readline().strip()
+        nodes = int(fptr.readline().split()[1])
+    return "%s:%d" %(title, nodes)
+
+
+
+def fort15_constituents(fort15):
+    """
+    sorted tuple of the tidal potential (NTIF) and boundary (NBFR) constituent names of a fort.15
+    or fort.15 template - found by their comments, as in the NSEM templates. None if there are none
+    """
+
+    with open(fort15, 'r') as fptr:
+        lines = fptr.readlines()
+
+    names = set()
+    for i, line in enumerate(lines):
+        comment = line.split('!', 1)[1] if '!' in line else ''
+        if not re.search(r'\b(NTIF|NBFR)\b', comment, re.I):
+            continue
+        try:
+            count = int(line.split()[0])
+        except (ValueError, IndexError):
+            continue                                  # placeholder or not a count line
+        # NTIF: name, then potential parameters; NBFR: name, then frequency parameters
+        names.update(lines[i + 1 + 2 * k].split()[0].upper() for k in range(count) if i + 1 + 2 * k < len(lines))
+    return tuple(sorted(names)) or None
+
+
+
+def hotstart_info(path):
+    """ {'mesh', 'cold_start', 'time'} of a hotstart, time in seconds since the cold start, from its header """
+
+    hdr = nch.read(path)
+    title = str(hdr.attrs.get('agrid', '')).strip()
+    nodes = hdr.dims.get('node')
+    if nodes is None:
+        raise nch.NCHeaderError("%s has no node dimension, not an ADCIRC hotstart" %path)
+
+    time_var = hdr.variables.get('time')
+    cold_start = nch.parse_date(hdr.attrs.get('base_date')) or nch.parse_date(time_var.attrs.get('units') if time_var else None)
+    if cold_start is None:
+        raise nch.NCHeaderError("%s has no base_date, the cold start date is unknown" %path)
+
+    seconds = nch.first_value(path, 'time', hdr)
+    if seconds is None:
+        raise nch.NCHeaderError("%s has no model time" %path)
+    return {'mesh': "%s:%d" %(title, nodes), 'cold_start': cold_start, 'time': float(seconds)}
+
+
+
+def staged(run_dir, hot_date, tolerance=TOLERANCE):
+    """
+    name of the hotstart already in run_dir (i.e. left there by its spin-up) to start from at hot_date:
+    the one whose header reaches hot_date, else the first found. None if run_dir holds none
+    """
+
+    names = [f for f in HOTSTART_FILES if os.path.exists(os.path.join(run_dir, f))]
+    for name in names:
+        try:
+            info = hotstart_info(os.path.join(run_dir, name))
+        except (OSError, nch.NCHeaderError):
+            continue
+        reached = info['cold_start'] + datetime.timedelta(seconds=info['time'])
+        if abs((reached - hot_date).total_seconds()) <= tolerance:
+            return name
+    return names[0] if names else None
+
+
+
+class HotstartCache():
+
+    """
+    <root>/<id>/<fort.67.nc|fort.68.nc>   one hotstart per entry, read-only
+    <root>/index.json                    {id: {'mesh', 'constituents', 'cold_start', 'time', 'hot_date',
+                                               'file', 'size', 'stored', 'used'}}
+    """
+
+    def __init__(self, root, max_bytes=None, max_age_days=None):
+
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age_days = max_age_days
+        os.makedirs(root, exist_ok=True)
+
+
+    @contextmanager
+    def _locked(self):
+        """ the index, read and written under an exclusive lock - many preps share a cache """
+
+        with open(os.path.join(self.root, LOCK), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                index = self.entries()
+                yield index
+                nus.write_atomic(os.path.join(self.root, INDEX), json.dumps(index, indent=1, sort_keys=True))
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+    def entries(self):
+        try:
+            with open(os.path.join(self.root, INDEX), 'r') as fptr:
+                return json.load(fptr)
+        except (OSError, ValueError):
+            return {}
+
+
+    def path(self, entry):
+        return os.path.join(self.root, entry['file'])
+
+
+    # ---------------------------------------------------------- store and find
+
+    def store(self, path, constituents, mesh=None):
+        """
+        adds the hotstart at path, constituents: names forced in the run (see fort15_constituents).
+        mesh, cold start and model time come from the header, mesh may be given (see mesh_key).
+        returns the entry id, an entry already stored is kept
+        """
+
+        info = hotstart_info(path)
+        mesh = mesh or info['mesh']
+        constituents = sorted(c.upper() for c in constituents)
+        cold_start = info['cold_start'].strftime('%Y-%m-%d %H:%M:%S')
+        key = hashlib.sha256(json.dumps([mesh, constituents, cold_start, info['time']]).encode()).hexdigest()[:16]
+        hot_date = info['cold_start'] + datetime.timedelta(seconds=info['time'])
+
+        name = os.path.basename(path)
+        entry_dir = os.path.join(self.root, key)
+        if key in self.entries() and os.path.exists(os.path.join(entry_dir, name)):
+            return key
+
+        tmp = os.path.join(self.root, ".%s.%d" %(key, os.getpid()))
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        try:
+            nin.link_file(path, os.path.join(tmp, name), link=False)     # the run may write it again
+            os.chmod(os.path.join(tmp, name), 0o444)                 # hardlinked into runs, never written
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            os.rename(tmp, entry_dir)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+
+        now = time.time()
+        with self._locked() as index:
+            index[key] = {'mesh': mesh, 'constituents': constituents, 'cold_start': cold_start,
+                          'time': info['time'], 'hot_date': hot_date.strftime('%Y-%m-%d %H:%M:%S'),
+                          'file': os.path.join(key, name), 'size': os.path.getsize(path),
+                          'stored': now, 'used': now}
+        print("Stored hotstart %s (%s, %.2f days after %s) as %s" %(path, mesh, info['time'] / 86400., cold_start, key))
+        self.evict()
+        return key
+
+
+    def store_run(self, run_dir, constituents, mesh=None):
+        """ stores the hotstarts a run wrote, returns their entry ids """
+
+        return [self.store(os.path.join(run_dir, f), constituents, mesh)
+                for f in HOTSTART_FILES if os.path.exists(os.path.join(run_dir, f))]
+
+
+    def find(self, mesh, constituents, hot_date, min_spinup_days=0.0, tolerance=TOLERANCE):
+        """
+        the entry (dict with its 'id') of a hotstart of mesh with the same constituents reaching
+        hot_date after at least min_spinup_days, the longest spun-up one if many. None if there is none
+        """
+
+        constituents = sorted(c.upper() for c in constituents)
+        best = None
+        for key, e in self.entries().items():
+            if e['mesh'] != mesh or e['constituents'] != constituents:
+                continue
+            if abs((nus.to_date(e['hot_date'], frmt=1) - hot_date).total_seconds()) > tolerance:
+                continue
+            if e['time'] < min_spinup_days * 86400. or not os.path.exists(self.path(e)):
+                continue
+            if best is None or e['time'] > best['time']:
+                best = dict(e, id=key)
+        return best
+
+
+    def install(self, entry, run_dir, name=None, link=True):
+        """
+        the hotstart of entry into run_dir as name (its own name by default) - reflinked, else hardlinked
+        if link (only for runs that do not write hotstarts, the cached file is read-only), else copied.
+        returns the fort.15 IHOT value reading it
+        """
+
+        name = name or os.path.basename(entry['file'])
+        dest = os.path.join(run_dir, name)
+        os.makedirs(run_dir, exist_ok=True)
+        method = nin.link_file(self.path(entry), dest, link=link)
+        if method != 'hardlink':
+            os.chmod(dest, 0o644)
+        with self._locked() as index:
+            if entry['id'] in index:
+                index[entry['id']]['used'] = time.time()
+        print("Hotstart %s (%s) into %s, %s" %(entry['id'], entry['hot_date'], dest, method))
+        return IHOT.get(name, 567)
+
+
+    # ---------------------------------------------------------- eviction
+
+    def evict(self, max_bytes=None, max_age_days=None):
+        """ drops entries unused for more than max_age_days, then the least recently used ones
+            until the cache holds at most max_bytes. returns the dropped ids """
+
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        max_age_days = self.max_age_days if max_age_days is None else max_age_days
+        dropped = []
+        with self._locked() as index:
+            now = time.time()
+            for key, e in sorted(index.items(), key=lambda ke: ke[1]['used']):
+                total = sum(x['size'] for x in index.values())
+                missing = not os.path.exists(self.path(e))
+                too_old = max_age_days is not None and now - e['used'] > max_age_days * 86400.
+                too_big = max_bytes is not None and total > max_bytes
+                if missing or too_old or too_big:
+                    shutil.rmtree(os.path.join(self.root, key), ignore_errors=True)
+                    del index[key]
+                    dropped.append(key)
+        for key in dropped:
+            print("Removed hotstart %s from cache" %key)
+        return dropped
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="ADCIRC hotstart cache")
+    parser.add_argument("cache", help="cache directory, i.e. $GESIN/hotstart")
+    sub = parser.add_subparsers(dest='command')
+    sub.add_parser("list", help="lists the cached hotstarts")
+    store = sub.add_parser("store", help="stores hotstart files")
+    store.add_argument("files", nargs='+')
+    store.add_argument("--fort15", required=True, help="fort.15 of the run, for its constituents")
+    store.add_argument("--fort14", help="fort.14 of the run, the mesh from the hotstart header if not given")
+    evict = sub.add_parser("evict", help="drops old entries and the least recently used above a quota")
+    evict.add_argument("--max-gb", type=float)
+    evict.add_argument("--max-age-days", type=float)
+    args = parser.parse_args()
+
+    cache = HotstartCache(args.cache)
+    if args.command == 'store':
+        constituents = fort15_constituents(args.fort15)
+        if not constituents:
+            print(nus.colory("red", "No tidal constituents found in %s" %args.fort15))
+            sys.exit(1)
+        mesh = mesh_key(args.fort14) if args.fort14 else None
+        for f in args.files:
+            cache.store(f, constituents, mesh)
+    elif args.command == 'evict':
+        cache.evict(args.max_gb * 1024 ** 3 if args.max_gb else None, args.max_age_days)
+    else:
+        for key, e in sorted(cache.entries().items(), key=lambda ke: ke[1]['hot_date']):
+            print("%s  %s  %s -> %s (%6.2f days)  %s  %.1f MB" %(key, e['mesh'], e['cold_start'], e['hot_date'],
+                  e['time'] / 86400., " ".join(e['constituents']), e['size'] / 1048576.))
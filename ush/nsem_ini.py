@@ -21,6 +21,8 @@ RUN_DIR = "/scratch2/COASTAL/coastal/scrub/nsem_run"                    # nsem,
 repository = "https://github.com/moghimis/ADC-WW3-NWM-NEMS"             # nsem models + NEMS
 compile_flag = 0                                                        # 1 to compile the nsem code, 0 not to compile
 git_flag = 0                                                            # 1 to git NSEM code from repo, 0 not to git
+build_cache = None                                                      # i.e. os.path.join(COM_DIR, "nems_build_cache") to keep NEMS.x + component installs by source hash
+build_jobs = 0                                                          # serial build.sh, or make jobs shared by the components compiled at once (i.e. 16)
 
 
 slurm_args = {								# slurm
@@ -120,11 +122,49 @@ NWM = {
         #
         'config_files' : {'namelist': 'namelist.hrldas', 'hydro': 'hydro.namelist'},                     # preprocess in nwm data dir
         #
+        # templates of config_files in nco parm dir, written per run with its start, length, restart and
+        # forcing names (see nsem_namelist.py). None copies the pre-made config_files instead
+        'namelist_templates': {'namelist': 'nwm_namelist.hrldas', 'hydro': 'nwm_hydro.namelist'},
+        #
         'table_files'  : ['CHANPARM.TBL', 'GENPARM.TBL', 'HYDRO.TBL', 'MPTABLE.TBL', 'SOILPARM.TBL'],    # preprocess in nwm data dir
         #
-        'nudgingTimeSliceObs_files': ['yyyy-mm-dd_hh:mm:00.15min.usgsTimeSlice.ncdf']
+        'nudgingTimeSliceObs_files': ['yyyy-mm-dd_hh:mm:00.15min.usgsTimeSlice.ncdf'],
+        #
+        'fill_max_hours': 0,        # forcing/time slice gaps up to this long linked to the nearest time, 0 reports them only
         #
       }
+
+
+WW3 = {
+        'grids'        : ['inlet', 'points'],       # mod_def.<grid> per ww3_multi grid, inputs in fix/meshes/<storm>/wav[/<grid>]
+        'boundary'     : None,                      # grid fed by ww3_bound from COMINwave *.spc (i.e. 'inlet'), None for no spectral boundary
+        'cache'        : os.path.join(COM_DIR, "ww3_prep_cache"),     # mod_def and nest files by input hash, linked into runs
+      }
+
+
+FORCING = {
+        'bbox'         : None,                      # (lon_min, lon_max, lat_min, lat_max), None for fix/meshes/<storm>/ocn/fort.14 extent
+        'margin'       : 0.5,                       # degrees around the mesh extent
+        'time_units'   : 'hours',                   # time axis of the prepared files: <units> since their first record
+        'chunk_mb'     : 256,                       # of one variable in memory at a time
+        'workers'      : 4,                         # scenario files prepared at the same time
+        # output file in COMINmeshdata: source file(s) in COMINatm - a name, glob or list (i.e. forecast cycles)
+        'atmesh'       : {'01_IKE_HWRF_OC.nc': '01_IKE_HWRF_OC.nc',
+                          '02_IKE_HWRF_OC_SM.nc': '02_IKE_HWRF_OC_SM.nc',
+                          '03_IKE_WRF.nc': '03_IKE_WRF.nc',
+                          '04_IKE_HWRF_OC_WRF.nc': '04_IKE_HWRF_OC_WRF.nc',
+                          '05_IKE_HWRF_OC_DA_HSOFS_orig.nc': '05_IKE_HWRF_OC_DA_HSOFS_orig.nc',
+                          '06_IKE_HWRF_OC_DA_HSOFS_Smoothing.nc': '06_IKE_HWRF_OC_DA_HSOFS_Smoothing.nc',
+                          '07_IKE_HWRF_OC_DA_WRF_SM.nc': '07_IKE_HWRF_OC_DA_WRF_SM.nc'},
+        # output file in COMINwavedata: source file(s) in COMINwave
+        'ww3data'      : {'01_ww3.test1.2008_sxy_OC.nc': '01_ww3.test1.2008_sxy_OC.nc',
+                          '02_ww3.test2.2008_sxy_OC_SM.nc': '02_ww3.test2.2008_sxy_OC_SM.nc',
+                          '03_ww3.test3.2008_sxy_WRF.nc': '03_ww3.test3.2008_sxy_WRF.nc',
+                          '04_ww3.test4.2008_sxy_OC_WRF.nc': '04_ww3.test4.2008_sxy_OC_WRF.nc',
+                          '05_ww3.test5.2008_sxy_OC_DA_HSOFS_orig.nc': '05_ww3.test5.2008_sxy_OC_DA_HSOFS_orig.nc',
+                          '06_ww3.test6.2008_sxy_OC_DA_HSOFS_Smoothing.nc': '06_ww3.test6.2008_sxy_OC_DA_HSOFS_Smoothing.nc',
+                          '07_ww3.test7.2008_sxy_OC_DA_WRF_SM.nc': '07_ww3.test7.2008_sxy_OC_DA_WRF_SM.nc'},
+      }
                                                                    
 
 # Enviroment vars from ecFlow scripting                                         # nco
@@ -135,6 +175,9 @@ SORCnsem = os.path.join(NWROOT,"sorc")
 PARMnsem = os.path.join(NWROOT,"parm")
 USHnsem = os.path.join(NWROOT,"ush")
 GESIN = os.path.join(NWROOT,"nwgs")
+hotstart_cache = os.path.join(GESIN,"hotstart")                                 # spun-up fort.67/68.nc by mesh, constituents and date
+hotstart_quota_gb = 500                                                         # hotstart cache size, least recently used dropped above
+hotstart_max_age_days = 180                                                     # hotstarts unused longer are dropped
 #
 COMIN = os.path.join(COM_DIR,envir,STORM)
 COMINatm = os.path.join(COMIN,"atm")
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+
+"""
+File Name   : nsem_install.py
+Description : NSEM incremental file installer - copies model input files in-process, records a manifest
+              of what was installed in the destination directory and skips unchanged files on re-runs
+Usage       : import this into an external python source file (i.e. import nsem_install as nin)
+Date        : 7/6/2020
+Contacts    : Coastal Act Team
+              ali.abdolali@noaa.gov, saeed.moghimi@noaa.gov, beheen.m.trimble@gmail.com, andre.vanderwesthuysen@noaa.gov
+"""
+
+# standard libs
+import os, json, fcntl, hashlib
+import shutil, tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+# local libs
+import nsem_utils as nus
+
+
+MANIFEST = ".nsem_install.json"
+MAX_WORKERS = 8
+FICLONE = 0x40049409              # linux ioctl, copy-on-write clone (btrfs, xfs)
+
+
+def file_hash(path, blocksize=1048576):
+    """ sha256 of a file content """
+
+    h = hashlib.sha256()
+    with open(path, 'rb') as fptr:
+        for block in iter(lambda: fptr.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+
+class Manifest():
+
+    """ record of installed files, kept as json in the destination directory:
+        {dest_name: {'source': path, 'size': bytes, 'mtime': seconds, 'sha256': hex or None}} """
+
+    def __init__(self, dest_dir, name=MANIFEST):
+
+        self.path = os.path.join(dest_dir, name)
+        self.entries = {}
+        try:
+            with open(self.path, 'r') as fptr:
+                self.entries = json.load(fptr)
+        except (OSError, ValueError):
+            self.entries = {}     # first install or unreadable manifest, install everything
+
+
+    def record(self, name, source, st, digest=None):
+        self.entries[name] = {'source': source, 'size': st.st_size,
+                              'mtime': st.st_mtime, 'sha256': digest}
+
+
+    def is_current(self, name, source, st, dest, use_hash=False):
+        """ True if dest was installed from source and neither changed since """
+
+        e = self.entries.get(name)
+        if not e or e['source'] != source:
+            return False
+        try:
+            if os.path.getsize(dest) != st.st_size:
+                return False
+        except OSError:
+            return False
+        if e['size'] != st.st_size:
+            return False
+        if e['mtime'] == st.st_mtime:
+            return True
+        # touched but maybe not changed, the hash decides
+        return bool(use_hash and e['sha256'] and e['sha256'] == file_hash(source))
+
+
+    def save(self):
+        """ atomic write - a killed install never leaves a half written manifest """
+        nus.write_atomic(self.path, json.dumps(self.entries, indent=1, sort_keys=True))
+
+
+
+def copy_file(source, dest):
+    """ in-process copy into a temporary file renamed over dest, shutil.copyfile uses
+        sendfile on linux so the data does not pass through python """
+
+    fd, tmp = tempfile.mkstemp(prefix="." + os.path.basename(dest) + ".", dir=os.path.dirname(dest))
+    os.close(fd)
+    try:
+        shutil.copyfile(source, tmp)
+        shutil.copymode(source, tmp)
+        os.replace(tmp, dest)
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+
+def install_files(sources, dest_dir, use_hash=False, workers=MAX_WORKERS, manifest=MANIFEST):
+    """
+    copies each file in sources into dest_dir, unless the manifest shows it is already there.
+    sources:  iterable of full path file names, installed under their base name
+    use_hash: also records sha256 so a touched but unchanged source is not copied again
+    returns (copied, skipped, failed) lists of base names
+    """
+
+    os.makedirs(dest_dir, exist_ok=True)
+    mf = Manifest(dest_dir, manifest)
+    copied = []; skipped = []; failed = []
+
+    todo = []; dirty = False
+    for source in sources:
+        name = os.path.basename(source)
+        dest = os.path.join(dest_dir, name)
+        try:
+            st = os.stat(source)
+        except OSError as err:
+            print(nus.colory("red", "Error installing file %s: %s" %(source, err)))
+            failed.append(name)
+            continue
+        if mf.is_current(name, source, st, dest, use_hash):
+            skipped.append(name)
+            if mf.entries[name]['mtime'] != st.st_mtime:
+                # unchanged content, remember the new mtime to skip hashing next time
+                mf.record(name, source, st, mf.entries[name]['sha256'])
+                dirty = True
+        else:
+            todo.append((name, source, dest, st))
+
+    def install(job):
+        name, source, dest, st = job
+        print("Copying file %s" %source)
+        copy_file(source, dest)
+        return file_hash(source) if use_hash else None
+
+    if todo:
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(todo)))) as pool:
+            futures = [(job, pool.submit(install, job)) for job in todo]
+            for job, future in futures:
+                name, source, dest, st = job
+                try:
+                    digest = future.result()
+                except OSError as err:
+                    print(nus.colory("red", "Error copying file %s: %s" %(source, err)))
+                    failed.append(name)
+                    continue
+                mf.record(name, source, st, digest)
+                copied.append(name)
+                dirty = True
+
+    if dirty:
+        mf.save()
+
+    if skipped:
+        print("%d file(s) unchanged since last install, skipped" %len(skipped))
+    return copied, skipped, failed
+
+
+
+def link_dir(source, dest):
+    """ symbolic link dest -> source, an existing link to another source is replaced """
+
+    if os.path.islink(dest):
+        if os.readlink(dest) == source:
+            print("Link already exists to %s" %dest)
+            return
+        os.remove(dest)
+    print("Creating link to %s" %dest)
+    os.symlink(source, dest)
+
+
+
+def link_file(source, dest, link=True):
+    """
+    dest as a copy-on-write clone of source, else a hardlink (if link), else a copy.
+    returns 'reflink', 'hardlink' or 'copy'
+    """
+
+    if link and os.path.exists(dest) and os.path.samefile(source, dest):
+        return 'hardlink'                 # already linked, a rename over the same file does nothing
+
+    tmp ="%s.%d.tmp" %(dest, os.getpid())
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    try:
+        with open(source, 'rb') as src, open(tmp, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        method = 'reflink'
+    except OSError:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        try:
+            if not link:
+                raise OSError("hardlink not wanted")
+            os.link(source, tmp)
+            method = 'hardlink'
+        except OSError:
+            copy_file(source, tmp)
+            method = 'copy'
+    os.replace(tmp, dest)
+    return method
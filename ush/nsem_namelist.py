@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+
+"""
+File Name   : nsem_namelist.py
+Description : Fortran namelist reader/writer - a namelist file (i.e. parm/nwm_namelist.hrldas, parm/nwm_hydro.namelist)
+              parsed once into groups of typed values, with its comments and layout kept, so per-run overrides
+              (start time, KHOUR, restart and forcing names, ...) are applied to a copy and written back as a
+              valid namelist that differs from the template only in the overridden values. Many runs are
+              written from one parse, and a file is only rewritten when its content changes
+Usage       : import this into an external python source file (i.e. import nsem_namelist as nnl)
+              nml = nnl.load("parm/nwm_namelist.hrldas").copy(); nml.set('NOAHLSM_OFFLINE', 'KHOUR', 240)
+              nml.write("run/namelist.hrldas"); nnl.write_many(template, {dest: {group: {key: value}}})
+              or standalone: python nsem_namelist.py <namelist> [group.key=value ...] [-o output]
+Date        : 7/6/2020
+Contacts    : Coastal Act Team
+              ali.abdolali@noaa.gov, saeed.moghimi@noaa.gov, beheen.m.trimble@gmail.com, andre.vanderwesthuysen@noaa.gov
+"""
+
+# standard libs
+import os, re, copy, argparse, functools
+from collections import OrderedDict
+
+# local libs
+import nsem_utils as nus
+
+
+_GROUP = re.compile(r'^\s*&(\w+)\s*(?:!.*)?$')
+_END = re.compile(r'^\s*/\s*(?:!.*)?$')
+_ITEM = re.compile(r'^(\s*([A-Za-z_]\w*(?:\(\s*\d+(?:\s*,\s*\d+)*\s*\))?)\s*=\s*)(.*)$')
+_INT = re.compile(r'^[+-]?\d+$')
+_FLOAT = re.compile(r'^[+-]?(\d+\.?\d*|\.\d+)([eEdD][+-]?\d+)?$')
+
+
+class NamelistError(ValueError):
+    pass
+
+
+
+def _split_comment(text):
+    """ (value, trailing blanks and comment) of the text after '=', a '!' inside quotes is not a comment """
+
+    quote = None
+    for i, c in enumerate(text):
+        if quote:
+            if c == quote:
+                quote = None
+        elif c in "'\"":
+            quote = c
+        elif c == '!':
+            value = text[:i].rstrip()
+            return value, text[len(value):]
+    value = text.rstrip()
+    return value, text[len(value):]
+
+
+
+def _split_values(text):
+    """ comma separated values, commas inside quotes kept """
+
+    parts = []; quote = None; start = 0
+    for i, c in enumerate(text):
+        if quote:
+            if c == quote:
+                quote = None
+        elif c in "'\"":
+            quote = c
+        elif c == ',':
+            parts.append(text[start:i].strip())
+            start = i + 1
+    parts.append(text[start:].strip())
+    return [p for p in parts if p != ''] or ['']
+
+
+
+def parse_value(text):
+    """ python value of a namelist value: str, bool, int, float or a list of them """
+
+    parts = _split_values(text)
+    if len(parts) > 1:
+        return [parse_value(p) for p in parts]
+
+    t = parts[0]
+    if len(t) >= 2 and t[0] == t[-1] and t[0] in "'\"":
+        return t[1:-1].replace(t[0] * 2, t[0])
+    if re.match(r'^\.?(t|true)\.?$', t, re.I):
+        return True
+    if re.match(r'^\.?(f|false)\.?$', t, re.I):
+        return False
+    if _INT.match(t):
+        return int(t)
+    if _FLOAT.match(t):
+        return float(t.replace('d', 'e').replace('D', 'e'))
+    raise NamelistError("can not read namelist value %s" %text)
+
+
+
+def format_value(value):
+    """ namelist text of a python value """
+
+    if isinstance(value, (list, tuple)):
+        return ", ".join(format_value(v) for v in value)
+    if isinstance(value, bool):
+        return ".TRUE." if value else ".FALSE."
+    if isinstance(value, int):
+        return "%d" %value
+    if isinstance(value, float):
+        return repr(value)
+    return '"%s"' %str(value).replace('"', '""')
+
+
+
+class Namelist():
+
+    """
+    groups: {GROUP: {key: value}}, names compared without case and kept as written.
+    the lines of the file are kept, an item is ['item', group, key, prefix, value text, suffix]
+    and is written back as it was unless its value is set
+    """
+
+    def __init__(self, text, name=None):
+
+        self.name = name
+        self.lines = []
+        self.groups = OrderedDict()        # group lower: (name, OrderedDict(key lower: [name, value]))
+        self._parse(text)
+
+
+    def _parse(self, text):
+
+        group = None
+        for n, line in enumerate(text.splitlines(), 1):
+            m = _GROUP.match(line)
+            if m and group is None:
+                group = m.group(1)
+                self.groups.setdefault(group.lower(), (group, OrderedDict()))
+                self.lines.append(['text', line])
+                continue
+            if group is not None and _END.match(line):
+                self.lines.append(['end', group, line])
+                group = None
+                continue
+
+            m = _ITEM.match(line) if group is not None else None
+            if not m:
+                if group is not None and line.strip() and not line.strip().startswith('!'):
+                    raise NamelistError("%s line %d: can not read '%s'" %(self.name, n, line.strip()))
+                self.lines.append(['text', line])
+                continue
+
+            prefix, key, rest = m.groups()
+            value, suffix = _split_comment(rest)
+            try:
+                parsed = parse_value(value)
+            except NamelistError as err:
+                raise NamelistError("%s line %d: %s" %(self.name, n, err))
+            self.groups[group.lower()][1][re.sub(r'\s+', '', key).lower()] = [key, parsed]
+            self.lines.append(['item', group.lower(), re.sub(r'\s+', '', key).lower(), prefix, value, suffix])
+
+        if group is not None:
+            raise NamelistError("%s: group &%s has no closing /" %(self.name, group))
+
+
+    # ---------------------------------------------------------- values
+
+    def _items(self, group):
+        try:
+            return self.groups[group.lower()][1]
+        except KeyError:
+            raise NamelistError("%s has no group &%s" %(self.name, group))
+
+
+    def has(self, group, key):
+        return group.lower() in self.groups and re.sub(r'\s+', '', key).lower() in self.groups[group.lower()][1]
+
+
+    def get(self, group, key, default=None):
+        item = self._items(group).get(re.sub(r'\s+', '', key).lower())
+        return item[1] if item else default
+
+
+    def set(self, group, key, value):
+        """ sets key of group, a key not in the group is added before its closing / """
+
+        items = self._items(group)
+        k = re.sub(r'\s+', '', key).lower()
+        if k in items:
+            if items[k][1] == value and type(items[k][1]) is type(value):
+                return
+            items[k][1] = value
+            for line in self.lines:
+                if line[0] == 'item' and line[1] == group.lower() and line[2] == k:
+                    line[4] = format_value(value)
+            return
+
+        items[k] = [key, value]
+        end = [i for i, line in enumerate(self.lines) if line[0] == 'end' and line[1].lower() == group.lower()][0]
+        self.lines.insert(end, ['item', group.lower(), k, "%s = " %key, format_value(value), ""])
+
+
+    def update(self, overrides):
+        """ overrides: {group: {key: value}} """
+        for group, values in overrides.items():
+            for key, value in values.items():
+                self.set(group, key, value)
+        return self
+
+
+    def to_dict(self):
+        """ {GROUP: {key: value}}, names as written """
+        return OrderedDict((name, OrderedDict((k, v) for k, v in items.values()))
+                           for name, items in self.groups.values())
+
+
+    def copy(self):
+        return copy.deepcopy(self)
+
+
+    # ---------------------------------------------------------- output
+
+    def text(self):
+
+        out = []
+        for line in self.lines:
+            if line[0] == 'item':
+                out.append(line[3] + line[4] + line[5])
+            else:
+                out.append(line[-1])
+        return "\n".join(out) + "\n"
+
+
+    def write(self, filename):
+        """ writes the namelist unless filename already holds it, returns True if it was written """
+
+        text = self.text()
+        try:
+            with open(filename, 'r') as fptr:
+                if fptr.read() == text:
+                    return False
+        except OSError:
+            pass
+        nus.write_atomic(filename, text)
+        return True
+
+
+
+@functools.lru_cache(maxsize=32)
+def _load(path, mtime, size):
+    with open(path, 'r') as fptr:
+        return Namelist(fptr.read(), path)
+
+
+
+def load(filename):
+    """ parsed namelist of filename, parsed once until the file changes - copy it before setting values """
+
+    st = os.stat(filename)
+    return _load(os.path.abspath(filename), st.st_mtime, st.st_size)
+
+
+
+def write_many(template, runs):
+    """
+    template: namelist file name or Namelist
+    runs:     {output file name: {group: {key: value}}}
+    writes one namelist per run from one parse of the template, returns the file names actually written
+    """
+
+    base = load(template) if isinstance(template, str) else template
+    written = []
+    for filename, overrides in runs.items():
+        if base.copy().update(overrides).write(filename):
+            written.append(filename)
+    return written
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="reads a Fortran namelist and writes it with overrides")
+    parser.add_argument("namelist")
+    parser.add_argument("overrides", nargs='*', help="group.key=value, i.e. NOAHLSM_OFFLINE.KHOUR=240")
+    parser.add_argument("-o", "--output", help="output file, the values are listed if not given")
+    args = parser.parse_args()
+
+    nml = load(args.namelist).copy()
+    for o in args.overrides:
+        name, sep, value = o.partition('=')
+        group, dot, key = name.partition('.')
+        if not sep or not dot:
+            parser.error("override %s is not group.key=value" %o)
+        nml.set(group, key, parse_value(value))
+
+    if args.output:
+        print("%s %s" %(args.output, "written" if nml.write(args.output) else "unchanged"))
+    else:
+        for group, values in nml.to_dict().items():
+            print("&%s" %group)
+            for key, value in values.items():
+                print("    %s = %s" %(key, format_value(value)))
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+
+"""
+File Name   : nsem_ncheader.py
+Description : NetCDF header reader - dimensions, global and variable attributes of a NetCDF file and the
+              first value of a variable, read from the few kilobytes of the header instead of opening
+              multi-GB model files. Classic, 64-bit offset and CDF-5 files are read directly,
+              NetCDF-4 (HDF5) files need the netCDF4 package
+Usage       : import this into an external python source file (i.e. import nsem_ncheader as nch)
+              hdr = nch.read("fort.67.nc"); hdr.dims['node'], hdr.attrs['agrid'], nch.first_value("fort.67.nc", 'time')
+Date        : 7/6/2020
+Contacts    : Coastal Act Team
+              ali.abdolali@noaa.gov, saeed.moghimi@noaa.gov, beheen.m.trimble@gmail.com, andre.vanderwesthuysen@noaa.gov
+"""
+
+# standard libs
+import re, struct, datetime
+from collections import namedtuple
+
+
+HDF5_MAGIC = b'\x89HDF\r\n\x1a\n'
+
+NC_DIMENSION = 10
+NC_VARIABLE = 11
+NC_ATTRIBUTE = 12
+
+# nc_type: (struct format, size)
+NC_TYPES = {1: ('b', 1), 2: ('c', 1), 3: ('h', 2), 4: ('i', 4), 5: ('f', 4), 6: ('d', 8),
+            7: ('B', 1), 8: ('H', 2), 9: ('I', 4), 10: ('q', 8), 11: ('Q', 8)}
+
+UNIT_SECONDS = {'second': 1.0, 'minute': 60.0, 'hour': 3600.0, 'day': 86400.0}
+
+_DATE = re.compile(r'(\d{4})-(\d{1,2})-(\d{1,2})(?:[ T](\d{1,2}):(\d{2})(?::(\d{2}))?)?')
+
+Header = namedtuple('Header', 'format dims attrs variables')      # variables: {name: Variable}
+Variable = namedtuple('Variable', 'dims attrs nc_type begin')
+
+
+class NCHeaderError(ValueError):
+    pass
+
+
+
+class _Reader():
+
+    """ walks the header of a classic file, version 1 (classic), 2 (64-bit offset) or 5 (CDF-5) """
+
+    def __init__(self, fptr, version):
+
+        self.fptr = fptr
+        self.count = 'q' if version == 5 else 'i'            # element counts and dimension lengths
+        self.offset = 'q' if version in (2, 5) else 'i'      # variable begin
+
+
+    def unpack(self, fmt):
+        size = struct.calcsize('>' + fmt)
+        data = self.fptr.read(size)
+        if len(data) != size:
+            raise NCHeaderError("truncated NetCDF header")
+        return struct.unpack('>' + fmt, data)
+
+
+    def number(self, fmt=None):
+        return self.unpack(fmt or self.count)[0]
+
+
+    def padded(self, size):
+        data = self.fptr.read(size)
+        self.fptr.read((4 - size % 4) % 4)
+        return data
+
+
+    def name(self):
+        return self.padded(self.number()).decode('utf-8', 'replace')
+
+
+    def values(self, nc_type, nelems):
+        fmt, size = NC_TYPES[nc_type]
+        data = self.padded(nelems * size)
+        if nc_type == 2:
+            return data.rstrip(b'\x00').decode('utf-8', 'replace')
+        values = struct.unpack('>%d%s' %(nelems, fmt), data)
+        return values[0] if nelems == 1 else values
+
+
+    def listing(self, tag, item):
+        found = self.number('i'); nelems = self.number()
+        if found == 0 and nelems == 0:
+            return []                                        # ABSENT
+        if found != tag:
+            raise NCHeaderError("unexpected tag %d in NetCDF header" %found)
+        return [item() for i in range(nelems)]
+
+
+    def attribute(self):
+        name = self.name()
+        nc_type = self.number('i')
+        return name, self.values(nc_type, self.number())
+
+
+    def dimension(self):
+        return self.name(), self.number()
+
+
+    def variable(self, dim_names):
+        name = self.name()
+        dims = tuple(dim_names[self.number()] for i in range(self.number()))
+        attrs = dict(self.listing(NC_ATTRIBUTE, self.attribute))
+        nc_type = self.number('i')
+        self.number()                                        # vsize
+        return name, Variable(dims, attrs, nc_type, self.number(self.offset))
+
+
+
+def parse_date(text):
+    """ first yyyy-mm-dd[ hh:mm[:ss]] in text, None if there is none """
+
+    m = _DATE.search(text or "")
+    if not m:
+        return None
+    return datetime.datetime(*[int(g) for g in m.groups(0)])
+
+
+
+def time_units(units):
+    """ (seconds per unit, base date) of CF time units, i.e. 'minutes since 2008-08-23 00:00:00' """
+
+    unit, sep, since = (units or "").partition(' since ')
+    unit = unit.strip().lower().rstrip('s')
+    base = parse_date(since)
+    if not sep or unit not in UNIT_SECONDS or base is None:
+        raise NCHeaderError("unknown time units '%s'" %units)
+    return UNIT_SECONDS[unit], base
+
+
+
+def _read_hdf5(filename):
+    try:
+        import netCDF4
+    except ImportError:
+        raise NCHeaderError("%s is a NetCDF-4 file, reading it needs the netCDF4 package" %filename)
+
+    with netCDF4.Dataset(filename) as nc:
+        dims = dict((k, len(d)) for k, d in nc.dimensions.items())
+        attrs = dict((k, nc.getncattr(k)) for k in nc.ncattrs())
+        variables = dict((k, Variable(v.dimensions, dict((a, v.getncattr(a)) for a in v.ncattrs()), None, None))
+                         for k, v in nc.variables.items())
+    return Header('NETCDF4', dims, attrs, variables)
+
+
+
+def read(filename):
+    """ Header of a NetCDF file, raises NCHeaderError (a ValueError) if it is not one """
+
+    with open(filename, 'rb') as fptr:
+        magic = fptr.read(8)
+        if magic == HDF5_MAGIC:
+            return _read_hdf5(filename)
+        if magic[:3] != b'CDF' or magic[3:4] not in (b'\x01', b'\x02', b'\x05'):
+            raise NCHeaderError("%s is not a NetCDF file" %filename)
+
+        version = ord(magic[3:4])
+        fptr.seek(4)
+        rd = _Reader(fptr, version)
+        numrecs = rd.number()
+        dims = rd.listing(NC_DIMENSION, rd.dimension)
+        attrs = dict(rd.listing(NC_ATTRIBUTE, rd.attribute))
+        names = [n for n, size in dims]
+        variables = dict(rd.listing(NC_VARIABLE, lambda: rd.variable(names)))
+
+    # the unlimited dimension is stored with length 0, its length is the record count
+    dims = dict((n, numrecs if size == 0 else size) for n, size in dims)
+    return Header({1: 'CLASSIC', 2: '64BIT_OFFSET', 5: 'CDF5'}[version], dims, attrs, variables)
+
+
+
+def first_value(filename, name, header=None):
+    """ first element of variable name (i.e. the model time of a hotstart), None if the file has no data """
+
+    header = header or read(filename)
+    if name not in header.variables:
+        raise NCHeaderError("%s has no variable %s" %(filename, name))
+
+    var = header.variables[name]
+    if var.begin is None:                                    # NetCDF-4
+        import netCDF4
+        with netCDF4.Dataset(filename) as nc:
+            values = nc.variables[name][:].ravel()
+            return values[0].item() if values.size else None
+
+    if any(header.dims[d] == 0 for d in var.dims):
+        return None
+    fmt, size = NC_TYPES[var.nc_type]
+    with open(filename, 'rb') as fptr:
+        fptr.seek(var.begin)
+        data = fptr.read(size)
+    if len(data) != size:
+        return None
+    return struct.unpack('>' + fmt, data)[0]
@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+
+"""
+File Name   : nsem_nemsconfig.py
+Description : NEMS nems.configure parser and writer - one pass over the file into an immutable model
+              (components, petlists, attributes and the runSeq time-loop tree), memoized per file
+              modification time, and a writer that regenerates the file from the model
+Usage       : import this into an external python source file (i.e. import nsem_nemsconfig as nnc)
+              cfg = nnc.read("nems.configure"); text = nnc.write(cfg)
+Date        : 7/6/2020
+Contacts    : Coastal Act Team
+              ali.abdolali@noaa.gov, saeed.moghimi@noaa.gov, beheen.m.trimble@gmail.com, andre.vanderwesthuysen@noaa.gov
+"""
+
+# standard libs
+import os, re, functools
+from collections import namedtuple
+
+# local libs
+import nsem_utils as nus
+
+
+# ------------------------------------------------------------------ model
+# every piece is a namedtuple, so a parsed configuration can be cached and shared safely
+
+# name: ATM, model: atmesh, petlist: (lo, hi) or the raw text of a template placeholder,
+# attributes: ((key, value), ...)
+Component = namedtuple('Component', 'name model petlist attributes')
+
+# ATM -> OCN   :remapMethod=redist  ==> src ATM, dst OCN, options (('remapMethod', 'redist'),)
+Connector = namedtuple('Connector', 'src dst options')
+
+# ATM, or ATM with a phase label (i.e. "ATM phase1")
+RunStep = namedtuple('RunStep', 'component phase')
+
+# @3600 ... @ ==> interval '3600' (kept as text, it may be a template placeholder), body (steps and loops)
+TimeLoop = namedtuple('TimeLoop', 'interval body')
+
+# earth: component names in EARTH_component_list order, run_seq: body of the runSeq block
+NEMSConfigure = namedtuple('NEMSConfigure', 'earth earth_attributes components run_seq')
+
+
+class NEMSConfigError(ValueError):
+
+    def __init__(self, msg, path=None, lineno=None):
+        where = ""
+        if path:
+            where = "%s:%s: " %(path, lineno) if lineno else "%s: " %path
+        ValueError.__init__(self, where + msg)
+
+
+
+def component(cfg, name):
+    for comp in cfg.components:
+        if comp.name == name:
+            return comp
+    raise KeyError(name)
+
+
+
+def walk(body):
+    """ every RunStep and Connector of a runSeq body, depth first """
+    for item in body:
+        if isinstance(item, TimeLoop):
+            for sub in walk(item.body):
+                yield sub
+        else:
+            yield item
+
+
+
+def run_seq_lines(body):
+    """ runSeq body as the stripped lines NEMSConfig used to keep """
+    lines = []
+    for item in body:
+        if isinstance(item, TimeLoop):
+            lines.append("@" + item.interval)
+            lines += run_seq_lines(item.body)
+            lines.append("@")
+        else:
+            lines.append(_format_item(item))
+    return lines
+
+
+# ------------------------------------------------------------------ parser
+
+_BLOCK_OPEN = re.compile(r'^(\w+)\s*::\s*$')
+_BLOCK_CLOSE = re.compile(r'^::\s*$')
+_LABEL = re.compile(r'^(\w+)\s*:\s*(.*?)\s*$')
+_CONNECTOR = re.compile(r'^(\S+)\s*->\s*(\S+)\s*(?::(.*))?$')
+
+
+def _tokenize(text, path=None):
+    """ one pass over the lines: yields ('label', name, value, lineno) and
+        ('block', name, [(line, lineno), ...], lineno) """
+
+    block = None
+    for lineno, raw in enumerate(text.splitlines(), 1):
+        line = raw.strip()
+        if block is not None:
+            if _BLOCK_CLOSE.match(line):
+                yield ('block', block[0], block[1], block[2])
+                block = None
+            elif line and not line.startswith('#'):
+                block[1].append((line, lineno))
+            continue
+
+        if not line or line.startswith('#'):
+            continue
+        mo = _BLOCK_OPEN.match(line)
+        if mo:
+            block = (mo.group(1), [], lineno)
+            continue
+        mo = _LABEL.match(line)
+        if mo:
+            yield ('label', mo.group(1), mo.group(2), lineno)
+            continue
+        raise NEMSConfigError("can not parse line '%s'" %line, path, lineno)
+
+    if block is not None:
+        raise NEMSConfigError("block %s:: is not closed with ::" %block[0], path, block[2])
+
+
+
+def _attributes(lines, path):
+
+    attrs = []
+    for line, lineno in lines:
+        if '=' not in line:
+            raise NEMSConfigError("attribute without '=': '%s'" %line, path, lineno)
+        k, v = line.split('=', 1)
+        attrs.append((k.strip(), v.strip()))
+    return tuple(attrs)
+
+
+
+def _petlist(value):
+    """ '0 10' to (0, 10), a single pet '12' to (12, 12), placeholders stay text """
+    try:
+        pets = tuple(int(v) for v in value.split())
+    except ValueError:
+        return value
+    if len(pets) == 1:
+        return (pets[0], pets[0])
+    return pets
+
+
+
+def _run_seq(lines, path):
+
+    root = []; stack = [root]        # open time loops are [interval, body] lists
+    for line, lineno in lines:
+        if line.startswith('@'):
+            interval = line[1:].strip()
+            if interval:
+                loop = []
+                stack[-1].append([interval, loop])
+                stack.append(loop)
+            elif len(stack) == 1:
+                raise NEMSConfigError("'@' closes a time loop that was never opened", path, lineno)
+            else:
+                stack.pop()
+            continue
+
+        mo = _CONNECTOR.match(line)
+        if mo:
+            options = []
+            for opt in (mo.group(3) or "").split(':'):
+                opt = opt.strip()
+                if opt:
+                    k, _, v = opt.partition('=')
+                    options.append((k.strip(), v.strip()))
+            stack[-1].append(Connector(mo.group(1), mo.group(2), tuple(options)))
+        else:
+            parts = line.split(None, 1)
+            stack[-1].append(RunStep(parts[0], parts[1] if len(parts) > 1 else None))
+
+    # loops left open at the end of the block (i.e. "@180" alone) close there
+    def freeze(body):
+        return tuple(TimeLoop(item[0], freeze(item[1])) if isinstance(item, list) else item for item in body)
+    return freeze(root)
+
+
+
+def parse(text, path=None):
+    """ nems.configure text to a NEMSConfigure """
+
+    labels = {}; blocks = {}
+    for kind, name, value, lineno in _tokenize(text, path):
+        if kind == 'label':
+            labels[name] = (value, lineno)
+        else:
+            blocks[name] = (value, lineno)
+
+    if 'EARTH_component_list' not in labels:
+        raise NEMSConfigError("EARTH_component_list is missing", path)
+    earth = tuple(labels['EARTH_component_list'][0].split())
+
+    components = []
+    for name in earth:
+        if name + '_model' not in labels:
+            raise NEMSConfigError("%s_model is missing for component %s" %(name, name), path)
+        model = labels[name + '_model'][0]
+        petlist = _petlist(labels[name + '_petlist_bounds'][0]) if name + '_petlist_bounds' in labels else None
+        attrs = _attributes(blocks[name + '_attributes'][0], path) if name + '_attributes' in blocks else ()
+        components.append(Component(name, model, petlist, attrs))
+
+    earth_attrs = _attributes(blocks['EARTH_attributes'][0], path) if 'EARTH_attributes' in blocks else ()
+    run_seq = _run_seq(blocks['runSeq'][0], path) if 'runSeq' in blocks else ()
+
+    return NEMSConfigure(earth, earth_attrs, tuple(components), run_seq)
+
+
+
+@functools.lru_cache(maxsize=32)
+def _read(path, mtime_ns, size):
+    with open(path, 'r') as fptr:
+        return parse(fptr.read(), path)
+
+
+
+def read(path):
+    """ parsed nems.configure, memoized on (path, mtime) - re-reading an unchanged file is free """
+
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    return _read(path, st.st_mtime_ns, st.st_size)
+
+
+# ------------------------------------------------------------------ writer
+
+# section comment per component, as in the NSEM nems.configure files
+SECTION = {'NWM': 'HYD'}
+
+
+def _format_item(item):
+
+    if isinstance(item, Connector):
+        line = "%s -> %s" %(item.src, item.dst)
+        if item.options:
+            line += "   :" + ":".join(k + ("=" + v if v else "") for k, v in item.options)
+        return line
+    if item.phase:
+        return "%s %s" %(item.component, item.phase)
+    return item.component
+
+
+
+def _write_run_seq(body, indent):
+
+    lines = []
+    for item in body:
+        if isinstance(item, TimeLoop):
+            lines.append(indent + "@" + item.interval)
+            lines += _write_run_seq(item.body, indent + "  ")
+            lines.append(indent + "@")
+        else:
+            lines.append(indent + _format_item(item))
+    return lines
+
+
+
+def _write_attributes(name, attrs):
+    return [name + "_attributes::"] + ["  %s = %s" %(k, v) for k, v in attrs] + ["::"]
+
+
+
+def write(cfg, filename=None):
+    """ NEMSConfigure to nems.configure text, written atomically to filename if given """
+
+    def petlist(p):
+        return " ".join(str(i) for i in p) if isinstance(p, tuple) else p
+
+    lines = ["# nems.configure - autogenerated by NSEM at %s" %nus.now(frmt=3),
+             "#############################################",
+             "####  NEMS Run-Time Configuration File  #####",
+             "#############################################",
+             "",
+             "# EARTH #",
+             "EARTH_component_list: " + " ".join(cfg.earth)]
+    lines += _write_attributes("EARTH", cfg.earth_attributes)
+
+    for comp in cfg.components:
+        lines += ["", "# %s #" %SECTION.get(comp.name, comp.name),
+                  "%-32s%s" %(comp.name + "_model:", comp.model)]
+        if comp.petlist is not None:
+            lines.append("%-32s%s" %(comp.name + "_petlist_bounds:", petlist(comp.petlist)))
+        lines += _write_attributes(comp.name, comp.attributes)
+
+    lines += ["", "# Run Sequence #", "runSeq::"] + _write_run_seq(cfg.run_seq, "  ") + ["::", ""]
+    text = "\n".join(lines)
+
+    if filename:
+        nus.write_atomic(filename, text)
+    return text
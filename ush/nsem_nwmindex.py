@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+
+"""
+File Name   : nsem_nwmindex.py
+Description : NWM input presence index - a directory of time stamped files (forcing yyyymmddhh.LDASIN_DOMAIN1,
+              USGS time slices yyyy-mm-dd_hh:mm:00.15min.usgsTimeSlice.ncdf) scanned once, each file name
+              decoded to its time and kept as a sorted datetime64 array. Coverage of a run window, its gaps,
+              first/last time and off-cadence files are then answered by binary search, and short gaps
+              can be filled with links to the nearest available time
+Usage       : import this into an external python source file (i.e. import nsem_nwmindex as nwi)
+              idx = nwi.scan(forcing_dir, 'yyyymmddhh.LDASIN_DOMAIN1', 'yyyymmddhh', '%Y%m%d%H', 3600)
+              idx.covers(start, end); idx.gaps(start, end); idx.fill(start, end, run_forcing_dir, max_missing=2)
+              or standalone: python nsem_nwmindex.py <dir> forcing|nudging [--start ... --hours ... --fill N --dest <dir>]
+Date        : 7/6/2020
+Contacts    : Coastal Act Team
+              ali.abdolali@noaa.gov, saeed.moghimi@noaa.gov, beheen.m.trimble@gmail.com, andre.vanderwesthuysen@noaa.gov
+"""
+
+# standard libs
+import os, re, argparse, functools
+from collections import namedtuple
+
+# third party libs
+import numpy as np
+
+# local libs
+import nsem_utils as nus
+import nsem_timeaxis as nta
+
+
+# kind: (template token, strftime format of the token, cadence in seconds)
+KINDS = {'forcing': ('yyyymmddhh', '%Y%m%d%H', 3600),
+         'nudging': ('yyyy-mm-dd_hh:mm', '%Y-%m-%d_%H:%M', 900)}
+
+TEMPLATES = {'forcing': 'yyyymmddhh.LDASIN_DOMAIN1',
+             'nudging': 'yyyy-mm-dd_hh:mm:00.15min.usgsTimeSlice.ncdf'}
+
+# strftime code: (regex, position in numpy's iso string YYYY-MM-DDTHH:MM:SS)
+_CODES = {'Y': (r'\d{4}', 0), 'm': (r'\d{2}', 5), 'd': (r'\d{2}', 8),
+          'H': (r'\d{2}', 11), 'M': (r'\d{2}', 14), 'S': (r'\d{2}', 17)}
+_ISO_ZERO = "0000-01-01T00:00:00"
+
+Gap = namedtuple('Gap', 'start end missing')       # first and last missing time, number of missing files
+
+
+@functools.lru_cache(maxsize=16)
+def _pattern(template, token, fmt):
+    """ regex of the file names of template, one group per strftime code of fmt """
+
+    before, sep, after = template.partition(token)
+    if not sep:
+        raise ValueError("%s is not in template %s" %(token, template))
+
+    regex = ""; codes = []; i = 0
+    while i < len(fmt):
+        if fmt[i] == '%' and i + 1 < len(fmt) and fmt[i+1] in _CODES:
+            regex += "(%s)" %_CODES[fmt[i+1]][0]
+            codes.append(fmt[i+1])
+            i += 2
+        else:
+            regex += re.escape(fmt[i])
+            i += 1
+    return re.compile("^%s%s%s$" %(re.escape(before), regex, re.escape(after))), tuple(codes)
+
+
+
+def decode(name, template, token, fmt):
+    """ time of a file name built from template (see nsem_timeaxis.file_names), None if it is not one """
+
+    regex, codes = _pattern(template, token, fmt)
+    m = regex.match(name)
+    if not m:
+        return None
+    iso = list(_ISO_ZERO)
+    for code, value in zip(codes, m.groups()):
+        pos = _CODES[code][1]
+        iso[pos:pos + len(value)] = value
+    try:
+        return np.datetime64("".join(iso), 's')
+    except ValueError:
+        return None                                    # i.e. month 13
+
+
+
+class TimeIndex():
+
+    """
+    times:  sorted datetime64[s] array of the files present, one per time
+    names:  file names, same order
+    step:   expected cadence, timedelta64[s]
+    """
+
+    def __init__(self, root, times, names, step, template=None, token=None, fmt=None):
+
+        self.root = root
+        self.times = times
+        self.names = names
+        self.step = np.timedelta64(int(step), 's')
+        self.template, self.token, self.fmt = template, token, fmt
+
+
+    def __len__(self):
+        return len(self.times)
+
+
+    @property
+    def first(self):
+        return self.times[0] if len(self.times) else None
+
+
+    @property
+    def last(self):
+        return self.times[-1] if len(self.times) else None
+
+
+    def _span(self, start, end):
+        """ index range [lo, hi) of the times in [start, end] """
+
+        start = np.datetime64(start, 's'); end = np.datetime64(end, 's')
+        return (int(np.searchsorted(self.times, start, 'left')),
+                int(np.searchsorted(self.times, end, 'right')))
+
+
+    def expected(self, start, end):
+        """ number of files of the cadence from start to end, both included """
+        return int((np.datetime64(end, 's') - np.datetime64(start, 's')) // self.step) + 1
+
+
+    def has(self, t):
+        i = int(np.searchsorted(self.times, np.datetime64(t, 's')))
+        return i < len(self.times) and self.times[i] == np.datetime64(t, 's')
+
+
+    def count(self, start, end):
+        """ number of files from start to end, both included """
+        lo, hi = self._span(start, end)
+        return hi - lo
+
+
+    def covers(self, start, end):
+        """ True if every time of the cadence from start to end has its file - two binary searches,
+            valid once off-cadence files are ruled out (see off_cadence) """
+
+        lo, hi = self._span(start, end)
+        return (hi - lo == self.expected(start, end) and hi > lo
+                and self.times[lo] == np.datetime64(start, 's') and self.times[hi-1] == np.datetime64(end, 's'))
+
+
+    def off_cadence(self, start=None, end=None):
+        """ times that do not fall on the cadence counted from start (the first time by default) """
+
+        if not len(self.times):
+            return self.times
+        start = np.datetime64(start, 's') if start is not None else self.times[0]
+        lo, hi = self._span(start, end if end is not None else self.times[-1])
+        t = self.times[lo:hi]
+        return t[(t - start) % self.step != np.timedelta64(0, 's')]
+
+
+    def gaps(self, start, end):
+        """ missing stretches of the cadence from start to end, a list of Gap """
+
+        start = np.datetime64(start, 's'); end = np.datetime64(end, 's')
+        lo, hi = self._span(start, end)
+        t = self.times[lo:hi]
+        t = t[(t - start) % self.step == np.timedelta64(0, 's')]
+
+        # sentinels one step outside the window so leading and trailing gaps are found the same way
+        bounds = np.concatenate(([start - self.step], t, [end + self.step]))
+        holes = np.nonzero(np.diff(bounds) > self.step)[0]
+        return [Gap(bounds[i] + self.step, bounds[i+1] - self.step, int((bounds[i+1] - bounds[i]) // self.step) - 1)
+                for i in holes]
+
+
+    def missing(self, start, end):
+        """ every missing time from start to end, a datetime64 array """
+
+        out = [np.arange(g.start, g.end + self.step, self.step) for g in self.gaps(start, end)]
+        return np.concatenate(out) if out else np.array([], dtype='datetime64[s]')
+
+
+    def nearest(self, t):
+        """ (time, name) of the file closest in time to t, the earlier one on a tie. None if empty """
+
+        if not len(self.times):
+            return None
+        t = np.datetime64(t, 's')
+        i = int(np.searchsorted(self.times, t))
+        if i == len(self.times) or (i > 0 and t - self.times[i-1] <= self.times[i] - t):
+            i -= 1
+        return self.times[i], self.names[i]
+
+
+    def name_of(self, t):
+        """ file name of time t, from the template the index was scanned with """
+        pattern = self.template.replace('%', '%%').replace(self.token, self.fmt)
+        return str(nta.format_times(np.array([t], dtype='datetime64[s]'), pattern)[0])
+
+
+    def fill(self, start, end, dest_dir, max_missing=1):
+        """
+        dest_dir (i.e. the run directory forcing) as a directory of links to the files from start to end,
+        each missing file of a gap of at most max_missing files linked to the file of the nearest time.
+        longer gaps are left alone. nothing is written in the scanned directory, a dest_dir inside it is
+        a ValueError; a dest_dir link (to the scanned directory, see nsem_install.link_dir) is replaced.
+        returns ({missing name: substitute name}, [Gap not filled])
+        """
+
+        if os.path.islink(dest_dir):
+            os.remove(dest_dir)
+        root = os.path.realpath(self.root)
+        if os.path.commonpath([root, os.path.realpath(dest_dir)]) == root:
+            raise ValueError("%s is in the scanned directory %s, fill another one" %(dest_dir, self.root))
+        os.makedirs(dest_dir, exist_ok=True)
+
+        lo, hi = self._span(start, end)
+        for name in self.names[lo:hi]:
+            _link(os.path.join(root, name), os.path.join(dest_dir, name))
+
+        filled = {}; left = []
+        for g in self.gaps(start, end):
+            if g.missing > max_missing:
+                left.append(g)
+                continue
+            for t in np.arange(g.start, g.end + self.step, self.step):
+                near_t, near_name = self.nearest(t)
+                name = self.name_of(t)
+                _link(os.path.join(root, near_name), os.path.join(dest_dir, name))
+                filled[name] = near_name
+        return filled, left
+
+
+    def report(self, start, end, label=None):
+        """ prints the coverage of the window, returns True if it is complete """
+
+        label = label or self.root
+        extra = self.off_cadence(start, end)
+        if self.covers(start, end) and not len(extra):
+            print("%s: %d files from %s to %s, complete" %(label, self.count(start, end), start, end))
+            return True
+
+        gaps = self.gaps(start, end)
+        missing = sum(g.missing for g in gaps)
+        print(nus.colory("red", "%s: %d of %d files missing from %s to %s (present %s to %s)"
+                         %(label, missing, self.expected(start, end), start, end, self.first, self.last)))
+        for g in gaps:
+            span = str(g.start) if g.missing == 1 else "%s to %s" %(g.start, g.end)
+            print("    missing %s (%d file%s)" %(span, g.missing, "s" if g.missing > 1 else ""))
+        for t in extra:
+            print("    off cadence %s" %t)
+        return False
+
+
+
+def _link(source, dest):
+    """ symbolic link dest -> source, replacing dest (i.e. a broken link of an earlier fill) """
+
+    if os.path.lexists(dest):
+        os.remove(dest)
+    os.symlink(source, dest)
+
+
+
+def scan(root, template, token, fmt, step):
+    """ index of the files of root named after template, other files are ignored. one directory read """
+
+    found = {}
+    with os.scandir(root) as it:
+        for entry in it:
+            t = decode(entry.name, template, token, fmt)
+            if t is not None:
+                found[t] = entry.name
+
+    times = np.array(sorted(found), dtype='datetime64[s]')
+    names = np.array([found[t] for t in times.tolist()] if found else [], dtype=object)
+    return TimeIndex(root, times, names, step, template, token, fmt)
+
+
+
+def scan_kind(root, kind, template=None):
+    """ index of forcing or nudging files (see KINDS), with the template of the initialization file if given """
+
+    token, fmt, step = KINDS[kind]
+    return scan(root, template or TEMPLATES[kind], token, fmt, step)
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="NWM forcing/nudging file coverage")
+    parser.add_argument("dir", help="i.e. .../forcing/<storm> or .../nudgingTimeSliceObs/<storm>")
+    parser.add_argument("kind", choices=sorted(KINDS))
+    parser.add_argument("--start", help="yyyy-mm-dd hh:mm:ss, the first file by default")
+    parser.add_argument("--hours", type=float, help="run length, up to the last file by default")
+    parser.add_argument("--fill", type=int, default=0, help="links gaps of at most this many files to the nearest time")
+    parser.add_argument("--dest", help="directory the --fill links are made in, never dir itself")
+    args = parser.parse_args()
+    if args.fill and not args.dest:
+        parser.error("--fill needs --dest")
+
+    idx = scan_kind(args.dir, args.kind)
+    if not len(idx):
+        print(nus.colory("red", "No %s files in %s" %(args.kind, args.dir)))
+        raise SystemExit(1)
+
+    start = np.datetime64(nus.to_date(args.start, frmt=1), 's') if args.start else idx.first
+    if args.hours is not None:
+        end = start + np.timedelta64(int(args.hours * 3600), 's') - idx.step
+    else:
+        end = idx.last
+    if args.fill:
+        filled, left = idx.fill(start, end, args.dest, args.fill)
+        for name, near in sorted(filled.items()):
+            print("Linked %s -> %s" %(name, near))
+        idx = scan_kind(args.dest, args.kind, idx.template)
+    raise SystemExit(0 if idx.report(start, end) else 1)
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+
+"""
+File Name   : nsem_petlayout.py
+Description : NEMS run sequence analyzer and PET layout optimizer - simulates one coupling step of the
+              parsed runSeq with per-component cost estimates (critical path, PET overlap and idle
+              fractions, node count) and proposes *_petlist_bounds that minimize the wall time of a
+              step for a node budget, with the matching nems.configure and Slurm resources
+Usage       : import this into an external python source file (i.e. import nsem_petlayout as npl)
+              or standalone: python nsem_petlayout.py nems.configure costs.json --nodes 20 --cores-per-node 40
+              costs.json: {"OCN": {"work": 4000, "serial": 0.02}, "NWM": 9000, "ATM": {"work": 1, "max_pets": 1}}
+              work is in PET-seconds per run of the component, connectors: {"ATM->OCN": 0.5} in seconds
+Date        : 7/6/2020
+Contacts    : Coastal Act Team
+              ali.abdolali@noaa.gov, saeed.moghimi@noaa.gov, beheen.m.trimble@gmail.com, andre.vanderwesthuysen@noaa.gov
+"""
+
+# standard libs
+import json, math
+import argparse
+
+# local libs
+import nsem_utils as nus
+import nsem_nemsconfig as nnc
+
+
+class Cost():
+
+    """ cost model of one component: a run on n PETs takes work * (serial + (1 - serial) / n) seconds """
+
+    def __init__(self, work, serial=0.0, min_pets=1, max_pets=None):
+
+        self.work = float(work)
+        self.serial = float(serial)
+        self.min_pets = int(min_pets)
+        self.max_pets = int(max_pets) if max_pets else None
+
+
+    def run_time(self, npets):
+        return self.work * (self.serial + (1.0 - self.serial) / max(1, npets))
+
+
+
+def read_costs(costs):
+    """ {name: number or dict of Cost arguments} to ({component: Cost}, {(src, dst): seconds}) """
+
+    comps = {}; connectors = {}
+    for name, value in costs.items():
+        if '->' in name:
+            src, dst = [n.strip() for n in name.split('->')]
+            connectors[(src, dst)] = float(value)
+        elif isinstance(value, dict):
+            comps[name] = Cost(**value)
+        else:
+            comps[name] = Cost(value)
+    return comps, connectors
+
+
+
+def _interval(text):
+    try:
+        return float(text)
+    except ValueError:
+        return None        # template placeholder, counted as one run
+
+
+
+class StepReport():
+
+    """ result of simulating one outer coupling step """
+
+    def __init__(self, layout, makespan, busy, total_pets, cores_per_node):
+
+        self.layout = layout                        # {component: (lo, hi)}
+        self.makespan = makespan                    # critical path of a coupling step, seconds
+        self.busy = busy                            # {component: seconds running (connectors included)}
+        self.total_pets = total_pets
+        self.nodes = int(math.ceil(total_pets / float(cores_per_node)))
+
+        used = sum(self.busy[c] * (hi - lo + 1) for c, (lo, hi) in layout.items())
+        self.idle_fraction = 1.0 - used / (total_pets * makespan) if makespan > 0 else 0.0
+
+        counts = {}
+        for lo, hi in layout.values():
+            for p in range(lo, hi + 1):
+                counts[p] = counts.get(p, 0) + 1
+        self.overlap_fraction = sum(1 for n in counts.values() if n > 1) / float(total_pets) if total_pets else 0.0
+
+
+    def summary(self):
+        lines = ["Coupling step critical path: %.3f seconds" %self.makespan,
+                 "PETs: %d on %d node(s), idle %.1f%%, shared by more than one component %.1f%%"
+                 %(self.total_pets, self.nodes, 100 * self.idle_fraction, 100 * self.overlap_fraction)]
+        for c, (lo, hi) in self.layout.items():
+            lines.append("  %-4s petlist %5d %5d  (%5d PETs)  busy %.3f seconds" %(c, lo, hi, hi - lo + 1, self.busy[c]))
+        return "\n".join(lines)
+
+
+
+def simulate(cfg, layout, costs, connector_costs=None, cores_per_node=1):
+    """
+    list-schedules the runSeq of cfg for one outer coupling step: items run in runSeq order,
+    each as soon as all the PETs it touches are free. A connector touches the PETs of both
+    components. Inner loops run outer_interval / inner_interval times.
+    layout: {component: (lo, hi)}, costs: {component: Cost}, connector_costs: {(src, dst): seconds}
+    returns a StepReport
+    """
+
+    connector_costs = connector_costs or {}
+    names = list(layout)
+    overlaps = {}
+    for c in names:
+        lo, hi = layout[c]
+        overlaps[c] = [o for o in names if layout[o][0] <= hi and lo <= layout[o][1]]
+
+    free = dict((c, 0.0) for c in names)
+    busy = dict((c, 0.0) for c in names)
+
+    def run(comps, duration):
+        start = max(free[c] for c in comps)
+        end = start + duration
+        for c in comps:
+            busy[c] += duration
+            for o in overlaps[c]:
+                free[o] = max(free[o], end)
+
+    def visit(body, outer):
+        for item in body:
+            if isinstance(item, nnc.TimeLoop):
+                inner = _interval(item.interval)
+                repeat = int(round(outer / inner)) if outer and inner else 1
+                for i in range(max(1, repeat)):
+                    visit(item.body, inner)
+            elif isinstance(item, nnc.Connector):
+                comps = [c for c in (item.src, item.dst) if c in layout]
+                if comps:
+                    run(comps, connector_costs.get((item.src, item.dst), 0.0))
+            elif item.component in layout:
+                c = item.component
+                lo, hi = layout[c]
+                run([c], costs[c].run_time(hi - lo + 1) if c in costs else 0.0)
+
+    visit(cfg.run_seq, None)
+
+    total_pets = max(hi for lo, hi in layout.values()) + 1 if layout else 0
+    return StepReport(layout, max(free.values()) if free else 0.0, busy, total_pets, cores_per_node)
+
+
+
+def current_layout(cfg):
+    """ {component: (lo, hi)} from the petlist bounds of a parsed nems.configure """
+
+    layout = {}
+    for comp in cfg.components:
+        if not isinstance(comp.petlist, tuple):
+            raise nnc.NEMSConfigError("%s_petlist_bounds is not set (%s)" %(comp.name, comp.petlist))
+        layout[comp.name] = comp.petlist
+    return layout
+
+
+
+def _contiguous(cfg, npets):
+    """ disjoint petlists in EARTH_component_list order """
+
+    layout = {}; lo = 0
+    for c in cfg.earth:
+        layout[c] = (lo, lo + npets[c] - 1)
+        lo += npets[c]
+    return layout
+
+
+
+def optimize(cfg, costs, nodes, cores_per_node, connector_costs=None, min_gain=1.0e-3, steps=200):
+    """
+    greedy PET allocation for a node budget: every component starts on its minimum, then chunks
+    of PETs go to the component whose growth shortens the coupling step the most, until the
+    budget is used or no growth gains more than min_gain (relative). Petlists are disjoint so
+    components not ordered by the runSeq can run concurrently.
+    returns the StepReport of the proposed layout
+    """
+
+    budget = nodes * cores_per_node
+    npets = dict((c, costs[c].min_pets if c in costs else 1) for c in cfg.earth)
+    if sum(npets.values()) > budget:
+        raise ValueError("%d node(s) of %d cores can not hold the minimum of %d PETs"
+                         %(nodes, cores_per_node, sum(npets.values())))
+
+    chunk = max(1, budget // steps)
+
+    def report(n):
+        return simulate(cfg, _contiguous(cfg, n), costs, connector_costs, cores_per_node)
+
+    best = report(npets)
+    while sum(npets.values()) < budget:
+        left = budget - sum(npets.values())
+        candidates = []
+        for c in cfg.earth:
+            limit = costs[c].max_pets if c in costs else 1
+            grow = min(chunk, left, limit - npets[c]) if limit else min(chunk, left)
+            if grow <= 0:
+                continue
+            trial = dict(npets); trial[c] += grow
+            candidates.append((report(trial), trial))
+
+        # components running concurrently with the same busy time only gain when grown together
+        top = max(best.busy.values())
+        critical = [c for c in cfg.earth if best.busy[c] >= 0.99 * top and
+                    (c not in costs or not costs[c].max_pets or npets[c] < costs[c].max_pets)]
+        if len(critical) > 1 and len(critical) * chunk <= left:
+            trial = dict(npets)
+            for c in critical:
+                limit = costs[c].max_pets if c in costs else 1
+                trial[c] = min(trial[c] + chunk, limit) if limit else trial[c] + chunk
+            candidates.append((report(trial), trial))
+
+        if not candidates:
+            break
+        rep, trial = min(candidates, key=lambda rt: rt[0].makespan)
+        if best.makespan - rep.makespan <= min_gain * best.makespan:
+            break
+        best, npets = rep, trial
+
+    return best
+
+
+
+def apply_layout(cfg, layout):
+    """ the same configuration with new petlist bounds """
+
+    comps = tuple(comp._replace(petlist=tuple(layout[comp.name])) if comp.name in layout else comp
+                  for comp in cfg.components)
+    return cfg._replace(components=comps)
+
+
+
+def slurm_resources(report, cores_per_node, slurm_args=None):
+    """ slurm_args (see nsem_ini.py) updated for the layout, for func_nsem_build.SlurmJob """
+
+    args = dict(slurm_args or {})
+    args['nnodes'] = report.nodes
+    args['ntasks'] = int(math.ceil(report.total_pets / float(report.nodes)))    # tasks per node
+    args['npets'] = report.total_pets     # total tasks, the proposed PET count
+    return args
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="analyze a nems.configure run sequence and propose a PET layout")
+    parser.add_argument("nems_configure", help="nems.configure file")
+    parser.add_argument("costs", help="json file of component and connector costs")
+    parser.add_argument("--nodes", type=int, help="node budget, only analyzes the current layout if not given")
+    parser.add_argument("--cores-per-node", type=int, default=40)
+    parser.add_argument("--out", help="writes the proposed nems.configure to this file")
+    args = parser.parse_args()
+
+    cfg = nnc.read(args.nems_configure)
+    with open(args.costs) as fptr:
+        costs, connector_costs = read_costs(json.load(fptr))
+
+    cur = simulate(cfg, current_layout(cfg), costs, connector_costs, args.cores_per_node)
+    print(nus.colory("blue", "Current layout\n" + cur.summary()))
+
+    if args.nodes:
+        best = optimize(cfg, costs, args.nodes, args.cores_per_node, connector_costs)
+        print(nus.colory("green", "Proposed layout\n" + best.summary()))
+        print("Slurm resources: %s" %slurm_resources(best, args.cores_per_node))
+        if args.out:
+            nnc.write(apply_layout(cfg, best.layout), args.out)
+            print("Processed nems.configure %s" %args.out)
@@ -1,9 +1,9 @@
 #!/usr/bin/env python
 
 # stdandard libs
-import os, sys, time, subprocess, logging, shutil
+import os, sys, time, subprocess, logging, shutil, argparse
 import json
-from datetime import datetime, timedelta
+from datetime import datetime
 from dateutil.parser import parser
 from string import Template
 
@@ -13,7 +13,13 @@ import json
 
 # user defined libs
 import nsem_utils as util
-import nsem_ini as ini
+import nsem_tidefac as ntf
+import nsem_spinup as nsp
+import nsem_hotstart as nhs
+import nsem_ncheader as nch
+import nsem_ww3 as nww
+import nsem_forcing as nfc
+import nsem_config as ncf
 
 ##########################################
 
@@ -25,7 +31,7 @@ storm and per run_name ready to be submitted to run.
 logger = logging.getLogger("jlogfile")
 
 
-def get_tidal_fact():
+def get_tidal_fact(ini):
     """
     based on spin-up start time prepare tide fac to be used in fort.15.tempelate
     In:
@@ -33,84 +39,35 @@ def get_tidal_fact():
 
     """
 
-    # copy tidal input file - TODO why in two places?? get example
-    tide_spin_sdate, tide_spin_edate, wave_spin_sdate, wave_spin_edate, start_date, end_date = spinup_time()
-    duration = str ((wave_spin_edate - tide_spin_sdate).total_seconds() /86400.)
-    msg = """{} {} {} {} {}""".format(duration, tide_spin_sdate.hour, tide_spin_sdate.day,
-                                      tide_spin_sdate.month, tide_spin_sdate.year)
-    tidefac_inp_file = os.path.join(env.COMINadc, 'tide_inp.txt')
-    with open (tidefac_inp_file, 'w') as fpt:
-        fpt.write(msg)
-
-
-    tidefac_dic = {}
-    tidefac_out_file = os.path.join(env.COMOUT, 'tide_fac.out')
-    tidefac_out      = open(tidefac_out_file,'r')
-
-    for line in tidefac_out.readlines():
-        params = line.split()
-        print(line)
-        if 'K1'  in  params:    fft1,facet1   = params[1],params[2]
-        if 'O1'  in  params:    fft2,facet2   = params[1],params[2]
-        if 'P1'  in  params:    fft3,facet3   = params[1],params[2]
-        if 'Q1'  in  params:    fft4,facet4   = params[1],params[2]
-        if 'N2'  in  params:    fft5,facet5   = params[1],params[2]
-        if 'M2'  in  params:    fft6,facet6   = params[1],params[2]
-        if 'S2'  in  params:    fft7,facet7   = params[1],params[2]
-        if 'K2'  in  params:    fft8,facet8   = params[1],params[2]
-        if 'MF'  in  params:    fft9,facet9   = params[1],params[2]
-        if 'MM'  in  params:    fft10,facet10 = params[1],params[2]
-        if 'M4'  in  params:    fft11,facet11 = params[1],params[2]
-        if 'MS4' in  params:    fft12,facet12 = params[1],params[2]
-        if 'MN4' in  params:    fft13,facet13 = params[1],params[2]
-    tidefac_out.close()
-
-    return dict ( fft1=fft1,facet1=facet1,
-                  fft2=fft2,facet2=facet2,
-                  fft3=fft3,facet3=facet3,
-                  fft4=fft4,facet4=facet4,
-                  fft5=fft5,facet5=facet5,
-                  fft6=fft6,facet6=facet6,
-                  fft7=fft7,facet7=facet7,
-                  fft8=fft8,facet8=facet8,
-                  fft9=fft9,facet9=facet9,
-                  fft10=fft10,facet10=facet10,
-                  fft11=fft11,facet11=facet11,
-                  fft12=fft12,facet12=facet12,
-                  fft13=fft13,facet13=facet13
-               )
+    # nodal factors and equilibrium arguments computed in process, as tide_fac computed them
+    # for the same input (see nsem_tidefac.py) - no tide_inp.txt / tide_fac.out round trip
+    tide_spin_sdate, tide_spin_edate, wave_spin_sdate, wave_spin_edate, start_date, end_date = spinup_time(ini)
+    duration = (wave_spin_edate - tide_spin_sdate).total_seconds() /86400.
+
+    return ntf.fort15_dict(tide_spin_sdate, duration)
 
 
 
 
 """ to check the caclulation wit engineers """
-def spinup_time(ts=12.5,ws=27):
+def spinup_time(ini, ts=12.5,ws=27):
 
     """calculates spinup timing for both tide and wave
-       relative to forecast start time and end time """
-
-    env = ini    # not to change the variable defined here already!!   
+       relative to forecast start time and end time (ini: a nsem_config.NSEMConfig) """
 
-    duration = env.nhours_fcst
-    
-    start_date_str = env.start_month + "/" + env.start_day + "/" + env.start_year + " " + \
-                     env.start_hour + ":" + env.start_minute + ":" + env.start_second
-
-    # string date to date object
-    start_date = datetime.strptime(start_date_str, '%m/%d/%Y %H:%M:%S')
-    hours_added = timedelta(hours=duration)
-    end_date = start_date + hours_added
+    # forecast start and length, from model_configure (see nsem_config.RunWindow)
+    duration = ini.window.hours
+    start_date = ini.window.start
+    end_date = ini.window.end
     delta = end_date - start_date
     num_days = delta.days
     print(start_date, end_date, num_days)
 
-    # tide spinup start time must be 12 days prior to forecast start date
-    tide_spin_start_date = start_date - timedelta(days=ts)
-    # wave spinup star time must be 27 prior to start date
-    wave_spin_start_date = start_date - timedelta(days=ws)
-
-    tide_spin_end_date = tide_spin_start_date + timedelta(days=ts)
-    wave_spin_end_date = wave_spin_start_date + timedelta(days=ws)
+    # tide spinup start time must be 12 days prior to forecast start date,
+    # wave spinup star time must be 27 prior to start date (see nsem_spinup.windows for many storms)
+    w = nsp.windows([start_date], duration, ts=ts, ws=ws)
+    tide_spin_start_date, tide_spin_end_date, wave_spin_start_date, wave_spin_end_date = \
+        [nsp.to_datetime(w[k][0]) for k in ('tide_start', 'tide_end', 'wave_start', 'wave_end')]
     # 2008-08-23 00:00:00
     # 2008-09-04 12:00:00
     # 2008-09-19 00:00:00
@@ -124,41 +81,21 @@ def spinup_time(ts=12.5,ws=27):
 
 
 """ must be adjusted based on HWRF+ADC data file name standards """
-def adc_atm_data():
-    # Is this the atmesh or atm app_inp_dir = /scratch2/COASTAL/coastal/save/NAMED_STORMS/NSEM_app_run_workflow/nsemodel_inps
-    # copping atm data from COMINatm
+def adc_atm_data(ini):
+    # copping atm data from COMINatm into COMINmeshdata, subset to the mesh with the time axis
+    # fixed (what was done by hand for wind_atm_fin.nc  wind_atm_fin_ch_time_vec.nc), see nsem_forcing.py
     # (i.e. /scratch2/COASTAL/coastal/scrub/com/nsem/para/shinnecock/atm)
 
-    atm_inp_dir     = env.COMINatm           # 'hsofs_forcings/ike_v2_7settings/inp_atmesh'
-    wav_inp_dir     = env.COMINwav           # 'hsofs_forcings/ike_v2_7settings/inp_wavdata'
-
-    # atm files are
-    # what was in wind_atm_fin.nc  wind_atm_fin_ch_time_vec.nc
-    atm_netcdf_file_names = [
-        '01_IKE_HWRF_OC.nc',
-        '02_IKE_HWRF_OC_SM.nc',
-        '03_IKE_WRF.nc',
-        '04_IKE_HWRF_OC_WRF.nc',
-        '05_IKE_HWRF_OC_DA_HSOFS_orig.nc',
-        '06_IKE_HWRF_OC_DA_HSOFS_Smoothing.nc',
-        '07_IKE_HWRF_OC_DA_WRF_SM.nc',
-        ]
+    env = ini
+    return nfc.scenario_jobs(env.FORCING['atmesh'], env.COMINatm, env.COMINmeshdata)
 
 
 
 """ must be adjusted based on some standard naming or copied manually """
-def adc_wave_data():
+def adc_wave_data(ini):
 
-    wav_netcdf_file_names = [
-        '01_ww3.test1.2008_sxy_OC.nc',
-        '02_ww3.test2.2008_sxy_OC_SM.nc',
-        '03_ww3.test3.2008_sxy_WRF.nc',
-        '04_ww3.test4.2008_sxy_OC_WRF.nc',
-        '05_ww3.test5.2008_sxy_OC_DA_HSOFS_orig.nc',
-        '06_ww3.test6.2008_sxy_OC_DA_HSOFS_Smoothing.nc',
-        '07_ww3.test7.2008_sxy_OC_DA_WRF_SM.nc',
-        ]
-    return (file for file in wav_netcdf_file_names)
+    env = ini
+    return nfc.scenario_jobs(env.FORCING['ww3data'], env.COMINwave, env.COMINwavedata)
 
 
 """ is this needed ??? """
@@ -175,17 +112,13 @@ def change_nws():
     nws     = str (base_info.nws)
     line2replace  = ' ' +nws+ \
         '                                       ! NWS - WIND STRESS AND BAROMETRIC PRESSURE \n'
-    #replace main fort.15
-    filename = os.path.join(run_dir,'fort.15')
-    replace_pattern_line( filename = filename , pattern = pattern, line2replace = line2replace )
-
-    #replace fort.15 in PE directories
+    #replace main fort.15 and fort.15 in PE directories, one pass per file
+    filenames = [os.path.join(run_dir,'fort.15')]
+    filenames += [os.path.join(dir1,'fort.15') for dir1 in glob.glob(run_dir + '/PE0*')]
 
-    dirs = glob.glob(run_dir + '/PE0*')
-
-    for dir1 in dirs:
-         filename = os.path.join(dir1,'fort.15')
-         replace_pattern_line( filename = filename , pattern = pattern, line2replace = line2replace )
+    for filename, result in util.rewrite_many(filenames, [(pattern, line2replace)]).items():
+        if isinstance(result, Exception):
+            print(util.colory("red", " > Error updating %s: %s" %(filename, result)))
 
     print(' > Finished updating  fort.15s')
    #####
@@ -194,7 +127,7 @@ def change_nws():
     line2replace  = '       ' + nws + \
         '                        ! NWS, wind data type \n'
     filename = os.path.join(run_dir,'fort.80')
-    replace_pattern_line( filename = filename , pattern = pattern, line2replace = line2replace )
+    util.replace_pattern_line( filename = filename , pattern = pattern, line2replace = line2replace )
     print(' > Finished updating  fort.80')
 
 
@@ -335,51 +268,41 @@ def prep_nems(dic=None):
     ##################################################################################
 
 
-""" Must be adjusted per naming standards """
-def prep_ww3():
+def hotstart_cache(ini):
+    """ the hotstart cache of the initialization file and the mesh key of its storm """
+
+    cache = nhs.HotstartCache(ini.hotstart_cache, ini.hotstart_quota_gb * 1024 ** 3, ini.hotstart_max_age_days)
+    mesh = nhs.mesh_key(os.path.join(ini.FIXnsem,'meshes',ini.STORM,'ocn','fort.14'))
+    return cache, mesh
+
+
+
+
+def store_spinup(ini, run_dir=None):
     """
-    Prepare ww3 run files
+    stores the fort.67.nc/fort.68.nc a finished spin-up wrote in run_dir (COMINadc by default) in the
+    hotstart cache, with the constituents of the fort.15 there. Run by the spin-up job once ADCIRC
+    is done (nsem_prep.py <ini> --store-spinup), and again before a hot run looks the cache up.
+    returns the entry ids
     """
-    #ww3
-    txt1 = ' > Prepare ww3 inps ... (take couple of minutes)'
-    logf(txt1,log_file)
-
-    os.chdir(run_dir)
-
-    # Process WW3 grid and physics
-    txt1 = ' > Processing WW3 grid and physics...'
-    logf(txt1,log_file)
-    os.system('cp -f ' + ww3_grd_inp + '/*.msh ' + run_dir)
-    os.system('cp -f ' + ww3_grd_inp + '/ww3_grid.inp ' + run_dir)
-    os.system('${EXECnsem}/ww3_grid ww3_grid.inp > ww3_grid.out')
-    os.system('cp -p mod_def.ww3 mod_def.inlet')
-    os.system('cp -p mod_def.ww3 mod_def.points')
-
-    if base_info.wbound_flg:
-       # Process WW3 boundary conditions
-       txt1 = ' > Processing WW3 boundary conditions...'
-       logf(txt1,log_file)
-       os.system('cp -f ${COMINwave}/*.spc ' + run_dir)
-       os.system('cp -f ' + ww3_grd_inp + '/ww3_bound.inp ' + run_dir)
-       os.system('${EXECnsem}/ww3_bound ww3_bound.inp > ww3_bound.out')
-       os.system('mv nest.ww3 nest.inlet')
-       os.system('${EXECnsem}/ww3_bound ww3_bound.inp > ww3_bound.out')
-       os.system('mv nest.ww3 nest.inlet')
-    ##########
-    dc_ww3_multi={}
-    dc_ww3_multi.update({'start_pdy'    :base_info.tide_spin_end_date.strftime("%Y%m%d %H%M%S") })
-    dc_ww3_multi.update({'end_pdy'      :base_info.wave_spin_end_date.strftime("%Y%m%d %H%M%S") })
-    dc_ww3_multi.update({'dt_out_sec'   :3600  })
-    ##
-    tmpname = os.path.join(FIXnsem, 'templates', base_info.ww3_multi_tmpl)
-    ww3_multi = os.path.join(run_dir,'ww3_multi.inp')
-    util.tmp2scr(filename=ww3_multi,tmpname=tmpname,d=dc_ww3_multi)
-    #os.system('cp -fr  ' +   tmpname          +'  '   +run_dir+'/scr/')
+
+    run_dir = run_dir or ini.COMINadc
+    constituents = nhs.fort15_constituents(os.path.join(run_dir, 'fort.15'))
+    if not constituents:
+        return []
+    cache, mesh = hotstart_cache(ini)
+    try:
+        return cache.store_run(run_dir, constituents, mesh)
+    except (OSError, nch.NCHeaderError) as err:
+        msg = "\tHotstarts of %s not cached: %s" %(run_dir, err)
+        print(util.colory("red",msg))
+        return []
+
 
 
 
 """ All input file copying must be communicated to see how we should do them?? """
-def prep_adc(dic):
+def prep_adc(ini, dic):
 
     """
     adcirc preparation per storm and per run name requires:
@@ -399,6 +322,36 @@ def prep_adc(dic):
     app_inp_dir = /scratch2/COASTAL/coastal/save/NAMED_STORMS/NSEM_app_run_workflow/nsemodel_inps
     """
 
+    env = ini
+
+    # hotstart cache - a spin-up already run is not run again, a hot run starts from its fort.67.nc
+    fort15tmp = os.path.join(env.FIXnsem,'meshes',env.STORM,'ocn', dic['fort15_temp'])
+    cache, mesh = hotstart_cache(env)
+    constituents = nhs.fort15_constituents(fort15tmp) or ()
+
+    if dic['ihot'] == 0:
+        entry = cache.find(mesh, constituents, dic['end_date'])
+        if entry:
+            msg = "\tMesh already spun up to %s (hotstart %s), spin-up skipped" %(entry['hot_date'], entry['id'])
+            print(util.colory("green",msg))
+            return entry
+    else:
+        store_spinup(env)          # in case the spin-up job did not store its hotstarts
+        entry = cache.find(mesh, constituents, dic['start_date'])
+        if entry:
+            # a hardlink shares the cached file, only for runs writing no hotstart of their own
+            dic['ihot'] = cache.install(entry, env.COMINadc, link=not dic['hot_ndt_out'])
+        else:
+            # not cached (i.e. copied in by hand, unreadable header), start from what the run directory holds
+            name = nhs.staged(env.COMINadc, dic['start_date'])
+            if not name:
+                msg = "\tNo hotstart of %s reaching %s in %s or %s" %(mesh, dic['start_date'], env.hotstart_cache, env.COMINadc)
+                print(util.colory("red",msg))
+                sys.exit(1)
+            dic['ihot'] = nhs.IHOT[name]
+            msg = "\tNo cached hotstart reaching %s, starting from %s in %s" %(dic['start_date'], name, env.COMINadc)
+            print(util.colory("red",msg))
+
     msg = "\tProcessing boundary condition, fort15 ....."
     print(util.colory("green",msg))
     update_fort15(dic)
@@ -412,17 +365,11 @@ def prep_adc(dic):
 
     # copy files that are needed
     adcprep = os.path.join(env.EXECnsem, 'adcprep')
-    adc_grd_inp   = os.path.join(env.FIXnsem,'meshes',env.storm,'ocn')  # copy HSOFS grid similar for all cases
 
     """ TODO go through these
     tidefac   = os.path.join(EXECnsem, 'tidefac')
     # adc_inp   = os.path.join(COMINadc) # this must be copied there manually by HYDRO_STREAM, see CONOPS7
-    adc_grd_inp   = os.path.join(FIXnsem,'meshes',storm,'ocn')  # copy HSOFS grid similar for all cases
     ww3_grd_inp   = os.path.join(FIXnsem,'meshes',storm,'wav')
-    hot_file = os.path.join(GESIN,'hotfiles','fort.67.nc')  # TODO once manual next after running tide_spinup??
-    os.system('cp -f ' + hot_file +' ' + run_dir)
-    hot_file = os.path.join(GESIN,'hotfiles','fort.68.nc')
-    os.system('cp -f ' + hot_file +' ' + run_dir)
     """
 
 
@@ -440,26 +387,18 @@ def prep_adc(dic):
 
 
 """ need clarification to be implemented """
-def prep_ww3(wbnd_flg=0):
+def prep_ww3(ini, wbnd_flg=0):
 
     """ Prepare ww3 run files """
 
     env = ini
 
-    # Process WW3 grid and physics
-    ww3_grid_inp = os.path.join(env.FIXnsem, "meshes", env.STORM, "wav", "ww3_grid.inp")
-
-    os.system('${EXECnsem}/ww3_grid ww3_grid.inp > ww3_grid.out')
-    os.system('cp -p mod_def.ww3 mod_def.inlet')
-    os.system('cp -p mod_def.ww3 mod_def.points')
-
-    if wbnd_flg:
-       # Process WW3 boundary conditions
-       # TODO why copy from COMINwave to run_dir??
-       os.system('cp -f ${COMINwave}/*.spc ' + ini.RUN_DIR)
-       os.system('cp -f ' + ww3_grd_inp + '/ww3_bound.inp ' + run_dir)
-       os.system('${EXECnsem}/ww3_bound ww3_bound.inp > ww3_bound.out')
-       os.system('mv nest.ww3 nest.inlet')
+    # Process WW3 grid and physics, and boundary conditions - mod_def/nest files cached
+    # by their inputs and linked into the run directory, see nsem_ww3.py
+    run_dir = env.RUNdir
+    grid_dir = os.path.join(env.FIXnsem, "meshes", env.STORM, "wav")
+    ww3 = nww.WW3Prep(grid_dir, env.EXECnsem, env.WW3['cache'])
+    ww3.prep(run_dir, env.WW3['grids'], env.WW3['boundary'] if wbnd_flg else None, env.COMINwave)
 
     ##########   TODO Not found, check on these
     dc_ww3_multi={}
@@ -475,7 +414,7 @@ def prep_ww3(wbnd_flg=0):
 
 
 
-def prep_nwm(dic=None):
+def prep_nwm(ini, dic=None):
     """
     check follwing files for configuration parameters and then copy
     following files into $COMIN/nwm: setEnvar.sh, namelist.hrldas, hydro.namelist
@@ -508,41 +447,12 @@ def plot_domain_decomp():
     pass
 
 
-def setvars(tide_spin_sdate, nems_sdate, tide_spin_edate, nems_edate):
+def setvars(ini, tide_spin_sdate, nems_sdate, tide_spin_edate, nems_edate):
     # To prepare a clod start ADCIRC-Only run for spining-up the tide 
    
     env = ini    # not to change the variable already defined!!
 
-    dic = {
-
-      'Ver': 'v2.0',
-      'RunName': 'ocn_spinup_' + env.STORM,
-
-      # inp files
-      'fetch_hot_from': None,
-      'fort15_temp': 'fort.15.template.tide_spinup',
-
-      # time
-      'start_date': tide_spin_sdate,
-      'start_date_nems': nems_sdate,
-      'end_date': tide_spin_edate,
-      'dt': 2.0,
-      'dt': 2.0,
-      'ndays':  (tide_spin_edate - tide_spin_sdate).total_seconds() / 86400.,   # duration in days
-
-      # fort15 op
-      'ndays_ramp': 5,
-      'nws': 0,         # no wave no atm
-      'ihot': 0,        # no hot start
-      'hot_ndt_out': (tide_spin_edate - tide_spin_sdate).total_seconds() / 86400. * 86400 /2.0,
-
-      # NEMS settings
-      'nems_configure': 'nems.configure.ocn.IN',
-      'model_configure': 'atm_namelist.rc.template',
-      'ocn_name': 'adcirc',
-      'ocn_petlist': '0 383',
-      'coupling_interval_sec': 3600
-    }
+    dic = nsp.spinup_vars('ocn_spinup_' + env.STORM, tide_spin_sdate, tide_spin_edate, nems_sdate, nems_edate)
 
 
     msg = """\nStart spinup tide: {}
@@ -558,10 +468,11 @@ End forecast date  : {}""".format(dic['start_date'], dic['end_date'], dic['ndays
     return dic
 
 
-def main():
+def main(ini_file):
 
-    msg = "\n%s: Reading initialization file %s .........." %(__file__,"nsem_ini.py")
+    msg = "\n%s: Reading initialization file %s .........." %(__file__, ini_file)
     print(util.colory("blue", msg))
+    ini = ncf.load(ini_file)
 
     msg = "\n%s: Setting up run type \"%s\" for storm \"%s\" .........." %(__file__, ini.RUN_TYPE, ini.STORM)
     print(util.colory("blue", msg))
@@ -572,12 +483,12 @@ def main():
 
     msg = "\nCalculating spinup time ....."
     print(util.colory("red", msg))
-    tide_spin_sdate,tide_spin_edate, _, _, nems_sdate, nems_edate, = spinup_time()
+    tide_spin_sdate,tide_spin_edate, _, _, nems_sdate, nems_edate, = spinup_time(ini)
 
     # To prepare a clod start ADCIRC-Only run for spining-up the tide 
     msg = "\nSetting model variables ....."
     print(util.colory("red", msg))
-    dic = setvars(tide_spin_sdate,tide_spin_edate,nems_sdate,nems_edate)
+    dic = setvars(ini,tide_spin_sdate,tide_spin_edate,nems_sdate,nems_edate)
 
     msg = "\nPreprocessing ATM input files ....."
     print(util.colory("red", msg))
@@ -591,17 +502,17 @@ def main():
 
     msg = "\nPreprocessing ADCIRC input files ....."
     print(util.colory("red", msg))
-    # prep_adc()
+    # prep_adc(ini, dic)
 
 
     msg = "\nPreprocessing WW3 input files ....."
     print(util.colory("red", msg))
-    # prep_ww3()
+    # prep_ww3(ini)
 
 
     msg = "\nPreprocessing NWM input files ....."
     print(util.colory("red", msg))
-    prep_nwm()
+    prep_nwm(ini)
 
     msg = "\nPreparing NEMS configuration files ....."
     print(util.colory("red", msg))
@@ -612,5 +523,14 @@ def main():
 
 if __name__ == '__main__':
 
-    main()
+    args_parser = argparse.ArgumentParser(description="prepares the model inputs of a storm and run type")
+    args_parser.add_argument("ini", nargs='?', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "nsem_ini.py"),
+                        help="initialization file, nsem_ini.py next to this script by default")
+    args_parser.add_argument("--store-spinup", action="store_true",
+                        help="only stores the hotstarts of the finished spin-up in COMINadc in the hotstart cache")
+    args = args_parser.parse_args()
+    if args.store_spinup:
+        store_spinup(ncf.load(args.ini))
+    else:
+        main(args.ini)
 
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+
+"""
+File Name   : nsem_spinup.py
+Description : NSEM spin-up planner - tide and wave spin-up windows of many events (storm forecasts)
+              computed in one array call, and ADCIRC cold start tide spin-up runs whose hotstarts
+              (fort.67/68) cover every forecast start, with the fewest days simulated. Events on the same
+              mesh share a run when its start lies within the spin-up length limits of all of them and it
+              is shorter than their own runs; ADCIRC keeps only its last two hotstarts, so a run serves at
+              most two forecast start times
+Usage       : import this into an external python source file (i.e. import nsem_spinup as nsp)
+              plan = nsp.plan(events); plan.runs (setvars dictionaries), plan.reuse (event -> run, hotstart file)
+              or standalone: python nsem_spinup.py events.json [--ts 12.5] [--max-spinup 45] [--out plan.json]
+              events.json: [{"name": "ike", "start": "2008-09-06 12:00:00", "hours": 252, "mesh": "hsofs"}, ...]
+Date        : 7/6/2020
+Contacts    : Coastal Act Team
+              ali.abdolali@noaa.gov, saeed.moghimi@noaa.gov, beheen.m.trimble@gmail.com, andre.vanderwesthuysen@noaa.gov
+"""
+
+# standard libs
+import sys, json, datetime
+import argparse
+from collections import namedtuple, OrderedDict
+
+# third party libs
+import numpy as np
+
+# local libs
+import nsem_utils as nus
+
+
+TIDE_SPINUP = 12.5          # days of tide spin-up before a forecast start, at least
+WAVE_SPINUP = 27            # days of wave spin-up before a forecast start
+MAX_SPINUP = 45             # days a shared tide spin-up may run before a forecast start, at most
+DT = 2.0                    # ADCIRC time step of a spin-up run, seconds
+
+# mesh: events on different meshes never share a spin-up
+Event = namedtuple('Event', 'name start hours mesh')
+Event.__new__.__defaults__ = ('hsofs',)
+
+# reuse map entry - the spin-up run an event starts from, the hotstart time it uses and the file
+# holding it (fort.67 or fort.68, ADCIRC writes the first hotstart of a run to fort.67 then alternates)
+Reuse = namedtuple('Reuse', 'run hot_date spinup_days hotstart')
+
+
+def _seconds(days):
+    return np.round(np.asarray(days, dtype=float) * 86400.0).astype('timedelta64[s]')
+
+
+
+def to_datetime(value):
+    """ datetime64 to datetime """
+    return value.astype('datetime64[s]').astype(datetime.datetime)
+
+
+
+def events_from(items):
+    """ Events from (name, start, hours[, mesh]) tuples or dictionaries, start a date, datetime64 or a yyyy-mm-dd hh:mm:ss string """
+
+    events = []
+    for item in items:
+        if isinstance(item, dict):
+            item = Event(**item)
+        else:
+            item = Event(*item)
+        if isinstance(item.start, str):
+            start = nus.to_date(item.start, frmt=1)
+        else:
+            start = to_datetime(np.datetime64(item.start, 's'))
+        events.append(item._replace(start=start, hours=float(item.hours)))
+    return events
+
+
+
+def windows(starts, hours, ts=TIDE_SPINUP, ws=WAVE_SPINUP):
+    """
+    spin-up windows of forecasts starting at starts (datetimes or datetime64) and running hours long,
+    one element per forecast (see nsem_prep.spinup_time) - dictionary of datetime64 arrays:
+    tide_start, tide_end, wave_start, wave_end, start, end
+    """
+
+    start = np.atleast_1d(np.asarray(starts, dtype='datetime64[s]'))
+    hours = np.broadcast_to(np.asarray(hours, dtype=float), start.shape)
+    tide_start = start - _seconds(ts)
+    wave_start = start - _seconds(ws)
+    return OrderedDict([
+        ('tide_start', tide_start), ('tide_end', tide_start + _seconds(ts)),
+        ('wave_start', wave_start), ('wave_end', wave_start + _seconds(ws)),
+        ('start', start), ('end', start + _seconds(hours / 24.0)),
+    ])
+
+
+
+def pairs(starts, ts=TIDE_SPINUP, max_spinup=MAX_SPINUP, dt=DT):
+    """
+    cold starts serving the forecast starts (datetime64), at most two hotstart times per run: ADCIRC
+    alternates its hotstarts between fort.67 and fort.68, so only the last two writes survive. A run at s
+    serving a < b writes every b - a time steps, with a - s a multiple of it, and needs ts <= a - s and
+    b - s <= max_spinup days. Neighbouring starts share a run only when it is shorter than their two own
+    runs of ts days; which ones is solved exactly for the fewest simulated days (dynamic programming).
+    returns [(s, hotstart times)]
+    """
+
+    starts = np.unique(np.asarray(starts, dtype='datetime64[s]'))
+    tsec, msec = _seconds(ts), _seconds(max_spinup)
+
+    def shared(a, b):
+        """ cold start of the run serving a and b, None if they should not share one """
+        d = b - a
+        s = a - -(-tsec // d) * d
+        if b - s <= msec and b - s < 2 * tsec and (d / np.timedelta64(1, 's')) % dt == 0:
+            return s
+        return None
+
+    # cost[i]: fewest seconds simulated for the first i starts, last[i]: 1 or 2 starts in the last run
+    n = len(starts)
+    cost = [np.timedelta64(0, 's')] + [None] * n
+    last = [0] * (n + 1)
+    for i in range(1, n + 1):
+        cost[i], last[i] = cost[i - 1] + tsec, 1
+        if i > 1:
+            s = shared(starts[i - 2], starts[i - 1])
+            if s is not None and cost[i - 2] + (starts[i - 1] - s) < cost[i]:
+                cost[i], last[i] = cost[i - 2] + (starts[i - 1] - s), 2
+
+    runs = []; i = n
+    while i > 0:
+        hot = starts[i - last[i]:i]
+        runs.append((shared(hot[0], hot[1]) if len(hot) == 2 else hot[0] - tsec, hot))
+        i -= last[i]
+    return runs[::-1]
+
+
+
+def spinup_vars(run_name, tide_spin_sdate, tide_spin_edate, nems_sdate, nems_edate, hot_ndt_out=None, dt=DT):
+    """ ADCIRC only cold start run spinning up the tide (see nsem_prep.setvars), hot_ndt_out in time steps """
+
+    ndays = (tide_spin_edate - tide_spin_sdate).total_seconds() / 86400.
+    return {
+
+      'Ver': 'v2.0',
+      'RunName': run_name,
+
+      # inp files
+      'fetch_hot_from': None,
+      'fort15_temp': 'fort.15.template.tide_spinup',
+
+      # time
+      'start_date': tide_spin_sdate,
+      'start_date_nems': nems_sdate,
+      'end_date': tide_spin_edate,
+      'dt': dt,
+      'ndays': ndays,   # duration in days
+
+      # fort15 op
+      'ndays_ramp': 5,
+      'nws': 0,         # no wave no atm
+      'ihot': 0,        # no hot start
+      'hot_ndt_out': ndays * 86400 / dt if hot_ndt_out is None else hot_ndt_out,
+
+      # NEMS settings
+      'nems_configure': 'nems.configure.ocn.IN',
+      'model_configure': 'atm_namelist.rc.template',
+      'ocn_name': 'adcirc',
+      'ocn_petlist': '0 383',
+      'coupling_interval_sec': 3600
+    }
+
+
+
+class SpinupPlan():
+
+    """ runs: setvars dictionaries of the spin-up runs, reuse: {event name: Reuse} """
+
+    def __init__(self, events, runs, reuse, ts):
+
+        self.events = events
+        self.runs = runs
+        self.reuse = reuse
+        self.ts = ts
+
+
+    def spinup_days(self):
+        """ (planned, one spin-up per event) days of tide spin-up simulated """
+        return sum(r['ndays'] for r in self.runs), self.ts * len(self.events)
+
+
+    def summary(self):
+        planned, alone = self.spinup_days()
+        lines = ["%d event(s), %d spin-up run(s): %.1f days simulated instead of %.1f (%.0f%% saved)"
+                 %(len(self.events), len(self.runs), planned, alone, 100 * (1 - planned / alone) if alone else 0)]
+        for r in self.runs:
+            users = [e for e, u in self.reuse.items() if u.run == r['RunName']]
+            lines.append("  %-32s %s -> %s  %6.2f days  %s" %(r['RunName'], r['start_date'], r['end_date'],
+                                                            r['ndays'], ", ".join(users)))
+        return "\n".join(lines)
+
+
+    def to_json(self):
+        def dates(d):
+            return dict((k, [str(t) for t in v] if isinstance(v, list) else
+                            str(v) if isinstance(v, datetime.datetime) else v) for k, v in d.items())
+        return json.dumps({'runs': [dates(r) for r in self.runs],
+                           'reuse': dict((e, dates(u._asdict())) for e, u in self.reuse.items())}, indent=1)
+
+
+
+def plan(events, ts=TIDE_SPINUP, max_spinup=MAX_SPINUP, dt=DT):
+    """
+    tide spin-up runs for events (see events_from), shared by events on the same mesh (see pairs). An event
+    starting at F uses the hotstart at F of a cold start at s, ts <= F - s <= max_spinup days. A run lasts
+    until its last hotstart time. Event names must be unique.
+    returns a SpinupPlan
+    """
+
+    if max_spinup < ts:
+        raise ValueError("max_spinup %s is shorter than the tide spin-up %s" %(max_spinup, ts))
+
+    events = events_from(events)
+    names = [e.name for e in events]
+    duplicates = sorted(set(n for n in names if names.count(n) > 1))
+    if duplicates:
+        raise ValueError("duplicate event name(s): %s" %", ".join(duplicates))
+
+    w = windows([e.start for e in events], [e.hours for e in events], ts=ts)
+    meshes = np.array([e.mesh for e in events])
+
+    runs = []; reuse = OrderedDict()
+    for mesh in sorted(set(meshes)):
+        idx = np.nonzero(meshes == mesh)[0]
+        for point, hot in pairs(w['start'][idx], ts=ts, max_spinup=max_spinup, dt=dt):
+            members = idx[np.isin(w['start'][idx], hot)]
+            step = None if len(hot) == 1 else int(round((hot[1] - hot[0]) / np.timedelta64(1, 's') / dt))
+
+            if len(members) == 1:
+                name = 'ocn_spinup_' + events[members[0]].name
+            else:
+                name = 'ocn_spinup_%s_%s' %(mesh, to_datetime(point).strftime('%Y%m%d%H'))
+            first = members[np.argmin(w['start'][members])]
+            last = members[np.argmax(w['end'][members])]
+            run = spinup_vars(name, to_datetime(point), to_datetime(hot[-1]), to_datetime(w['start'][first]),
+                              to_datetime(w['end'][last]), hot_ndt_out=step, dt=dt)
+            run['hot_dates'] = [to_datetime(h) for h in hot]
+            # hotstart n of the run (1 for the first write) is in fort.67 when n is odd, fort.68 when even
+            every = hot[-1] - point if step is None else hot[1] - hot[0]
+            files = dict((h, 'fort.67' if ((h - point) // every) % 2 else 'fort.68') for h in hot.tolist())
+            run['hot_files'] = [files[h] for h in hot.tolist()]
+            runs.append(run)
+            for i in members:
+                reuse[events[i].name] = Reuse(name, to_datetime(w['start'][i]),
+                                              (w['start'][i] - point) / np.timedelta64(86400, 's'),
+                                              files[w['start'][i].tolist()])
+
+    reuse = OrderedDict((e.name, reuse[e.name]) for e in events)
+    return SpinupPlan(events, runs, reuse, ts)
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="plan the tide spin-up runs of many events, fewest days simulated")
+    parser.add_argument("events", help="json list of events: name, start, hours and optionally mesh")
+    parser.add_argument("--ts", type=float, default=TIDE_SPINUP, help="tide spin-up days, at least")
+    parser.add_argument("--max-spinup", type=float, default=MAX_SPINUP, help="tide spin-up days, at most")
+    parser.add_argument("--out", help="writes the runs and the reuse map to this json file")
+    args = parser.parse_args()
+
+    with open(args.events) as fptr:
+        spinups = plan(json.load(fptr), ts=args.ts, max_spinup=args.max_spinup)
+    print(nus.colory("green", spinups.summary()))
+    if args.out:
+        nus.write_atomic(args.out, spinups.to_json())
+        print("Spin-up plan %s" %args.out)
+    sys.exit(0)
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+
+"""
+File Name   : nsem_template.py
+Description : NSEM template registry - string.Template files (fort.15, nems.configure, model_configure,
+              ww3_multi.inp, ...) are parsed once, cached by path and modification time, and rendered
+              for many substitution dictionaries with atomic writes
+Usage       : import this into an external python source file (i.e. import nsem_template as ntp)
+Date        : 7/6/2020
+Contacts    : Coastal Act Team
+              ali.abdolali@noaa.gov, saeed.moghimi@noaa.gov, beheen.m.trimble@gmail.com, andre.vanderwesthuysen@noaa.gov
+"""
+
+# standard libs
+import os, threading
+from collections import OrderedDict
+from string import Template
+
+# local libs
+import nsem_utils as nus
+
+
+class TemplateError(KeyError):
+    """ raised by strict renders when placeholders are left without a value """
+
+    def __init__(self, tmpname, missing):
+        self.tmpname = tmpname
+        self.missing = missing
+        KeyError.__init__(self, "unresolved placeholders in %s: %s" %(tmpname, ", ".join(missing)))
+
+
+
+class CompiledTemplate():
+
+    """ a template split once into literal text and placeholder names,
+        rendering is a join over the pieces, same result as Template.safe_substitute """
+
+    def __init__(self, text, tmpname=None):
+
+        self.tmpname = tmpname
+        self.pieces = []                   # literal strings and (name, original text) tuples
+        self.identifiers = []
+
+        pos = 0
+        for mo in Template.pattern.finditer(text):
+            self.pieces.append(text[pos:mo.start()])
+            pos = mo.end()
+            name = mo.group('named') or mo.group('braced')
+            if name is not None:
+                self.pieces.append((name, mo.group()))
+                if name not in self.identifiers:
+                    self.identifiers.append(name)
+            elif mo.group('escaped') is not None:
+                self.pieces.append('$')
+            else:
+                self.pieces.append(mo.group())       # invalid placeholder, kept as is
+        self.pieces.append(text[pos:])
+
+
+    def unresolved(self, d):
+        return [name for name in self.identifiers if name not in d]
+
+
+    def render(self, d, strict=False):
+        """ returns (text, unresolved placeholder names) """
+
+        missing = self.unresolved(d)
+        if missing and strict:
+            raise TemplateError(self.tmpname, missing)
+
+        out = []
+        for piece in self.pieces:
+            if isinstance(piece, tuple):
+                name, original = piece
+                out.append(str(d[name]) if name in d else original)
+            else:
+                out.append(piece)
+        return "".join(out), missing
+
+
+
+class TemplateRegistry():
+
+    """ least recently used cache of compiled templates keyed by path,
+        a template file modified on disk is compiled again """
+
+    def __init__(self, maxsize=32):
+
+        self.maxsize = maxsize
+        self.templates = OrderedDict()     # path: (mtime_ns, size, CompiledTemplate)
+        self.lock = threading.Lock()       # ensemble members render from a thread pool
+
+
+    def get(self, tmpname):
+
+        path = os.path.abspath(tmpname)
+        st = os.stat(path)
+        with self.lock:
+            cached = self.templates.get(path)
+            if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+                self.templates.move_to_end(path)
+                return cached[2]
+
+        # compiled outside the lock, two threads may both compile a new template
+        with open(path, 'r') as fptr:
+            compiled = CompiledTemplate(fptr.read(), tmpname)
+        with self.lock:
+            self.templates[path] = (st.st_mtime_ns, st.st_size, compiled)
+            self.templates.move_to_end(path)
+            while len(self.templates) > self.maxsize:
+                self.templates.popitem(last=False)
+        return compiled
+
+
+    def render(self, tmpname, d, filename=None, strict=False):
+        """ renders one substitution dictionary, written atomically to filename if given.
+            returns (text, unresolved placeholder names) """
+
+        text, missing = self.get(tmpname).render(d, strict)
+        if filename:
+            nus.write_atomic(filename, text)
+        return text, missing
+
+
+    def render_many(self, tmpname, jobs, strict=False):
+        """
+        renders the same template for many members.
+        jobs: iterable of (filename, dictionary)
+        returns {filename: unresolved placeholder names}
+        """
+
+        compiled = self.get(tmpname)
+        report = {}
+        for filename, d in jobs:
+            text, missing = compiled.render(d, strict)
+            nus.write_atomic(filename, text)
+            report[filename] = missing
+        return report
+
+
+    def clear(self):
+        with self.lock:
+            self.templates.clear()
+
+
+
+# shared by nsem_utils.tmp2scr
+registry = TemplateRegistry()
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+
+"""
+File Name   : nsem_tidefac.py
+Description : NSEM tidal factors - nodal factors and equilibrium arguments (V0 + u, degrees Greenwich)
+              of the ADCIRC tidal constituents, the values the tide_fac program writes to tide_fac.out,
+              for many start dates and run lengths in one array call. Schureman's formulas with the
+              tide_fac conventions: V0 at the start of the run, nodal factors and u at its middle
+Usage       : import this into an external python source file (i.e. import nsem_tidefac as ntf)
+              d15 = ntf.fort15_dict(start_date, ndays)       # fft1, facet1, ... for fort.15 templates
+              standalone, same input as tide_fac: python nsem_tidefac.py ndays hour day month year [--compare tide_fac.out]
+Date        : 7/6/2020
+Contacts    : Coastal Act Team
+              ali.abdolali@noaa.gov, saeed.moghimi@noaa.gov, beheen.m.trimble@gmail.com, andre.vanderwesthuysen@noaa.gov
+"""
+
+# standard libs
+import sys, datetime
+import argparse
+from collections import OrderedDict
+
+# third party libs
+import numpy as np
+
+
+# fort.15 templates use fft<n>/facet<n> in this order
+FORT15 = ('K1', 'O1', 'P1', 'Q1', 'N2', 'M2', 'S2', 'K2', 'MF', 'MM', 'M4', 'MS4', 'MN4')
+
+# per constituent:
+#   V0 coefficients of (T, s, h, p, p1) plus a constant, degrees
+#   u coefficients of (xi, nu, nu', 2nu'', R)
+#   nodal factor exponents of the basic factors (M2, O1, K1, K2, MF, MM, J1, OO1, M3, L2)
+CONSTITUENTS = OrderedDict([
+    #        T   s   h   p  p1   const     xi  nu nu' 2nu''  R     M2 O1 K1 K2 MF MM J1 OO1 M3 L2
+    ('K1',  ((1,  0,  1,  0,  0,  -90),   (0,  0, -1,  0,  0),  (0, 0, 1, 0, 0, 0, 0, 0, 0, 0))),
+    ('O1',  ((1, -2,  1,  0,  0,   90),   (2, -1,  0,  0,  0),  (0, 1, 0, 0, 0, 0, 0, 0, 0, 0))),
+    ('P1',  ((1,  0, -1,  0,  0,   90),   (0,  0,  0,  0,  0),  (0, 0, 0, 0, 0, 0, 0, 0, 0, 0))),
+    ('Q1',  ((1, -3,  1,  1,  0,   90),   (2, -1,  0,  0,  0),  (0, 1, 0, 0, 0, 0, 0, 0, 0, 0))),
+    ('N2',  ((2, -3,  2,  1,  0,    0),   (2, -2,  0,  0,  0),  (1, 0, 0, 0, 0, 0, 0, 0, 0, 0))),
+    ('M2',  ((2, -2,  2,  0,  0,    0),   (2, -2,  0,  0,  0),  (1, 0, 0, 0, 0, 0, 0, 0, 0, 0))),
+    ('S2',  ((2,  0,  0,  0,  0,    0),   (0,  0,  0,  0,  0),  (0, 0, 0, 0, 0, 0, 0, 0, 0, 0))),
+    ('K2',  ((2,  0,  2,  0,  0,    0),   (0,  0,  0, -1,  0),  (0, 0, 0, 1, 0, 0, 0, 0, 0, 0))),
+    ('MF',  ((0,  2,  0,  0,  0,    0),   (-2, 0,  0,  0,  0),  (0, 0, 0, 0, 1, 0, 0, 0, 0, 0))),
+    ('MM',  ((0,  1,  0, -1,  0,    0),   (0,  0,  0,  0,  0),  (0, 0, 0, 0, 0, 1, 0, 0, 0, 0))),
+    ('M4',  ((4, -4,  4,  0,  0,    0),   (4, -4,  0,  0,  0),  (2, 0, 0, 0, 0, 0, 0, 0, 0, 0))),
+    ('MS4', ((4, -2,  2,  0,  0,    0),   (2, -2,  0,  0,  0),  (1, 0, 0, 0, 0, 0, 0, 0, 0, 0))),
+    ('MN4', ((4, -5,  4,  1,  0,    0),   (4, -4,  0,  0,  0),  (2, 0, 0, 0, 0, 0, 0, 0, 0, 0))),
+    ('2N2', ((2, -4,  2,  2,  0,    0),   (2, -2,  0,  0,  0),  (1, 0, 0, 0, 0, 0, 0, 0, 0, 0))),
+    ('MU2', ((2, -4,  4,  0,  0,    0),   (2, -2,  0,  0,  0),  (1, 0, 0, 0, 0, 0, 0, 0, 0, 0))),
+    ('NU2', ((2, -3,  4, -1,  0,    0),   (2, -2,  0,  0,  0),  (1, 0, 0, 0, 0, 0, 0, 0, 0, 0))),
+    ('L2',  ((2, -1,  2, -1,  0,  180),   (2, -2,  0,  0, -1),  (0, 0, 0, 0, 0, 0, 0, 0, 0, 1))),
+    ('LDA2',((2, -1,  0,  1,  0,  180),   (2, -2,  0,  0,  0),  (1, 0, 0, 0, 0, 0, 0, 0, 0, 0))),
+    ('T2',  ((2,  0, -1,  0,  1,    0),   (0,  0,  0,  0,  0),  (0, 0, 0, 0, 0, 0, 0, 0, 0, 0))),
+    ('2Q1', ((1, -4,  1,  2,  0,   90),   (2, -1,  0,  0,  0),  (0, 1, 0, 0, 0, 0, 0, 0, 0, 0))),
+    ('RHO1',((1, -3,  3, -1,  0,   90),   (2, -1,  0,  0,  0),  (0, 1, 0, 0, 0, 0, 0, 0, 0, 0))),
+    ('J1',  ((1,  1,  1, -1,  0,  -90),   (0, -1,  0,  0,  0),  (0, 0, 0, 0, 0, 0, 1, 0, 0, 0))),
+    ('OO1', ((1,  2,  1,  0,  0,  -90),   (-2, -1, 0,  0,  0),  (0, 0, 0, 0, 0, 0, 0, 1, 0, 0))),
+    ('M3',  ((3, -3,  3,  0,  0,    0),   (3, -3,  0,  0,  0),  (0, 0, 0, 0, 0, 0, 0, 0, 1, 0))),
+    ('MK3', ((3, -2,  3,  0,  0,  -90),   (2, -2, -1,  0,  0),  (1, 0, 1, 0, 0, 0, 0, 0, 0, 0))),
+    ('2MK3',((3, -4,  3,  0,  0,   90),   (4, -4,  1,  0,  0),  (2, 0,-1, 0, 0, 0, 0, 0, 0, 0))),
+    ('M6',  ((6, -6,  6,  0,  0,    0),   (6, -6,  0,  0,  0),  (3, 0, 0, 0, 0, 0, 0, 0, 0, 0))),
+    ('M8',  ((8, -8,  8,  0,  0,    0),   (8, -8,  0,  0,  0),  (4, 0, 0, 0, 0, 0, 0, 0, 0, 0))),
+    ('MSF', ((0,  2, -2,  0,  0,    0),   (-2, 2,  0,  0,  0),  (1, 0, 0, 0, 0, 0, 0, 0, 0, 0))),
+    ('S1',  ((1,  0,  0,  0,  0,    0),   (0,  0,  0,  0,  0),  (0, 0, 0, 0, 0, 0, 0, 0, 0, 0))),
+    ('S4',  ((4,  0,  0,  0,  0,    0),   (0,  0,  0,  0,  0),  (0, 0, 0, 0, 0, 0, 0, 0, 0, 0))),
+    ('S6',  ((6,  0,  0,  0,  0,    0),   (0,  0,  0,  0,  0),  (0, 0, 0, 0, 0, 0, 0, 0, 0, 0))),
+    ('SA',  ((0,  0,  1,  0,  0,    0),   (0,  0,  0,  0,  0),  (0, 0, 0, 0, 0, 0, 0, 0, 0, 0))),
+    ('SSA', ((0,  0,  2,  0,  0,    0),   (0,  0,  0,  0,  0),  (0, 0, 0, 0, 0, 0, 0, 0, 0, 0))),
+])
+
+_NAMES = list(CONSTITUENTS)
+_V0 = np.array([CONSTITUENTS[c][0] for c in _NAMES], dtype=float)        # (nconst, 6)
+_U = np.array([CONSTITUENTS[c][1] for c in _NAMES], dtype=float)         # (nconst, 5)
+_F = np.array([CONSTITUENTS[c][2] for c in _NAMES], dtype=float)         # (nconst, 10)
+
+RAD = np.pi / 180.0
+
+
+def _split(starts):
+    """ datetimes (or datetime64) to year, day of the year (1 on January 1st) and hour arrays """
+
+    t = np.atleast_1d(np.asarray(starts, dtype='datetime64[s]'))
+    year = t.astype('datetime64[Y]')
+    dayj = (t.astype('datetime64[D]') - year.astype('datetime64[D]')).astype(float) + 1.0
+    hour = (t - t.astype('datetime64[D]')).astype(float) / 3600.0
+    return year.astype(int).astype(float) + 1970.0, dayj, hour
+
+
+
+def orbit(year, dayj, hour):
+    """
+    mean longitudes, degrees in [0, 360), of the moon (s), lunar perigee (p), sun (h),
+    solar perigee (p1) and the moon's ascending node (N) - the tide_fac polynomials in years
+    since 1900, days (leap days since 1900 included) and hours, hours may run past 24
+    """
+
+    x = np.trunc((year - 1901.0) / 4.0)
+    dyr = year - 1900.0
+    dday = dayj + x - 1.0
+
+    n = 259.1560564 - 19.328185764 * dyr - 0.0529539336 * dday - 0.0022064139 * hour
+    p = 334.3837214 + 40.66246584 * dyr + 0.111404016 * dday + 0.004641834 * hour
+    s = 277.0256206 + 129.38482032 * dyr + 13.176396768 * dday + 0.549016532 * hour
+    h = 280.1895014 - 0.238724988 * dyr + 0.9856473288 * dday + 0.0410686387 * hour
+    p1 = 281.2208569 + 0.01717836 * dyr + 0.000047064 * dday + 0.000001961 * hour
+    return [np.mod(a, 360.0) for a in (s, p, h, p1, n)]
+
+
+
+def _nodal(year, dayj, hour):
+    """ u angles (xi, nu, nu', 2nu'', R) in degrees and log of the basic nodal factors at a time """
+
+    s, p, h, p1, n = orbit(year, dayj, hour)
+    N = n * RAD
+
+    I = np.arccos(0.9136949 - 0.0356926 * np.cos(N))                    # inclination of the moon's orbit
+    nu = np.arcsin(0.0897056 * np.sin(N) / np.sin(I))
+    xi = N - 2.0 * np.arctan(0.64412 * np.tan(N / 2.0)) - nu
+    nup = np.arctan(np.sin(nu) / (np.cos(nu) + 0.334766 / np.sin(2.0 * I)))
+    nup2 = np.arctan(np.sin(2.0 * nu) / (np.cos(2.0 * nu) + 0.0726184 / np.sin(I) ** 2))     # 2nu''
+
+    # L2 terms, P = p - xi
+    P = p * RAD - xi
+    tan2 = np.tan(I / 2.0) ** 2
+    R = np.arctan(np.sin(2.0 * P) / (1.0 / (6.0 * tan2) - np.cos(2.0 * P)))
+    inv_ra = np.sqrt(1.0 - 12.0 * tan2 * np.cos(2.0 * P) + 36.0 * tan2 ** 2)
+
+    base = np.stack([
+        np.cos(I / 2.0) ** 4 / 0.91544,                                                       # M2
+        np.sin(I) * np.cos(I / 2.0) ** 2 / 0.37988,                                            # O1
+        np.sqrt(0.8965 * np.sin(2.0 * I) ** 2 + 0.6001 * np.sin(2.0 * I) * np.cos(nu) + 0.1006),     # K1
+        0.001 + np.sqrt(19.0444 * np.sin(I) ** 4 + 2.7702 * np.sin(I) ** 2 * np.cos(2.0 * nu) + 0.0981),   # K2, tide_fac adds .001
+        np.sin(I) ** 2 / 0.1578,                                                               # MF
+        (2.0 / 3.0 - np.sin(I) ** 2) / 0.5021,                                                 # MM
+        np.sin(2.0 * I) / 0.7214,                                                              # J1
+        np.sin(I) * np.sin(I / 2.0) ** 2 / 0.01640,                                            # OO1
+        np.cos(I / 2.0) ** 6 / 0.8758,                                                         # M3
+        np.cos(I / 2.0) ** 4 / 0.91544 * inv_ra,                                               # L2
+    ], axis=-1)
+
+    u = np.stack([xi, nu, nup, nup2, R], axis=-1) / RAD
+    return u, np.log(base)
+
+
+
+def factors(starts, ndays, names=FORT15):
+    """
+    nodal factors and equilibrium arguments for runs starting at starts and lasting ndays.
+    starts: datetime, sequence of datetimes or datetime64 array; ndays: number or array (broadcast)
+    returns (f, eq) arrays of shape (len(starts), len(names)), eq in degrees [0, 360)
+    """
+
+    year, dayj, hour = _split(starts)
+    ndays = np.broadcast_to(np.asarray(ndays, dtype=float), year.shape)
+    idx = [_NAMES.index(c) for c in names]
+
+    # V0 at the start of the run
+    s, p, h, p1, n = orbit(year, dayj, hour)
+    T = 180.0 + 15.0 * hour                     # hour angle of the mean sun at Greenwich
+    args = np.stack([T, s, h, p, p1, np.ones_like(T)], axis=-1)
+    v0 = args @ _V0[idx].T
+
+    # nodal factors and u at the middle of the run
+    u_angles, log_base = _nodal(year, dayj, hour + ndays * 12.0)
+    f = np.exp(log_base @ _F[idx].T)
+    eq = np.mod(v0 + u_angles @ _U[idx].T, 360.0)
+    return f, eq
+
+
+
+def fort15_dicts(starts, ndays):
+    """ one fort.15 substitution dictionary per start date (fft1, facet1, ... in FORT15 order),
+        all computed in one array call - formatted as tide_fac writes them """
+
+    f, eq = factors(starts, ndays, FORT15)
+    dicts = []
+    for row_f, row_eq in zip(f, eq):
+        d = {}
+        for k, (fv, ev) in enumerate(zip(row_f, row_eq), 1):
+            d['fft%d' %k] = "%.5f" %fv
+            d['facet%d' %k] = "%.2f" %ev
+        dicts.append(d)
+    return dicts
+
+
+
+def fort15_dict(start, ndays):
+    """ the dictionary update_fort15 substitutes in fort.15 templates for one run """
+    return fort15_dicts([start], ndays)[0]
+
+
+
+def read_tide_fac(filename):
+    """ {constituent: (node factor, equilibrium argument)} from a tide_fac.out """
+
+    values = {}
+    with open(filename, 'r') as fptr:
+        for line in fptr:
+            params = line.split()
+            if len(params) >= 3 and params[0].upper() in CONSTITUENTS:
+                try:
+                    values[params[0].upper()] = (float(params[1]), float(params[2]))
+                except ValueError:
+                    continue
+    return values
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="nodal factors and equilibrium arguments, like tide_fac")
+    parser.add_argument("ndays", type=float, help="length of the run in days")
+    parser.add_argument("hour", type=float)
+    parser.add_argument("day", type=int)
+    parser.add_argument("month", type=int)
+    parser.add_argument("year", type=int)
+    parser.add_argument("--compare", help="a tide_fac.out of the same input, differences are reported")
+    parser.add_argument("--all", action='store_true', help="all constituents, not only the fort.15 ones")
+    args = parser.parse_args()
+
+    start = datetime.datetime(args.year, args.month, args.day) + datetime.timedelta(hours=args.hour)
+    names = _NAMES if args.all else FORT15
+    f, eq = factors([start], args.ndays, names)
+
+    print(" CONST   NODE     EQ ARG (ref GM)\n NAME    FACTOR    (DEG)")
+    for c, fv, ev in zip(names, f[0], eq[0]):
+        print(" %-6s %8.5f %9.2f" %(c, fv, ev))
+
+    if args.compare:
+        ref = read_tide_fac(args.compare)
+        worst_f = worst_eq = 0.0
+        for c, fv, ev in zip(names, f[0], eq[0]):
+            if c in ref:
+                worst_f = max(worst_f, abs(fv - ref[c][0]))
+                worst_eq = max(worst_eq, abs((ev - ref[c][1] + 180.0) % 360.0 - 180.0))
+        print("\nlargest difference with %s: node factor %.5f, equilibrium argument %.2f degrees"
+              %(args.compare, worst_f, worst_eq))
+        sys.exit(0 if worst_f < 1.0e-3 and worst_eq < 0.1 else 1)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+"""
+File Name   : nsem_timeaxis.py
+Description : NSEM time axis - whole calendars built as numpy datetime64 ranges and time stamped
+              file names (forcing, nudging time slices, ...) formatted in bulk
+Usage       : import this into an external python source file (i.e. import nsem_timeaxis as nta)
+Date        : 7/6/2020
+Contacts    : Coastal Act Team
+              ali.abdolali@noaa.gov, saeed.moghimi@noaa.gov, beheen.m.trimble@gmail.com, andre.vanderwesthuysen@noaa.gov
+"""
+
+# standard libs
+import datetime, functools
+
+# third party libs
+import numpy as np
+
+
+# position of each strftime code in numpy's iso string: YYYY-MM-DDTHH:MM:SS
+ISO_LEN = 19
+ISO_POS = {'Y': (0, 4), 'm': (5, 2), 'd': (8, 2), 'H': (11, 2), 'M': (14, 2), 'S': (17, 2)}
+
+
+def _to_datetime(date):
+    """ accepts a datetime or a 'yyyy-mm-dd hh:mm:ss' string """
+    if isinstance(date, str):
+        return datetime.datetime.strptime(date, '%Y-%m-%d %H:%M:%S')
+    return date
+
+
+def _to_timedelta(delta, unit):
+    """ accepts a timedelta or a number of units (i.e. hours) """
+    if isinstance(delta, datetime.timedelta):
+        return delta
+    return datetime.timedelta(**{unit: delta})
+
+
+
+@functools.lru_cache(maxsize=64)
+def _axis(start, duration, step):
+
+    t0 = np.datetime64(start, 's')
+    axis = np.arange(t0, t0 + np.timedelta64(int(duration.total_seconds()), 's'),
+                     np.timedelta64(int(step.total_seconds()), 's'))
+    axis.flags.writeable = False      # shared between callers through the cache
+    return axis
+
+
+
+def time_axis(start, duration, step, unit='hours'):
+    """
+    all times from start (included) to start + duration (excluded) every step.
+    start:    datetime or 'yyyy-mm-dd hh:mm:ss' string
+    duration: timedelta or number of units
+    step:     timedelta or number of units
+    returns a read-only datetime64[s] array, one cached array per (start, duration, step)
+    """
+
+    step = _to_timedelta(step, unit)
+    if step.total_seconds() <= 0:
+        raise ValueError("time axis step must be positive, got %s" %step)
+    return _axis(_to_datetime(start), _to_timedelta(duration, unit), step)
+
+
+
+def hourly(start, duration_hours):
+    return time_axis(start, duration_hours, 1)
+
+
+def every_15min(start, duration_hours):
+    return time_axis(start, duration_hours, datetime.timedelta(minutes=15))
+
+
+def to_datetime(t):
+    """ numpy datetime64 to datetime """
+    return t.astype('datetime64[s]').astype(datetime.datetime)
+
+
+
+@functools.lru_cache(maxsize=32)
+def _compile(pattern):
+    """ strftime-like pattern to a list of (iso string column, literal) per output character,
+        only %Y %m %d %H %M %S and %% are supported """
+
+    spec = []; i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '%' and i + 1 < len(pattern):
+            code = pattern[i+1]
+            if code == '%':
+                spec.append((None, '%'))
+            elif code in ISO_POS:
+                pos, width = ISO_POS[code]
+                spec += [(pos + k, None) for k in range(width)]
+            else:
+                raise ValueError("unsupported format code %%%s in %s" %(code, pattern))
+            i += 2
+        else:
+            spec.append((None, c))
+            i += 1
+    return tuple(spec)
+
+
+
+def format_times(axis, pattern):
+    """
+    formats every time of the axis with pattern (i.e. '%Y%m%d%H.LDASIN_DOMAIN1') at once -
+    the output characters are gathered column by column from the iso strings, so there is
+    no python loop over the times. returns a numpy unicode array
+    """
+
+    spec = _compile(pattern)
+    if len(axis) == 0 or len(spec) == 0:
+        return np.array([''] * len(axis), dtype='U1')
+
+    iso = np.datetime_as_string(axis.astype('datetime64[s]'), unit='s').astype('U%d' %ISO_LEN)
+    chars = iso.view('U1').reshape(len(iso), ISO_LEN)
+
+    out = np.empty((len(iso), len(spec)), dtype='U1')
+    for k, (col, literal) in enumerate(spec):
+        out[:, k] = literal if col is None else chars[:, col]
+    return out.view('U%d' %len(spec)).ravel()
+
+
+
+@functools.lru_cache(maxsize=64)
+def _file_names(start, duration, step, template, token, fmt):
+    pattern = template.replace('%', '%%').replace(token, fmt)
+    return tuple(format_times(_axis(start, duration, step), pattern).tolist())
+
+
+
+def file_names(template, token, fmt, start, duration, step, unit='hours'):
+    """
+    file names for every time of the axis - token in template is replaced by the time in fmt.
+    i.e. file_names('yyyymmddhh.LDASIN_DOMAIN1', 'yyyymmddhh', '%Y%m%d%H', start, 240, 1)
+    returns a cached tuple of strings
+    """
+
+    step = _to_timedelta(step, unit)
+    time_axis(start, duration, step, unit)      # validates and warms the shared axis
+    return _file_names(_to_datetime(start), _to_timedelta(duration, unit), step, template, token, fmt)
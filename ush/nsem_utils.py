@@ -7,9 +7,9 @@ Contacts    : Coastal Act Team
               ali.abdolali@noaa.gov, saeed.moghimi@noaa.gov, beheen.m.trimble@gmail.com, andre.vanderwesthuysen@noaa.gov
 """
 
-from string import Template
 import datetime, time
 import argparse, os, sys
+import shutil, tempfile, stat
 
 
 # local libs
@@ -61,13 +61,10 @@ def dateloop_byhour(start_date, duration_hours):
 
 
 def dateloop_15min(start_date, duration_min):
+    # every 15 minutes after start_date - for whole calendars use nsem_timeaxis
 
-    min_cntr = 0
-    for n in range(duration_min):
-        if min_cntr == 15:
-            min_cntr = 0
-            yield start_date + datetime.timedelta(minutes=n)
-        min_cntr += 1
+    for n in range(15, duration_min, 15):
+        yield start_date + datetime.timedelta(minutes=n)
 
 
 
@@ -118,6 +115,38 @@ def import_file(filename):
 
 
 
+def write_atomic(filename, text, mode='w'):
+    """
+    writes text into a temporary file next to filename and renames it over
+    filename, readers never see a half written file
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmpfile = tempfile.mkstemp(prefix="." + os.path.basename(filename) + ".", dir=directory)
+    try:
+        with os.fdopen(fd, mode) as fptr:
+            try:
+                os.fchmod(fd, stat.S_IMODE(os.stat(filename).st_mode))
+            except FileNotFoundError:
+                os.fchmod(fd, _FILE_MODE)      # mkstemp makes it 0600
+            fptr.write(text)
+        os.replace(tmpfile, filename)
+    except BaseException:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+        raise
+
+
+def _umask():
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+# mode of a new file under the umask, read once at import: os.umask is process wide,
+# swapping it while other threads create files would give them umask 0
+_FILE_MODE = 0o666 & ~_umask()
+
+
+
 def tmp2scr(filename=None,tmpname=None,d=None):
     """
     Replace a pattern in tempelate file and generate a new input file.
@@ -125,33 +154,81 @@ def tmp2scr(filename=None,tmpname=None,d=None):
     tmpname:  full path to tempelate file
     d:        dictionary of all patterns need to replace   
 
-    Uses string.Template from the Python standard library
+    Uses the compiled template cache in nsem_template.py, placeholders
+    without a value in d are left in place and reported
     """
-    fileout = open( filename,'w' )
-    filetmp = open( tmpname ,'r' )
-    out = Template( filetmp.read() ).safe_substitute(d)
-    fileout.write(str(out))
-    fileout.close()
-    filetmp.close()
+    import nsem_template
+
+    out, missing = nsem_template.registry.render(tmpname, d or {}, filename=filename)
+    if missing:
+        print(colory("red", "Unresolved placeholders in {}: {}".format(tmpname, ", ".join(missing))))
     return out   # just-incase if needed 
 
 
+def rewrite_lines(filename, rules):
+    """
+    replace the whole line if one of the patterns is found - all the rules
+    are applied in one pass, streaming into a temporary file renamed over filename.
+    rules: list of (pattern, line2replace), pattern is a string or a compiled regex,
+           the first pattern found in a line wins
+    returns the number of replaced lines
+    """
+    def matcher(pattern):
+        if hasattr(pattern, 'search'):
+            return pattern.search
+        return lambda line: pattern in line
+
+    rules = [(matcher(p), line) for p, line in rules]
+
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmpfile = tempfile.mkstemp(prefix="." + os.path.basename(filename) + ".", dir=directory)
+    nreplaced = 0
+    try:
+        with open(filename, 'r') as fin, os.fdopen(fd, 'w') as fout:
+            for line in fin:
+                for found, line2replace in rules:
+                    if found(line):
+                        line = line2replace
+                        nreplaced += 1
+                        break
+                fout.write(line)
+        shutil.copymode(filename, tmpfile)
+        os.replace(tmpfile, filename)
+    except BaseException:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+        raise
+    return nreplaced
+
+
+
+def rewrite_many(filenames, rules, workers=16):
+    """
+    rewrite_lines over many files (i.e. fort.15 in every PE directory) with a thread pool.
+    returns {filename: number of replaced lines or the exception raised}
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    def run(filename):
+        try:
+            return rewrite_lines(filename, rules)
+        except (OSError, UnicodeDecodeError) as err:
+            return err
+
+    filenames = list(filenames)
+    if not filenames:
+        return {}
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(filenames)))) as pool:
+        return dict(zip(filenames, pool.map(run, filenames)))
+
+
+
 def replace_pattern_line(filename, pattern, line2replace):
     """
     replace the whole line if the pattern found
     
     """
-
-    tmpfile = filename+'.tmp2'
-    os.system(' cp  -f ' + filename + '  ' + tmpfile)
-    tmp  = open(tmpfile,'r')
-    fil  = open(filename,'w')
-    for line in tmp:
-        fil.write(line2replace if pattern in line else line)
-
-    tmp.close()
-    fil.close()
-    os.system('rm ' + tmpfile  )
+    return rewrite_lines(filename, [(pattern, line2replace)])
 
 
 class BlankLinesHelpFormatter (argparse.HelpFormatter):
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+
+"""
+File Name   : nsem_verify.py
+Description : NSEM input file verification - checks large sets of expected input files
+              with one directory listing per parent directory instead of one stat per file
+Usage       : import this into an external python source file (i.e. import nsem_verify as nvf)
+              or run standalone to benchmark: python nsem_verify.py [nfiles]
+Date        : 7/6/2020
+Contacts    : Coastal Act Team
+              ali.abdolali@noaa.gov, saeed.moghimi@noaa.gov, beheen.m.trimble@gmail.com, andre.vanderwesthuysen@noaa.gov
+"""
+
+# standard libs
+import os, sys, time, stat
+import shutil, tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+# local libs
+import nsem_utils as nus
+
+
+# directories holding at least this many expected files are listed once with
+# os.scandir (or opened once and their files stat'ed relative to it, when sizes or
+# ages are checked),
+# the rest of the files are stat'ed one by one in a thread pool
+SCAN_THRESHOLD = 8
+MAX_WORKERS = 16
+
+
+class VerifyReport():
+
+    """ result of a verification run, files are kept with their full path """
+
+    def __init__(self):
+
+        self.checked = 0
+        self.missing = []        # not found, or not a regular file
+        self.empty = []          # smaller than min_size bytes
+        self.young = []          # modified less than min_age seconds ago (still being written?)
+        self.elapsed = 0.0
+
+
+    @property
+    def ok(self):
+        return not (self.missing or self.empty or self.young)
+
+
+    def bad_files(self):
+        return self.missing + self.empty + self.young
+
+
+    def summary(self):
+        msg = "Checked %d files in %.3f seconds: %d missing, %d too small, %d too young" \
+              %(self.checked, self.elapsed, len(self.missing), len(self.empty), len(self.young))
+        return msg
+
+
+    def print_report(self, title=None):
+
+        if self.ok:
+            print(nus.colory("green", title or self.summary()))
+            return
+
+        msg = "\n" + (title or self.summary())
+        for label, files in (("not found", self.missing), ("too small", self.empty), ("too young", self.young)):
+            for f in files:
+                msg += "\n%-10s %s" %(label, f)
+        print(nus.colory("red", msg))
+
+
+
+def _check_stat(st, min_size, min_age, now):
+    """ returns None if good, or the name of the report list the file belongs to """
+
+    if st.st_size < min_size:
+        return "empty"
+    if min_age > 0 and now - st.st_mtime < min_age:
+        return "young"
+    return None
+
+
+
+def _stat_file(path, min_size, min_age, now):
+
+    try:
+        st = os.stat(path)
+    except OSError:
+        return "missing"
+    if not stat.S_ISREG(st.st_mode):
+        return "missing"
+    return _check_stat(st, min_size, min_age, now)
+
+
+
+def _stat_dir(dirname, names, min_size, min_age, now):
+    """ stats names relative to the open directory, in this thread - each lookup starts from the
+        directory instead of the root. returns [(name, report list name)] of the bad files """
+
+    try:
+        fd = os.open(dirname, os.O_RDONLY | os.O_DIRECTORY)
+    except OSError:
+        return [(n, "missing") for n in names]
+    bad = []
+    try:
+        for n in names:
+            try:
+                st = os.stat(n, dir_fd=fd)
+            except OSError:
+                bad.append((n, "missing"))
+                continue
+            which = "missing" if not stat.S_ISREG(st.st_mode) else _check_stat(st, min_size, min_age, now)
+            if which:
+                bad.append((n, which))
+    finally:
+        os.close(fd)
+    return bad
+
+
+
+def _list_dir(dirname):
+    """ one listing of a directory - returns the set of names of its regular files """
+
+    entries = set()
+    try:
+        with os.scandir(dirname) as it:
+            for entry in it:
+                try:
+                    if entry.is_file():
+                        entries.add(entry.name)
+                except OSError:
+                    pass      # dangling links are reported as missing
+    except OSError:
+        pass                  # missing directory, every file in it is missing
+    return entries
+
+
+
+def verify_files(paths, min_size=0, min_age=0, workers=MAX_WORKERS, scan_threshold=SCAN_THRESHOLD):
+    """
+    checks that all the paths exist and are regular files.
+    paths:          iterable of full path file names
+    min_size:       files smaller than this (in bytes) are reported as empty, 1 catches zero-size files
+    min_age:        files modified less than min_age seconds ago are reported as too young
+                    - without min_size and min_age listed files are only looked up by name, nothing is stat'ed.
+                    with them a listing saves nothing, the files of those directories are stat'ed serially,
+                    relative to the directory
+    workers:        number of threads used for stat calls
+    scan_threshold: directories with at least this many expected files are listed with os.scandir
+    returns a VerifyReport
+    """
+
+    t0 = time.time()
+    report = VerifyReport()
+    need_stat = min_size > 0 or min_age > 0
+
+    # group the expected names per parent directory
+    by_dir = {}
+    for p in paths:
+        if p[:1] != os.sep:
+            p = os.path.abspath(p)
+        d, _, name = p.rpartition(os.sep)
+        names = by_dir.get(d)
+        if names is None:
+            names = by_dir[d] = []
+        names.append(name)
+
+    now = time.time()
+    singles = []          # paths that must be stat'ed one by one
+    for d, names in by_dir.items():
+        d = d or os.sep
+        report.checked += len(names)
+        if len(names) < scan_threshold:
+            singles.extend(os.path.join(d, n) for n in names)
+        elif need_stat:
+            for n, which in _stat_dir(d, names, min_size, min_age, now):
+                getattr(report, which).append(os.path.join(d, n))
+        else:
+            entries = _list_dir(d)
+            report.missing.extend(os.path.join(d, n) for n in names if n not in entries)
+
+    # stat calls of the scattered files are spread over the pool in chunks, one future per chunk
+    nchunks = max(1, min(workers, len(singles)))
+    chunks = [singles[i::nchunks] for i in range(nchunks)]
+
+    def run_chunk(chunk):
+        return [(path, _stat_file(path, min_size, min_age, now)) for path in chunk]
+
+    if len(singles) < scan_threshold or nchunks == 1:
+        results = [run_chunk(singles)]
+    else:
+        with ThreadPoolExecutor(max_workers=nchunks) as pool:
+            results = list(pool.map(run_chunk, chunks))
+
+    for result in results:
+        for path, which in result:
+            if which:
+                getattr(report, which).append(path)
+
+    report.missing.sort(); report.empty.sort(); report.young.sort()
+    report.elapsed = time.time() - t0
+    return report
+
+
+
+def benchmark(nfiles=10000, root=None, repeat=5):
+    """ builds a synthetic NWM storm tree of nfiles and compares a serial
+        os.path.isfile loop against verify_files, best of repeat runs each """
+
+    tmp = tempfile.mkdtemp(prefix="nsem_verify_", dir=root)
+    try:
+        # same layout as the NWM standalone data directory: 1/5 hourly forcing, 4/5 15-min time slices
+        forcing = os.path.join(tmp, "forcing", "storm")
+        slices = os.path.join(tmp, "nudgingTimeSliceObs", "storm")
+        os.makedirs(forcing)
+        os.makedirs(slices)
+
+        paths = []
+        for i in range(nfiles):
+            if i % 5 == 0:
+                p = os.path.join(forcing, "%010d.LDASIN_DOMAIN1" %i)
+            else:
+                p = os.path.join(slices, "%010d.15min.usgsTimeSlice.ncdf" %i)
+            with open(p, 'w') as f:
+                f.write("x")
+            paths.append(p)
+        # a few that are not there
+        paths += [os.path.join(forcing, "missing.%d" %i) for i in range(10)]
+
+        t_serial = None
+        for _ in range(repeat):
+            t0 = time.time()
+            serial_missing = [p for p in paths if not os.path.isfile(p)]
+            t_serial = min(time.time() - t0, t_serial or float('inf'))
+
+        report = min((verify_files(paths) for _ in range(repeat)), key=lambda r: r.elapsed)
+        sized = min((verify_files(paths, min_size=1) for _ in range(repeat)), key=lambda r: r.elapsed)
+
+        print("Serial os.path.isfile       : %d files, %d missing in %.3f seconds" %(len(paths), len(serial_missing), t_serial))
+        print("verify_files (names only)   : %s, %.1fx faster" %(report.summary(), t_serial / max(report.elapsed, 1e-6)))
+        print("verify_files (zero-size too): %s, %.1fx faster" %(sized.summary(), t_serial / max(sized.elapsed, 1e-6)))
+        return t_serial, report.elapsed, sized.elapsed
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+
+if __name__ == '__main__':
+
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
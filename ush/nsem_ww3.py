@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+
+"""
+File Name   : nsem_ww3.py
+Description : NSEM WW3 preprocessing - ww3_grid and ww3_bound run in-process in scratch directories, their
+              outputs (mod_def.ww3, nest.ww3) cached by a hash of their inputs and the executable, and
+              linked into the run directories as mod_def.<grid> and nest.<grid>. A grid is processed once
+              per ww3_grid.inp, mesh files and executable, the boundary only when the spectral files (*.spc)
+              change, and independent grids are processed in parallel
+Usage       : import this into an external python source file (i.e. import nsem_ww3 as nww)
+              ww3 = nww.WW3Prep(grid_dir, exec_dir, cache_dir); ww3.prep(run_dir, ['inlet', 'points'], 'inlet', spc_dir)
+Date        : 7/6/2020
+Contacts    : Coastal Act Team
+              ali.abdolali@noaa.gov, saeed.moghimi@noaa.gov, beheen.m.trimble@gmail.com, andre.vanderwesthuysen@noaa.gov
+"""
+
+# standard libs
+import os, glob, time, hashlib
+import shutil, tempfile, subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+# local libs
+import nsem_utils as nus
+import nsem_install as nin
+import nsem_buildcache as nbc
+
+
+GRID_INP = 'ww3_grid.inp'
+BOUND_INP = 'ww3_bound.inp'
+GRID_FILES = ('*.msh', '*.bot', '*.mask', '*.obst')         # read by ww3_grid next to ww3_grid.inp
+SPC_FILES = '*.spc'
+MAX_WORKERS = 8
+
+
+class WW3PrepError(RuntimeError):
+    pass
+
+
+
+def _key(kind, files, exe_digest, *extra):
+    """ sha256 of the names and contents of files, the executable and extra keys """
+
+    with ThreadPoolExecutor(max_workers=max(1, min(MAX_WORKERS, len(files)))) as pool:
+        digests = list(pool.map(nin.file_hash, files))
+    parts = [kind, exe_digest] + list(extra)
+    parts += ["%s %s" %(os.path.basename(f), d) for f, d in zip(files, digests)]
+    return hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+
+
+def _run(exe, inputs, outputs, log):
+    """
+    runs exe in a scratch directory holding links to inputs ({name: path}).
+    returns the scratch directory, with outputs (names) checked to be there - the caller removes it
+    """
+
+    work = tempfile.mkdtemp(prefix="." + os.path.basename(exe) + ".", dir=os.path.dirname(log))
+    for name, path in inputs.items():
+        os.symlink(os.path.abspath(path), os.path.join(work, name))
+    with open(log, 'w') as fptr:
+        status = subprocess.call([exe], cwd=work, stdout=fptr, stderr=subprocess.STDOUT)
+    missing = [o for o in outputs if not os.path.exists(os.path.join(work, o))]
+    if status or missing:
+        shutil.rmtree(work, ignore_errors=True)
+        raise WW3PrepError("%s failed (status %d%s), see %s" %(os.path.basename(exe), status,
+                           ", no " + " ".join(missing) if missing else "", log))
+    return work
+
+
+
+class WW3Prep():
+
+    """
+    grid_dir: ww3_grid.inp, ww3_bound.inp and mesh files (i.e. $FIXnsem/meshes/<storm>/wav), a grid with
+              inputs of its own has them in grid_dir/<grid>. exec_dir: ww3_grid and ww3_bound executables
+    """
+
+    def __init__(self, grid_dir, exec_dir, cache_dir, workers=MAX_WORKERS):
+
+        self.grid_dir = grid_dir
+        self.ww3_grid = os.path.join(exec_dir, 'ww3_grid')
+        self.ww3_bound = os.path.join(exec_dir, 'ww3_bound')
+        self.cache = nbc.BuildCache(cache_dir)
+        self.workers = workers
+        self._exe = {}
+
+
+    def exe_digest(self, exe):
+        """ executable version, its content hash """
+        if exe not in self._exe:
+            self._exe[exe] = nin.file_hash(exe)
+        return self._exe[exe]
+
+
+    def inputs_of(self, grid):
+        """ directory of the inputs of a grid and its ww3_grid input files """
+
+        d = os.path.join(self.grid_dir, grid)
+        if not os.path.exists(os.path.join(d, GRID_INP)):
+            d = self.grid_dir
+        files = [os.path.join(d, GRID_INP)]
+        for pattern in GRID_FILES:
+            files += sorted(glob.glob(os.path.join(d, pattern)))
+        return d, files
+
+
+    # ---------------------------------------------------------- ww3_grid
+
+    def mod_def(self, grid):
+        """ key of the mod_def.ww3 of grid in the cache, ww3_grid runs only if it is not there.
+            returns (key, seconds of ww3_grid or 0.0 if cached) """
+
+        d, files = self.inputs_of(grid)
+        key = _key('ww3_grid', files, self.exe_digest(self.ww3_grid))
+        if self.cache.has(key):
+            return key, 0.0
+
+        print("Running ww3_grid for grid %s (%s) ....." %(grid, d))
+        t0 = time.time()
+        work = _run(self.ww3_grid, dict((os.path.basename(f), f) for f in files), ['mod_def.ww3'],
+                    os.path.join(self.cache.root, "ww3_grid.%s.%d.out" %(key[:12], os.getpid())))
+        try:
+            self.cache.store(key, {'mod_def.ww3': os.path.join(work, 'mod_def.ww3')})
+        finally:
+            shutil.rmtree(work, ignore_errors=True)
+        return key, time.time() - t0
+
+
+    def prep_grids(self, run_dir, grids):
+        """ mod_def.<grid> of every grid linked into run_dir, grids of different inputs processed
+            in parallel and grids of the same inputs once. returns {grid: (key, seconds)} """
+
+        with ThreadPoolExecutor(max_workers=max(1, min(self.workers, len(grids)))) as pool:
+            by_inputs = {}
+            for grid in grids:
+                d, files = self.inputs_of(grid)
+                by_inputs.setdefault(tuple(files), []).append(grid)
+            futures = dict((files, pool.submit(self.mod_def, names[0])) for files, names in by_inputs.items())
+
+        done = {}
+        for files, names in by_inputs.items():
+            key, seconds = futures[files].result()
+            for grid in names:
+                self.cache.link(key, {'mod_def.ww3': os.path.join(run_dir, 'mod_def.' + grid)})
+                done[grid] = (key, seconds)
+        return done
+
+
+    # ---------------------------------------------------------- ww3_bound
+
+    def prep_boundary(self, run_dir, grid, spc_dir, mod_def_key):
+        """ nest.<grid> in run_dir from the spectral files of spc_dir, ww3_bound runs only if
+            those files, ww3_bound.inp or the grid changed. returns (key, seconds or 0.0 if cached) """
+
+        d, files = self.inputs_of(grid)
+        bound_inp = os.path.join(d, BOUND_INP)
+        spc = sorted(glob.glob(os.path.join(spc_dir, SPC_FILES)))
+        if not spc:
+            raise WW3PrepError("no spectral boundary files %s in %s" %(SPC_FILES, spc_dir))
+
+        key = _key('ww3_bound', [bound_inp] + spc, self.exe_digest(self.ww3_bound), mod_def_key)
+        seconds = 0.0
+        if not self.cache.has(key):
+            print("Running ww3_bound for grid %s with %d spectral file(s) ....." %(grid, len(spc)))
+            t0 = time.time()
+            inputs = dict((os.path.basename(f), f) for f in [bound_inp] + spc)
+            inputs['mod_def.ww3'] = os.path.join(self.cache.entry(mod_def_key), 'mod_def.ww3')
+            work = _run(self.ww3_bound, inputs, ['nest.ww3'],
+                        os.path.join(self.cache.root, "ww3_bound.%s.%d.out" %(key[:12], os.getpid())))
+            try:
+                self.cache.store(key, {'nest.ww3': os.path.join(work, 'nest.ww3')})
+            finally:
+                shutil.rmtree(work, ignore_errors=True)
+            seconds = time.time() - t0
+
+        self.cache.link(key, {'nest.ww3': os.path.join(run_dir, 'nest.' + grid)})
+        return key, seconds
+
+
+    def prep(self, run_dir, grids, boundary=None, spc_dir=None):
+        """ mod_def.<grid> for every grid and, with a boundary grid, its nest.<grid> into run_dir """
+
+        os.makedirs(run_dir, exist_ok=True)
+        t0 = time.time()
+        done = self.prep_grids(run_dir, grids)
+        for grid, (key, seconds) in done.items():
+            state = "ww3_grid %.1f seconds" %seconds if seconds else "cached"
+            print("mod_def.%s: %s (%s)" %(grid, key[:12], state))
+
+        if boundary:
+            key, seconds = self.prep_boundary(run_dir, boundary, spc_dir, done[boundary][0])
+            state = "ww3_bound %.1f seconds" %seconds if seconds else "spectral files unchanged, cached"
+            print("nest.%s: %s (%s)" %(boundary, key[:12], state))
+
+        print(nus.colory("green", "WW3 inputs ready in %s, %.1f seconds" %(run_dir, time.time() - t0)))
+        return done
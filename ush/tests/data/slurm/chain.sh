@@ -0,0 +1,9 @@
+#!/bin/sh -l
+# submits 3 job(s), each held by Slurm until the jobs it depends on end
+set -e
+spin_up_0=$(sbatch --parsable @TMP@/spinup.job)
+echo 'spin-up_0: '"$spin_up_0"
+job_2nd_forecast=$(sbatch --parsable --dependency=afterok:$spin_up_0 @TMP@/forecast.job)
+echo '2nd forecast: '"$job_2nd_forecast"
+post=$(sbatch --parsable --dependency=afterany:$spin_up_0,afterok:$job_2nd_forecast @TMP@/post.job)
+echo 'post: '"$post"
@@ -0,0 +1,76 @@
+"""
+File Name   : test_func_nsem_build.py
+Description : Slurm job files of func_nsem_build (array, heterogeneous and chained submissions) against
+              golden files in data/slurm. The temporary directory of a test reads @TMP@ in them.
+              To accept a change of the job files: NSEM_UPDATE_GOLDEN=1 python -m pytest ush/tests
+Usage       : python -m pytest ush/tests
+Date        : 7/6/2020
+Contacts    : Coastal Act Team
+              ali.abdolali@noaa.gov, saeed.moghimi@noaa.gov, beheen.m.trimble@gmail.com, andre.vanderwesthuysen@noaa.gov
+"""
+
+# standard libs
+import os, sys
+
+import pytest
+
+# local libs
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import func_nsem_build as fbn
+
+
+GOLDEN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "slurm")
+
+
+
+def _job(tmp, name="florence_atm2ocn"):
+    return fbn.SlurmJob(account='coastal', ntasks=32, nnodes=2, queue='debug', time=8, jobname=name,
+                        error=name, output=name, mailuser='coastal.act@noaa.gov', slurm_dir=str(tmp),
+                        prj_dir='/prj/ADC-WW3-NWM-NEMS')
+
+
+
+def _check(filename, tmp, golden):
+    with open(filename) as fptr:
+        text = fptr.read().replace(str(tmp), "@TMP@")
+    golden = os.path.join(GOLDEN, golden)
+    if os.environ.get('NSEM_UPDATE_GOLDEN'):
+        with open(golden, 'w') as fptr:
+            fptr.write(text)
+    with open(golden) as fptr:
+        assert text == fptr.read(), "%s differs from %s" %(filename, golden)
+
+
+
+def test_write_array(tmp_path):
+    runs = [tmp_path / ("member_%d" %i) for i in range(3)]
+    job_file = _job(tmp_path).write_array([str(r) for r in runs], max_running=2)
+    _check(job_file, tmp_path, "array.job")
+    _check(job_file.replace(".job", "") + ".dirs", tmp_path, "array.dirs")
+
+
+
+def test_write_hetjob(tmp_path):
+    petlists = {'ATM': (0, 0), 'OCN': (1, 60), 'WAV': (61, 100), 'HYD': (101, 130)}
+    job_file = _job(tmp_path).write_hetjob(petlists, {'ATM': 40, 'OCN': 40, 'WAV': 40, 'HYD': 24})
+    _check(job_file, tmp_path, "het.job")
+
+
+
+def test_write_chain(tmp_path):
+    jobs = [("spin-up_0", str(tmp_path / "spinup.job"), []),
+            ("2nd forecast", str(tmp_path / "forecast.job"), [("afterok", "spin-up_0")]),
+            ("post", str(tmp_path / "post.job"), [("afterany", "spin-up_0"), ("afterok", "2nd forecast")])]
+    script = fbn.write_chain(str(tmp_path / "submit.sh"), jobs)
+    _check(script, tmp_path, "chain.sh")
+    assert os.access(script, os.X_OK)
+
+
+
+def test_write_chain_names(tmp_path):
+    assert fbn.shell_name("spin-up.0") == "spin_up_0"
+    assert fbn.shell_name("0_run") == "job_0_run"
+    with pytest.raises(ValueError):          # the same shell variable
+        fbn.write_chain(str(tmp_path / "submit.sh"), [("a-b", "a.job", []), ("a.b", "b.job", [])])
+    with pytest.raises(ValueError):          # not submitted before
+        fbn.write_chain(str(tmp_path / "submit.sh"), [("a", "a.job", [("afterok", "b")])])
@@ -0,0 +1,65 @@
+"""
+File Name   : test_nsem_tidefac.py
+Description : nsem_tidefac against tide_fac.out files written by sorc/ADCIRC/util/estofs_tide_fac for several
+              start dates and run lengths. The reference file names hold the input: tide_fac_yyyymmddhh_ndays.out
+Usage       : python -m pytest ush/tests
+Date        : 7/6/2020
+Contacts    : Coastal Act Team
+              ali.abdolali@noaa.gov, saeed.moghimi@noaa.gov, beheen.m.trimble@gmail.com, andre.vanderwesthuysen@noaa.gov
+"""
+
+# standard libs
+import os, sys, glob, datetime
+
+# local libs
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import nsem_tidefac as ntf
+
+
+REFERENCES = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "tide_fac", "tide_fac_*.out")))
+
+
+
+def _input(filename):
+    """ (start, ndays) of a reference file name """
+    stamp, ndays = os.path.basename(filename)[len("tide_fac_"):-len(".out")].split('_')
+    return datetime.datetime.strptime(stamp, "%Y%m%d%H"), float(ndays)
+
+
+
+def _check(f, eq, ref):
+    for c, fv, ev in zip(ntf.FORT15, f, eq):
+        rf, re = ref[c]
+        assert abs(fv - rf) <= 1.0e-5 + 1.0e-9, "%s node factor %.5f, tide_fac %.5f" %(c, fv, rf)
+        assert abs((ev - re + 180.0) % 360.0 - 180.0) <= 0.015, "%s equilibrium argument %.2f, tide_fac %.2f" %(c, ev, re)
+
+
+
+def test_references_present():
+    assert len(REFERENCES) >= 5
+
+
+
+def test_each_reference():
+    for filename in REFERENCES:
+        start, ndays = _input(filename)
+        f, eq = ntf.factors([start], ndays)
+        _check(f[0], eq[0], ntf.read_tide_fac(filename))
+
+
+
+def test_one_array_call():
+    """ all references in one call, with a run length per start date """
+    inputs = [_input(filename) for filename in REFERENCES]
+    f, eq = ntf.factors([s for s, n in inputs], [n for s, n in inputs])
+    for k, filename in enumerate(REFERENCES):
+        _check(f[k], eq[k], ntf.read_tide_fac(filename))
+
+
+
+def test_fort15_dict():
+    start, ndays = _input(REFERENCES[0])
+    ref = ntf.read_tide_fac(REFERENCES[0])
+    d = ntf.fort15_dict(start, ndays)
+    for k, c in enumerate(ntf.FORT15, 1):
+        assert abs(float(d['fft%d' %k]) - ref[c][0]) <= 1.0e-5 + 1.0e-9